@@ -0,0 +1,229 @@
+"""
+This module contains the BulkLoad, which prepares tables to be loaded with as little overhead as
+possible and restores them afterwards.
+
+While the tables are prepared they are UNLOGGED (so their rows are not written to the WAL) and have
+no foreign keys, unique constraints or secondary indexes to maintain on every row. Once they are
+loaded they are set LOGGED again, their indexes are rebuilt over several connections at once and
+their foreign keys are added without checking the existing rows (NOT VALID) and then validated
+once, also in parallel.
+
+The definitions of everything that is dropped are saved to a JSON file before dropping it, so if the
+load fails they are restored by the next bulk load instead of being lost.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import time
+
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models import Model
+
+
+class BulkLoad:
+    """
+    Drops the constraints and indexes of tables and makes them unlogged during a bulk load.
+
+    Usage:
+        bulk_load = BulkLoad([Patent, PatentCitation], "bulk_load.json")
+        bulk_load.prepare()
+        load_the_tables()
+        bulk_load.finish()
+    """
+
+    def __init__(
+        self,
+        models: list[type[Model]],
+        state_path: str,
+        connections: int = 1,
+        using: str = DEFAULT_DB_ALIAS,
+    ):
+        """
+        Args:
+            models (list[type[Model]]): The models whose tables are loaded.
+            state_path (str): The JSON file the definitions of the dropped objects are saved to.
+            connections (int, optional): The connections the indexes are rebuilt over. Defaults to 1.
+            using (str, optional): The database of the tables. Defaults to "default".
+        """
+
+        self.tables = [model._meta.db_table for model in models]
+        self.state_path = state_path
+        self.connections = max(1, connections)
+        self.using = using
+        self.timings = {}
+
+    def prepare(self):
+        """
+        Saves the definitions of the foreign keys, unique constraints and secondary indexes of the
+        tables, drops them and sets the tables UNLOGGED.
+        If a previous bulk load didn't finish, the definitions it saved are used.
+        """
+
+        start = time.perf_counter()
+        if os.path.exists(self.state_path):
+            print(
+                f"Using the definitions saved by a previous bulk load in {self.state_path}"
+            )
+            with open(self.state_path) as f:
+                self.state = json.load(f)
+        else:
+            self.state = self._read_definitions()
+            with open(self.state_path, "w") as f:
+                json.dump(self.state, f, indent=4)
+
+        with connections[self.using].cursor() as cursor:
+            # Foreign keys first, a unique constraint can't be dropped while a key references it
+            for foreign_key in self.state["foreign_keys"]:
+                cursor.execute(
+                    f'ALTER TABLE {foreign_key["table"]} '
+                    f'DROP CONSTRAINT IF EXISTS "{foreign_key["name"]}"'
+                )
+            for constraint in self.state["unique_constraints"]:
+                cursor.execute(
+                    f'ALTER TABLE {constraint["table"]} '
+                    f'DROP CONSTRAINT IF EXISTS "{constraint["name"]}"'
+                )
+            for index in self.state["indexes"]:
+                cursor.execute(f'DROP INDEX IF EXISTS "{index["name"]}"')
+            for table in self.tables:
+                cursor.execute(f'ALTER TABLE "{table}" SET UNLOGGED')
+
+        self._time("Preparing the tables", start)
+
+    def finish(self):
+        """
+        Sets the tables LOGGED, rebuilds their indexes and unique constraints in parallel, adds
+        the foreign keys back and validates them in parallel. Then it prints the time each step
+        took and removes the saved definitions.
+        """
+
+        start = time.perf_counter()
+        # Permanent tables can't reference unlogged ones, so this goes before the foreign keys
+        self._run_parallel(f'ALTER TABLE "{table}" SET LOGGED' for table in self.tables)
+        self._time("Setting the tables logged", start)
+
+        start = time.perf_counter()
+        self._run_parallel(
+            index["definition"]
+            for index in self.state["indexes"] + self.state["unique_constraints"]
+            if not self._index_exists(index["name"])
+        )
+        with connections[self.using].cursor() as cursor:
+            for constraint in self.state["unique_constraints"]:
+                if not self._constraint_exists(constraint["table"], constraint["name"]):
+                    cursor.execute(
+                        f'ALTER TABLE {constraint["table"]} ADD CONSTRAINT '
+                        f'"{constraint["name"]}" UNIQUE USING INDEX "{constraint["name"]}"'
+                    )
+        self._time("Rebuilding the indexes", start)
+
+        start = time.perf_counter()
+        with connections[self.using].cursor() as cursor:
+            for foreign_key in self.state["foreign_keys"]:
+                if not self._constraint_exists(
+                    foreign_key["table"], foreign_key["name"]
+                ):
+                    cursor.execute(
+                        f'ALTER TABLE {foreign_key["table"]} ADD CONSTRAINT '
+                        f'"{foreign_key["name"]}" {foreign_key["definition"]} NOT VALID'
+                    )
+        self._run_parallel(
+            f'ALTER TABLE {foreign_key["table"]} '
+            f'VALIDATE CONSTRAINT "{foreign_key["name"]}"'
+            for foreign_key in self.state["foreign_keys"]
+        )
+        self._time("Validating the foreign keys", start)
+
+        os.remove(self.state_path)
+        for step, elapsed in self.timings.items():
+            print(f"{step}: {elapsed:.1f}s")
+
+    def _read_definitions(self) -> dict:
+        """
+        Reads the definitions of the foreign keys (from and to the tables), unique constraints
+        and secondary indexes of the tables. Primary keys are kept, so they are not read.
+
+        Returns:
+            dict: The definitions.
+        """
+
+        with connections[self.using].cursor() as cursor:
+            cursor.execute(
+                "SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid) "
+                "FROM pg_constraint WHERE contype = 'f' "
+                "AND (conrelid = ANY(%s::regclass[]) OR confrelid = ANY(%s::regclass[]))",
+                [self.tables, self.tables],
+            )
+            foreign_keys = [
+                {"table": table, "name": name, "definition": definition}
+                for table, name, definition in cursor.fetchall()
+            ]
+
+            # A unique constraint is restored by building its index, then attaching it
+            cursor.execute(
+                "SELECT conrelid::regclass::text, conname, pg_get_indexdef(conindid) "
+                "FROM pg_constraint WHERE contype = 'u' AND conrelid = ANY(%s::regclass[])",
+                [self.tables],
+            )
+            unique_constraints = [
+                {"table": table, "name": name, "definition": definition}
+                for table, name, definition in cursor.fetchall()
+            ]
+
+            cursor.execute(
+                "SELECT x.indrelid::regclass::text, i.relname, pg_get_indexdef(i.oid) "
+                "FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid "
+                "WHERE x.indrelid = ANY(%s::regclass[]) AND NOT EXISTS ("
+                "SELECT 1 FROM pg_constraint c WHERE c.conindid = x.indexrelid "
+                "AND c.conrelid = x.indrelid AND c.contype IN ('p', 'u', 'x'))",
+                [self.tables],
+            )
+            indexes = [
+                {"table": table, "name": name, "definition": definition}
+                for table, name, definition in cursor.fetchall()
+            ]
+
+        return {
+            "tables": self.tables,
+            "foreign_keys": foreign_keys,
+            "unique_constraints": unique_constraints,
+            "indexes": indexes,
+        }
+
+    def _index_exists(self, name: str) -> bool:
+        with connections[self.using].cursor() as cursor:
+            cursor.execute("SELECT to_regclass(%s) IS NOT NULL", [f'"{name}"'])
+            return cursor.fetchone()[0]
+
+    def _constraint_exists(self, table: str, name: str) -> bool:
+        with connections[self.using].cursor() as cursor:
+            cursor.execute(
+                "SELECT EXISTS (SELECT 1 FROM pg_constraint "
+                "WHERE conrelid = %s::regclass AND conname = %s)",
+                [table, name],
+            )
+            return cursor.fetchone()[0]
+
+    def _run_parallel(self, statements):
+        """
+        Runs statements over several connections at once, each statement in its own transaction.
+
+        Args:
+            statements: The statements to run.
+        """
+
+        def run(statement: str):
+            connection = connections[self.using]  # Each thread gets its own connection
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(statement)
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(self.connections) as executor:
+            # list() waits for all of them and raises the first error
+            list(executor.map(run, list(statements)))
+
+    def _time(self, step: str, start: float):
+        self.timings[step] = time.perf_counter() - start
@@ -0,0 +1,184 @@
+"""
+This module contains the Checkpoint, a manifest of the stages of a long load that were completed,
+so a load that failed can be resumed instead of started over.
+
+Before a stage starts, the manifest records a watermark for each table it loads: the highest
+primary key for tables with a serial key, the number of rows for the others. A stage that was
+started but not completed is rolled back by deleting the rows above its watermarks, which can be
+done any number of times, and then it's run again.
+"""
+
+from datetime import datetime
+import json
+import os
+
+from django.apps import apps
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models import Model
+
+from main.management.copy_helper import SERIAL_FIELD_TYPES
+
+
+class CheckpointError(Exception):
+    """
+    Raised when a stage can't be rolled back.
+    """
+
+
+class Checkpoint:
+    """
+    Records the stages of a load that were started and completed in a JSON manifest.
+
+    Usage:
+        checkpoint = Checkpoint("checkpoint.json")
+        for stage, models in stages.items():
+            if not checkpoint.is_completed(stage):
+                checkpoint.start(stage, models)
+                run(stage)
+                checkpoint.complete(stage)
+    """
+
+    def __init__(self, path: str, using: str = DEFAULT_DB_ALIAS):
+        """
+        Args:
+            path (str): The path of the manifest, it's loaded if it exists.
+            using (str, optional): The database the stages load. Defaults to "default".
+        """
+
+        self.path = path
+        self.using = using
+        self.stages = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.stages = json.load(f)["stages"]
+
+    def reset(self):
+        """
+        Forgets all the stages, for a load that starts over.
+        """
+
+        self.stages = {}
+        self._save()
+
+    def is_completed(self, stage: str) -> bool:
+        """
+        Checks if a stage was completed.
+
+        Args:
+            stage (str): The name of the stage.
+
+        Returns:
+            bool: True if the stage was completed.
+        """
+
+        return self.stages.get(stage, {}).get("completed_at") is not None
+
+    def start(self, stage: str, models: list[type[Model]]):
+        """
+        Records the watermarks of the tables a stage loads before it runs. If the stage was
+        already started by a previous run, the rows it loaded are deleted instead, and the
+        watermarks of that run are kept.
+
+        Args:
+            stage (str): The name of the stage.
+            models (list[type[Model]]): The models the stage loads, in the order they are loaded.
+
+        Raises:
+            CheckpointError: If the stage can't be rolled back.
+        """
+
+        if stage in self.stages:
+            self.rollback(stage)
+            return
+
+        watermarks = {}
+        with connections[self.using].cursor() as cursor:
+            for model in models:
+                table, pk = model._meta.db_table, model._meta.pk.column
+                if _has_serial_pk(model):
+                    cursor.execute(f'SELECT MAX("{pk}") FROM "{table}"')
+                else:
+                    cursor.execute(f'SELECT COUNT(*) FROM "{table}"')
+                watermarks[model._meta.label] = cursor.fetchone()[0] or 0
+
+        self.stages[stage] = {
+            "started_at": datetime.now().isoformat(),
+            "completed_at": None,
+            "watermarks": watermarks,
+            "rows": {},
+        }
+        self._save()
+
+    def rollback(self, stage: str):
+        """
+        Deletes the rows a stage loaded, the last loaded table first.
+
+        Args:
+            stage (str): The name of the stage.
+
+        Raises:
+            CheckpointError: If a table without a serial key had rows before the stage.
+        """
+
+        watermarks = self.stages[stage]["watermarks"]
+        print(f"Rolling back the rows the {stage} stage loaded in a previous run...")
+        with connections[self.using].cursor() as cursor:
+            for label, watermark in reversed(watermarks.items()):
+                model = apps.get_model(label)
+                table, pk = model._meta.db_table, model._meta.pk.column
+                if _has_serial_pk(model):
+                    cursor.execute(
+                        f'DELETE FROM "{table}" WHERE "{pk}" > %s', [watermark]
+                    )
+                elif watermark == 0:
+                    cursor.execute(f'DELETE FROM "{table}"')
+                else:
+                    raise CheckpointError(
+                        f"{table} had rows before the {stage} stage, "
+                        "so the rows the stage loaded can't be told apart."
+                    )
+
+    def complete(self, stage: str):
+        """
+        Records that a stage was completed, with the rows it loaded into each table.
+
+        Args:
+            stage (str): The name of the stage.
+        """
+
+        rows = {}
+        with connections[self.using].cursor() as cursor:
+            for label, watermark in self.stages[stage]["watermarks"].items():
+                model = apps.get_model(label)
+                table, pk = model._meta.db_table, model._meta.pk.column
+                if _has_serial_pk(model):
+                    cursor.execute(
+                        f'SELECT COUNT(*) FROM "{table}" WHERE "{pk}" > %s',
+                        [watermark],
+                    )
+                    rows[label] = cursor.fetchone()[0]
+                else:
+                    cursor.execute(f'SELECT COUNT(*) FROM "{table}"')
+                    rows[label] = cursor.fetchone()[0] - watermark
+
+        self.stages[stage]["rows"] = rows
+        self.stages[stage]["completed_at"] = datetime.now().isoformat()
+        self._save()
+
+    def _save(self):
+        """
+        Writes the manifest, replacing the previous one atomically so it's never half written.
+        """
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(f"{self.path}.tmp", "w") as f:
+            json.dump({"stages": self.stages}, f, indent=4)
+        os.replace(f"{self.path}.tmp", self.path)
+
+
+def _has_serial_pk(model: type[Model]) -> bool:
+    """
+    This function checks if the primary key of a model is generated by a sequence.
+    """
+
+    return model._meta.pk.get_internal_type() in SERIAL_FIELD_TYPES
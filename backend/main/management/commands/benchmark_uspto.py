@@ -0,0 +1,399 @@
+"""
+This module defines a command that benchmarks parts of the uspto ingestion pipeline, so changes to
+it can be measured (and verified) without running the whole ingestion.
+
+Usage:
+    python manage.py benchmark_uspto normalization --source main/data/g_patent.tsv.zip
+    python manage.py benchmark_uspto copy --rows 1000000
+    python manage.py benchmark_uspto id_map --rows 8000000
+    python manage.py benchmark_uspto staging_cache --source main/data/g_us_patent_citation.tsv.zip
+    python manage.py benchmark_uspto ingestion --rows 100000
+    python manage.py benchmark_uspto ingestion --rows 100000 --compare-bulk-load
+"""
+
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+import numpy as np
+import pandas as pd
+
+from main.models import Patent, PatentCitation
+from main.management.helpers import lemma_text, lemmatize_token
+from main.management.commands.uspto import LOADED_MODELS
+from main.management.copy_helper import CopyPipeline, copy_dataframe
+from main.management.id_map import IdMap
+from main.management.memory_helper import format_size
+from main.management.staging_cache_helper import StagingCache
+from main.management.synthetic_helper import SyntheticPatentsView
+
+
+class Command(BaseCommand):
+    help = "This command benchmarks parts of the uspto ingestion pipeline."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "suite",
+            choices=["normalization", "copy", "id_map", "staging_cache", "ingestion"],
+        )
+        parser.add_argument(
+            "--source",
+            default=None,
+            help="A zipped g_patent table to take the texts from, otherwise the titles of the "
+            "patents in the database are used. The staging_cache suite reads any zipped table "
+            "and the ingestion suite loads the tables of a directory (e.g. made by "
+            "generate_uspto).",
+        )
+        parser.add_argument(
+            "--rows",
+            type=int,
+            default=20000,
+            help="How many rows to benchmark, the patents the ingestion suite generates.",
+        )
+        parser.add_argument(
+            "--copy-connections",
+            type=int,
+            default=os.cpu_count(),
+            help="The connections the copy suite copies the shards over (defaults to the "
+            "number of CPUs).",
+        )
+        parser.add_argument(
+            "--compare-bulk-load",
+            action="store_true",
+            help="Run the ingestion suite without and with --bulk-load-mode and compare them.",
+        )
+
+    def benchmark_normalization(self, source: str | None, rows: int):
+        """
+        Runs the text normalization (lemma_text) and its original implementation over a sample
+        of patent texts and reports the throughput of both. That their output is the same is
+        tested in main.tests.test_lemma_text.
+
+        Args:
+            source (str | None): A zipped g_patent table to take the texts from.
+            rows (int): How many patents to take the texts from.
+        """
+
+        from main.tests.test_lemma_text import reference_lemma_text
+
+        if source:
+            patents = pd.read_csv(
+                source,
+                sep="\t",
+                compression="zip",
+                usecols=["patent_title", "patent_abstract"],
+                dtype=str,
+                nrows=rows,
+            )
+            texts = (
+                patents["patent_title"].tolist() + patents["patent_abstract"].tolist()
+            )
+        else:
+            texts = list(Patent.objects.values_list("title", flat=True)[:rows])
+
+        start = time.perf_counter()
+        for text in texts:
+            reference_lemma_text(text)
+        reference_time = time.perf_counter() - start
+
+        lemmatize_token.cache_clear()
+        start = time.perf_counter()
+        for text in texts:
+            lemma_text(text)
+        optimized_time = time.perf_counter() - start
+
+        print(f"Texts: {len(texts)}")
+        print(f"Original: {len(texts) / reference_time:,.0f} texts/s")
+        print(f"Optimized: {len(texts) / optimized_time:,.0f} texts/s")
+        print(f"Speedup: {reference_time / optimized_time:.1f}x")
+
+    def benchmark_copy(self, rows: int, connections: int):
+        """
+        Copies synthetic patent citations into a temporary table in the CSV and the binary COPY
+        formats, and then with a CopyPipeline over one and over several connections, and reports
+        the throughput of each. Nothing is written to the real tables.
+
+        Args:
+            rows (int): How many citations to copy.
+            connections (int): The connections of the sharded pipeline.
+        """
+
+        rng = np.random.default_rng(0)
+        citations = pd.DataFrame(
+            {
+                "citing_patent_id": pd.array(rng.integers(1, 10**7, rows), "Int64"),
+                "cited_patent_id": pd.array(
+                    np.where(
+                        rng.random(rows) < 0.2, None, rng.integers(1, 10**7, rows)
+                    ),
+                    "Int64",
+                ),
+                "citation_date": np.datetime_as_string(
+                    np.datetime64("1976-01-01")
+                    + rng.integers(0, 17000, rows).astype("timedelta64[D]")
+                ).astype(object),
+                "cited_patent_number": np.where(
+                    rng.random(rows) < 0.8, None, "D123456"
+                ).astype(object),
+            }
+        )
+        citations["citation_year"] = citations["citation_date"].str[:4].astype("Int64")
+
+        print(f"Rows: {rows}")
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                f'CREATE TEMP TABLE "copy_benchmark" '
+                f'(LIKE "{PatentCitation._meta.db_table}" INCLUDING DEFAULTS) '
+                "ON COMMIT DROP"
+            )
+            for format in ["csv", "binary"]:
+                cursor.execute('TRUNCATE "copy_benchmark"')
+                start = time.perf_counter()
+                copy_dataframe(
+                    cursor,
+                    PatentCitation,
+                    citations,
+                    table="copy_benchmark",
+                    format=format,
+                )
+                elapsed = time.perf_counter() - start
+                print(f"{format}: {rows / elapsed:,.0f} rows/s ({elapsed:.2f}s)")
+
+        # The pipeline copies on connections of its own threads, so the table can't be temporary
+        table = "copy_benchmark_shards"
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'CREATE UNLOGGED TABLE "{table}" '
+                f'(LIKE "{PatentCitation._meta.db_table}" INCLUDING DEFAULTS)'
+            )
+        try:
+            elapsed = {}
+            for shards in dict.fromkeys([1, max(connections, 1)]):
+                with connection.cursor() as cursor:
+                    cursor.execute(f'TRUNCATE "{table}"')
+                start = time.perf_counter()
+                with CopyPipeline(
+                    PatentCitation, connections=shards, table=table
+                ) as pipeline:
+                    for chunk_start in range(0, rows, 100000):
+                        pipeline.put(citations.iloc[chunk_start : chunk_start + 100000])
+                elapsed[shards] = time.perf_counter() - start
+                print(
+                    f"CopyPipeline, {shards} connection(s): "
+                    f"{rows / elapsed[shards]:,.0f} rows/s ({elapsed[shards]:.2f}s)"
+                )
+            if len(elapsed) > 1:
+                print(f"Sharding speedup: {elapsed[1] / elapsed[shards]:.1f}x")
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute(f'DROP TABLE "{table}"')
+
+    def benchmark_id_map(self, rows: int):
+        """
+        Maps synthetic patent ids with a dict (the way the ids used to be mapped) and with an
+        IdMap, in memory and memory-mapped, verifies that all of them give the same ids and
+        reports the peak memory of building each map and the throughput of the lookups.
+
+        Args:
+            rows (int): How many ids the maps have.
+        """
+
+        rng = np.random.default_rng(0)
+        keys = pd.Series(
+            np.char.mod("%d", rng.permutation(rows) + 3000000).astype(object)
+        )
+        ids = np.arange(1, rows + 1)
+        lookups = pd.concat(
+            [
+                keys.sample(frac=0.9, random_state=0),
+                pd.Series(["D000000"] * (rows // 10)),
+            ]
+        )
+
+        def measure(build):
+            tracemalloc.start()
+            start = time.perf_counter()
+            id_map = build()
+            build_time = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            return id_map, build_time, peak
+
+        id_dict, dict_build, dict_peak = measure(lambda: dict(zip(keys, ids)))
+        id_map, map_build, map_peak = measure(lambda: IdMap.from_pairs(keys, ids))
+
+        with tempfile.TemporaryDirectory() as directory:
+            mapped = id_map.save(f"{directory}/patent")
+            results = {}
+            for name, lookup in [
+                ("dict", lambda: lookups.map(id_dict).astype("Int64")),
+                ("IdMap", lambda: id_map.map(lookups)),
+                ("IdMap (mmap)", lambda: mapped.map(lookups)),
+            ]:
+                start = time.perf_counter()
+                results[name] = lookup()
+                elapsed = time.perf_counter() - start
+                print(f"{name}: {len(lookups) / elapsed:,.0f} lookups/s")
+            del mapped
+
+        print(f"Ids: {rows}")
+        print(f"dict: built in {dict_build:.2f}s, peak {dict_peak / 2**20:,.0f} MiB")
+        print(
+            f"IdMap: built in {map_build:.2f}s, peak {map_peak / 2**20:,.0f} MiB, "
+            f"{id_map.nbytes / 2**20:,.0f} MiB once built"
+        )
+        if not all(result.equals(results["dict"]) for result in results.values()):
+            raise CommandError("The IdMap lookups differ from the dict lookups.")
+        print("The lookups are identical.")
+
+    def benchmark_staging_cache(self, source: str | None, rows: int):
+        """
+        Reads a zipped table in chunks with pd.read_csv and through the staging cache (once
+        converting it and once reading the converted file), verifies that both give the same
+        chunks and reports the throughput of each.
+
+        Args:
+            source (str | None): The zipped table.
+            rows (int): The rows of each chunk.
+
+        Raises:
+            CommandError: If no table is given, pyarrow is not installed or the chunks differ.
+        """
+
+        if not source:
+            raise CommandError("The staging_cache suite needs a table, pass --source.")
+        try:
+            cache = StagingCache(tempfile.mkdtemp())
+        except ImportError as e:
+            raise CommandError(f"The staging_cache suite needs pyarrow ({e}).")
+
+        def measure(read):
+            start = time.perf_counter()
+            chunks = list(read(chunksize=rows, dtype=str))
+            return chunks, time.perf_counter() - start
+
+        expected, csv_time = measure(
+            lambda **kwargs: pd.read_csv(source, sep="\t", compression="zip", **kwargs)
+        )
+        start = time.perf_counter()
+        cache.convert(source)
+        convert_time = time.perf_counter() - start
+        chunks, cache_time = measure(lambda **kwargs: cache.read(source, **kwargs))
+
+        total = sum(len(chunk) for chunk in expected)
+        print(f"Rows: {total}")
+        print(f"pd.read_csv: {total / csv_time:,.0f} rows/s")
+        print(f"Conversion: {total / convert_time:,.0f} rows/s")
+        print(f"Staging cache: {total / cache_time:,.0f} rows/s")
+        print(f"Speedup: {csv_time / cache_time:.1f}x")
+        if len(chunks) != len(expected) or not all(
+            chunk.equals(expected_chunk)
+            for chunk, expected_chunk in zip(chunks, expected)
+        ):
+            raise CommandError(
+                "The chunks of the staging cache differ from pd.read_csv."
+            )
+        print("The chunks are identical.")
+
+    def run_ingestion(self, source: str, directory: str, **options) -> dict:
+        """
+        Runs the uspto command over the tables of source and prints the time, the throughput and
+        the peak memory of each stage from the report of the run.
+
+        Args:
+            source (str): A directory with the zipped tables.
+            directory (str): The directory the report is written to.
+            **options: Options passed to the uspto command.
+
+        Returns:
+            dict: The report of the run.
+        """
+
+        report_path = f"{directory}/report.json"
+        call_command("uspto", mirror_dir=source, report=report_path, **options)
+        with open(report_path) as f:
+            report = json.load(f)
+
+        for stage, record in report["stages"].items():
+            loaded = sum(record.get("rows_loaded", {}).values())
+            print(
+                f"{stage}: {record['wall_seconds']:.1f}s, {record['rows_read']:,} rows read "
+                f"({record['rows_per_second']:,.0f} rows/s), {loaded:,} rows loaded, "
+                f"{format_size(record['peak_rss_bound'])} peak RSS at most"
+            )
+        patents = Patent.objects.count()
+        print(f"Patents: {patents}")
+        print(
+            f"Total: {report['wall_seconds']:.1f}s "
+            f"({patents / report['wall_seconds']:,.0f} patents/s), "
+            f"{format_size(report['peak_rss_bound'])} peak RSS at most"
+        )
+        return report
+
+    def benchmark_ingestion(
+        self, source: str | None, rows: int, compare_bulk_load: bool
+    ):
+        """
+        Runs the whole uspto ingestion into an empty database, over the tables of a directory or
+        over synthetic tables with rows patents (see SyntheticPatentsView), and reports the time
+        and the throughput of each stage from the report of the run. When comparing the bulk
+        load mode, the ingestion runs once normally and once with --bulk-load-mode, emptying the
+        loaded tables in between, and the totals of both runs are reported.
+
+        Args:
+            source (str | None): A directory with the zipped tables, otherwise they are generated.
+            rows (int): How many patents to generate.
+            compare_bulk_load (bool): Whether to run the ingestion without and with bulk load mode.
+
+        Raises:
+            CommandError: If the database already has patents.
+        """
+
+        if Patent.objects.exists():
+            raise CommandError(
+                "The ingestion suite loads into an empty database, run resetdb first."
+            )
+
+        with tempfile.TemporaryDirectory() as directory:
+            if not source:
+                start = time.perf_counter()
+                SyntheticPatentsView(rows).write(directory)
+                print(f"Generated in {time.perf_counter() - start:.1f}s")
+                source = directory
+
+            if not compare_bulk_load:
+                self.run_ingestion(source, directory)
+                return
+
+            print("Without --bulk-load-mode:")
+            normal = self.run_ingestion(source, directory)
+            tables = ", ".join(f'"{model._meta.db_table}"' for model in LOADED_MODELS)
+            with connection.cursor() as cursor:
+                cursor.execute(f"TRUNCATE {tables} RESTART IDENTITY CASCADE")
+            print("With --bulk-load-mode:")
+            bulk = self.run_ingestion(source, directory, bulk_load_mode=True)
+
+        print(
+            f"Total without --bulk-load-mode: {normal['wall_seconds']:.1f}s, "
+            f"with --bulk-load-mode: {bulk['wall_seconds']:.1f}s "
+            f"({normal['wall_seconds'] / bulk['wall_seconds']:.1f}x)"
+        )
+
+    def handle(self, *args, **options):
+        if options["suite"] == "normalization":
+            self.benchmark_normalization(options["source"], options["rows"])
+        elif options["suite"] == "copy":
+            self.benchmark_copy(options["rows"], options["copy_connections"])
+        elif options["suite"] == "id_map":
+            self.benchmark_id_map(options["rows"])
+        elif options["suite"] == "staging_cache":
+            self.benchmark_staging_cache(options["source"], options["rows"])
+        elif options["suite"] == "ingestion":
+            self.benchmark_ingestion(
+                options["source"], options["rows"], options["compare_bulk_load"]
+            )
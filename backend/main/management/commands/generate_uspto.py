@@ -0,0 +1,64 @@
+"""
+This module defines a command that generates a synthetic PatentsView release, with the tables the
+uspto command reads and their schemas, so the whole ingestion can be run and benchmarked at any
+scale without downloading anything (see SyntheticPatentsView).
+
+Usage:
+    python manage.py generate_uspto --patents 1000000
+    python manage.py uspto --mirror-dir main/data/synthetic
+"""
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from main.management.synthetic_helper import SyntheticPatentsView
+
+OUTPUT_DIRECTORY = f"{settings.BASE_DIR}/main/data/synthetic"
+
+
+class Command(BaseCommand):
+    help = "This command generates synthetic PatentsView tables for the uspto command."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--patents",
+            type=int,
+            default=10000,
+            help="How many patents to generate, the other tables are scaled with them.",
+        )
+        parser.add_argument(
+            "--output-dir",
+            default=OUTPUT_DIRECTORY,
+            help="The directory the tables are written to (defaults to main/data/synthetic), "
+            "it can be passed to the uspto command with --mirror-dir.",
+        )
+        parser.add_argument(
+            "--seed",
+            type=int,
+            default=0,
+            help="The seed of the generator, the same seed and patents give the same tables.",
+        )
+        parser.add_argument(
+            "--dirty",
+            type=float,
+            default=0.001,
+            help="The share of dirty values of each kind (e.g. malformed dates or unknown ids).",
+        )
+
+    def handle(self, *args, **options):
+        if options["patents"] <= 0:
+            raise CommandError("--patents must be positive.")
+        if not 0 <= options["dirty"] <= 0.1:
+            raise CommandError("--dirty must be between 0 and 0.1.")
+
+        start = time.perf_counter()
+        generator = SyntheticPatentsView(
+            options["patents"], seed=options["seed"], dirty=options["dirty"]
+        )
+        paths = generator.write(options["output_dir"])
+        print(
+            f"{len(paths)} tables generated in {options['output_dir']} "
+            f"in {time.perf_counter() - start:.1f}s."
+        )
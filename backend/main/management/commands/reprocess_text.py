@@ -0,0 +1,317 @@
+"""
+This module defines a command that normalizes the texts of the patents that are already in the
+database again (e.g. after the text normalization changed), without loading the data again.
+
+The titles are streamed out of the database with a server-side cursor, in id order, and lemmatized
+by the process pool one batch at a time. The database only keeps the processed abstracts, so the
+abstracts are normalized again only if the g_patent table they came from is given, and they are
+read from it in batches instead. While a batch is lemmatized the previous one is written back by
+another thread (on its own connection): it's copied into a temporary staging table and the patents
+are updated from it with a single UPDATE, which only rewrites the rows whose values changed.
+
+Every batch is committed on its own and the progress is saved after it, so the command can be
+stopped at any time and continued with --resume.
+
+Usage:
+    python manage.py reprocess_text
+    python manage.py reprocess_text --abstracts main/data/g_patent.tsv.zip --resume
+"""
+
+from concurrent.futures import ThreadPoolExecutor, Future
+from itertools import islice
+import json
+import os
+import time
+from typing import Iterator
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+import numpy as np
+import pandas as pd
+
+from main.models import Patent
+from main.management.helpers import (
+    lemmatize_column,
+    start_pool,
+    close_pool,
+)
+from main.management.commands.uspto import ID_MAP_DIRECTORY
+from main.management.copy_helper import copy_dataframe
+from main.management.id_map import IdMap
+
+BATCH_SIZE = 100000
+PROCESSES = os.cpu_count()
+CHECKPOINT_PATH = f"{settings.BASE_DIR}/main/data/reprocess_text_checkpoint.json"
+STAGING_TABLE = "reprocess_text_staging"
+
+
+class Command(BaseCommand):
+    help = "This command normalizes the titles and abstracts of the patents again."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--abstracts",
+            default=None,
+            help="The zipped g_patent table the patents were loaded from, to normalize their "
+            "abstracts too (the database doesn't keep the original abstracts).",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=BATCH_SIZE,
+            help="How many patents are normalized and written back at once.",
+        )
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=PROCESSES,
+            help="The size of the process pool the texts are normalized with "
+            "(defaults to the number of CPUs).",
+        )
+        parser.add_argument(
+            "--id-map-dir",
+            default=ID_MAP_DIRECTORY,
+            help="The directory the uspto command saved its id maps to, the patents of the "
+            "abstracts are looked up in its patent id map instead of in the database.",
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="Continue from the last batch a previous run wrote back (see "
+            "reprocess_text_checkpoint.json in the data directory).",
+        )
+
+    def load_progress(self, resume: bool) -> dict:
+        """
+        Reads the progress a previous run saved, or starts over.
+
+        Args:
+            resume (bool): Whether to continue the previous run.
+
+        Returns:
+            dict: The progress of the titles and the abstracts.
+        """
+
+        if resume and os.path.exists(CHECKPOINT_PATH):
+            with open(CHECKPOINT_PATH) as f:
+                return json.load(f)
+        return {
+            "title": {"last_id": 0, "rows": 0, "updated": 0, "completed": False},
+            "abstract": {"rows": 0, "updated": 0, "completed": False},
+        }
+
+    def save_progress(self):
+        """
+        Writes the progress, replacing the previous one atomically.
+        """
+
+        os.makedirs(os.path.dirname(CHECKPOINT_PATH), exist_ok=True)
+        with open(f"{CHECKPOINT_PATH}.tmp", "w") as f:
+            json.dump(self.progress, f, indent=2)
+        os.replace(f"{CHECKPOINT_PATH}.tmp", CHECKPOINT_PATH)
+
+    def write_batch(self, batch: pd.DataFrame) -> int:
+        """
+        Updates the patents of a batch from a staging table, in a transaction of its own. It's
+        run by the writer thread, so it uses that thread's connection.
+
+        Args:
+            batch (pd.DataFrame): The id of each patent and its new values, with the columns
+            named after the fields of Patent.
+
+        Returns:
+            int: How many patents had a value that changed.
+        """
+
+        table = Patent._meta.db_table
+        columns = [column for column in batch.columns if column != "id"]
+        names = ", ".join(f'"{column}"' for column in ["id", *columns])
+        assignments = ", ".join(f'"{column}" = s."{column}"' for column in columns)
+        current = ", ".join(f'p."{column}"' for column in columns)
+        new = ", ".join(f's."{column}"' for column in columns)
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                f'CREATE TEMP TABLE "{STAGING_TABLE}" ON COMMIT DROP AS '
+                f'SELECT {names} FROM "{table}" WITH NO DATA'
+            )
+            copy_dataframe(cursor, Patent, batch, table=STAGING_TABLE)
+            cursor.execute(f'ANALYZE "{STAGING_TABLE}"')
+            cursor.execute(
+                f'UPDATE "{table}" AS p SET {assignments} FROM "{STAGING_TABLE}" AS s '
+                f"WHERE p.id = s.id AND ROW({current}) IS DISTINCT FROM ROW({new})"
+            )
+            return cursor.rowcount
+
+    def write_batches(self, phase: str, batches: Iterator[tuple[pd.DataFrame, dict]]):
+        """
+        Writes batches back while the next ones are prepared, and saves the progress of a phase
+        once each batch is committed.
+
+        Args:
+            phase (str): The phase, title or abstract.
+            batches (Iterator[tuple[pd.DataFrame, dict]]): The batches, with the progress of the
+            phase once they are written.
+        """
+
+        progress = self.progress[phase]
+        # A single writer, so the batches are committed in order
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            pending: tuple[Future, dict] | None = None
+            try:
+                for batch, batch_progress in batches:
+                    future = writer.submit(self.write_batch, batch)
+                    if pending:
+                        self.finish_batch(phase, *pending)
+                    pending = (future, batch_progress)
+                if pending:
+                    self.finish_batch(phase, *pending)
+            finally:
+                # The connection is looked up in the writer thread, it's the one it wrote with
+                writer.submit(lambda: connection.close()).result()
+
+        progress["completed"] = True
+        self.save_progress()
+        print(
+            f"{phase.capitalize()}s reprocessed: {progress['rows']:,} read, "
+            f"{progress['updated']:,} patents updated"
+        )
+
+    def finish_batch(self, phase: str, future: Future, batch_progress: dict):
+        """
+        Waits for a batch to be written and saves the progress it made.
+
+        Args:
+            phase (str): The phase, title or abstract.
+            future (Future): The write of the batch.
+            batch_progress (dict): The progress of the phase once the batch is written.
+        """
+
+        progress = self.progress[phase]
+        updated = future.result()
+        progress.update(batch_progress)
+        progress["updated"] += updated
+        self.save_progress()
+        elapsed = time.perf_counter() - self.start
+        print(
+            f"{progress['rows']:,} {phase}s read, {progress['updated']:,} patents updated "
+            f"({elapsed:.0f}s)"
+        )
+
+    def title_batches(self) -> Iterator[tuple[pd.DataFrame, dict]]:
+        """
+        Streams the titles out of the database in id order, from the last id that was written
+        back, and normalizes them one batch at a time.
+
+        Yields:
+            tuple[pd.DataFrame, dict]: The new values of a batch and the progress once it's written.
+        """
+
+        progress = self.progress["title"]
+        rows = progress["rows"]
+        # The read transaction keeps the server-side cursor open, the batches are written
+        # back on another connection
+        with transaction.atomic():
+            titles = (
+                Patent.objects.filter(id__gt=progress["last_id"])
+                .order_by("id")
+                .values_list("id", "title")
+                .iterator(chunk_size=self.batch_size)
+            )
+            while batch := list(islice(titles, self.batch_size)):
+                batch = pd.DataFrame(batch, columns=["id", "title"])
+                batch["title_word_count_without_processing"] = (
+                    batch["title"].str.split().str.len()
+                ).astype("Int64")
+                batch[["title_word_count_with_processing", "title_processed"]] = (
+                    lemmatize_column(batch["title"])
+                )
+                rows += len(batch)
+                yield batch.drop(columns=["title"]), {
+                    "last_id": int(batch["id"].iloc[-1]),
+                    "rows": rows,
+                }
+
+    def abstract_batches(self, source: str) -> Iterator[tuple[pd.DataFrame, dict]]:
+        """
+        Reads the abstracts from the g_patent table, from the last row that was written back,
+        and normalizes the ones of the patents in the database one batch at a time.
+
+        Args:
+            source (str): The zipped g_patent table.
+
+        Yields:
+            tuple[pd.DataFrame, dict]: The new values of a batch and the progress once it's written.
+        """
+
+        # The patents are looked up by their USPTO id, which isn't indexed in the database, so
+        # the map the uspto command saved is used if it's there
+        path = os.path.join(self.id_map_dir, "patent")
+        if os.path.exists(f"{path}.keys.npy"):
+            id_map = IdMap.load(path)
+        else:
+            id_map = IdMap.from_queryset(
+                Patent.objects.filter(office="US"), "office_patent_id"
+            )
+
+        written = self.progress["abstract"]["rows"]
+        abstracts = pd.read_csv(
+            source,
+            sep="\t",
+            compression="zip",
+            usecols=["patent_id", "patent_abstract"],
+            dtype=str,
+            chunksize=self.batch_size,
+        )
+        for chunk in abstracts:
+            # The index is the row number, so the rows a previous run wrote back are skipped
+            # before they are normalized, even if the batch size changed since
+            chunk = chunk[chunk.index >= written].copy()
+            if chunk.empty:
+                continue
+            rows = int(chunk.index[-1]) + 1
+            chunk["id"] = id_map.map(chunk["patent_id"])
+            chunk = chunk[chunk["id"].notna()].reset_index(drop=True)
+            batch = pd.DataFrame({"id": chunk["id"].to_numpy(dtype=np.int64)})
+            batch["abstract_word_count_without_processing"] = (
+                chunk["patent_abstract"].str.split().str.len()
+            ).astype("Int64")
+            batch[["abstract_word_count_with_processing", "abstract_processed"]] = (
+                lemmatize_column(chunk["patent_abstract"])
+            )
+            yield batch, {"rows": rows}
+
+    def handle(self, *args, **options):
+        if options["batch_size"] <= 0:
+            raise CommandError("--batch-size must be positive.")
+        if options["abstracts"] and not os.path.exists(options["abstracts"]):
+            raise CommandError(f"{options['abstracts']} does not exist.")
+
+        self.batch_size = options["batch_size"]
+        self.id_map_dir = options["id_map_dir"]
+        self.progress = self.load_progress(options["resume"])
+        self.start = time.perf_counter()
+
+        start_pool(options["processes"])
+        try:
+            if self.progress["title"]["completed"]:
+                print("Skipping the titles, a previous run reprocessed them.")
+            else:
+                self.write_batches("title", self.title_batches())
+
+            if not options["abstracts"]:
+                print(
+                    "The abstracts were not reprocessed, pass the g_patent table they were "
+                    "loaded from with --abstracts."
+                )
+            elif self.progress["abstract"]["completed"]:
+                print("Skipping the abstracts, a previous run reprocessed them.")
+            else:
+                self.write_batches(
+                    "abstract", self.abstract_batches(options["abstracts"])
+                )
+        finally:
+            close_pool()
+
+        print(f"Texts reprocessed in {time.perf_counter() - self.start:.0f}s")
@@ -8,13 +8,24 @@ the database.
 ----------------------------------------------------------------------------------------------------
 # How does it work?
 ----------------------------------------------------------------------------------------------------
-It uses pandas to preprocess the data.
+It uses pandas to preprocess the data. The tables are read straight out of the downloaded zips, so
+they are never extracted to disk, unless --parallel-parse is used: then the link tables are
+extracted, so byte ranges of them can be parsed by the process pool at the same time.
 
-For relatively small tables, it uses django's ORM bulk_create method to insert the data into the
-database.
+All the tables are loaded with COPY for performance reasons. Lookup tables (e.g. the CPC and IPC
+hierarchies) are derived from the distinct rows of each chunk and copied once they are complete.
+Larger tables are streamed: the chunks are copied in the background while the next chunk is
+preprocessed, split in shards that are copied over several connections at once (see
+CopyPipeline). The shards commit together, so each table is still loaded all or nothing.
 
-For larger tables, it uses the postgres_copy module to insert the data into the database for 
-performance reasons.
+The link tables (e.g. inventors and citations) are copied into staging tables first, with the
+references that couldn't be mapped left empty. The rows with missing or unknown references are
+deleted with one anti-join per reference and counted by reason, and the rest are inserted into
+their tables, so no chunk is checked against the database while it's preprocessed.
+
+With --sample only the patents whose id hashes into the sampled fraction are loaded, along with
+the rows of the link tables that belong to them (and the US citations between them), so a small
+but consistent database can be built in minutes.
 
 ----------------------------------------------------------------------------------------------------
 # What are those fields and tables, how are they downloaded manually?
@@ -25,64 +36,912 @@ Moreover, one can download the tables manually from the following URL:
 https://patentsview.org/download/data-download-tables
 """
 
+from concurrent.futures import ThreadPoolExecutor, Future
 from datetime import datetime
-import zipfile
+from functools import partial
 import os
+import threading
+import time
+from typing import Iterator
 
-from django.core.management.base import BaseCommand
-from django.db.models import Subquery, OuterRef, Count, IntegerField
-from django.contrib.gis.geos import Point
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Model
 from django.conf import settings
-import requests as r
 import pandas as pd
 import numpy as np
 
 from main.models import *
 from main.management.helpers import *
+from main.management.download_helper import download_file
+from main.management.copy_helper import CopyPipeline, ewkb_points, reserve_ids
+from main.management.id_map import IdMap
+from main.management.bulk_load_helper import BulkLoad
+from main.management.checkpoint_helper import Checkpoint
+from main.management.staging_cache_helper import StagingCache
+from main.management.tsv_helper import extract_table, read_tsv
+from main.management.join_helper import SideTable
+from main.management.validation_helper import validate_staging
+from main.management.memory_helper import MemoryGovernor, parse_size
+from main.management.sample_helper import parse_fraction, sample_mask
+from main.management.telemetry_helper import Telemetry
+from main.management.incremental_helper import (
+    Fingerprints,
+    FINGERPRINT_HASH,
+    FINGERPRINT_PATENT_ID,
+    fingerprint_rows,
+    row_hashes,
+    create_staging_table,
+    copy_ids,
+    upsert_from_staging,
+    replace_from_staging,
+)
 
 # Constant definitions and initial setup
-CHUNK_SIZE = 1000000  # Lower it if you have memory issues
+CHUNK_SIZE = 1000000  # Lower it or use --max-memory if you have memory issues
 DATA_DIRECTORY = f"{settings.BASE_DIR}/main/data"
 ENDPOINT = "https://s3.amazonaws.com/data.patentsview.org/download/"
 CURRENT_YEAR = datetime.now().year
 USPTO_CREATION_YEAR = 1836
+DOWNLOAD_WORKERS = 4
+# How many tables after the one being processed are downloaded in the background, so the
+# downloads don't fill the disk with tables that won't be read for hours
+PREFETCH_TABLES = 2
+PROCESSES = os.cpu_count()
+COPY_CONNECTIONS = os.cpu_count()
+# More than the distinct IPC subgroups, to combine them with patent ids
+IPC_SUBGROUP_CODES = 2**24
+# The stages of the ingestion in the order they run (each one is run by handle_<stage>), with the
+# tables they read and the models they load, in the order they load them.
+STAGES = {
+    "location": (["g_location_disambiguated"], [Location]),
+    "cpc": (["g_cpc_title"], [CPCClass, CPCSubclass, CPCGroup]),
+    "patent": (["g_patent", "g_application", "g_figures"], [Patent]),
+    "patent_cpc_group": (["g_cpc_current"], [PatentCPCGroup]),
+    "ipc": (
+        ["g_ipc_at_issue"],
+        [
+            IPCSection,
+            IPCClass,
+            IPCSubclass,
+            IPCGroup,
+            IPCSubgroup,
+            PatentIPCSubgroup,
+        ],
+    ),
+    "pct": (["g_pct_data"], [PCTData]),
+    "inventor": (["g_inventor_disambiguated"], [Inventor]),
+    "assignee": (["g_assignee_disambiguated"], [Assignee]),
+    "us_patent_citation": (["g_us_patent_citation"], [PatentCitation]),
+    "foreign_citation": (["g_foreign_citation"], [PatentCitation]),
+    "counts": ([], []),
+}
+# The link tables (each row belongs to a patent), with the columns that are read (as strings).
+LINK_TABLES = {
+    "g_cpc_current": ["patent_id", "cpc_group"],
+    "g_ipc_at_issue": [
+        "patent_id",
+        "section",
+        "ipc_class",
+        "subclass",
+        "main_group",
+        "subgroup",
+    ],
+    "g_pct_data": [
+        "patent_id",
+        "published_or_filed_date",
+        "filed_country",
+        "pct_doc_number",
+        "pct_doc_type",
+    ],
+    "g_inventor_disambiguated": [
+        "patent_id",
+        "location_id",
+        "disambig_inventor_name_first",
+        "disambig_inventor_name_last",
+    ],
+    "g_assignee_disambiguated": [
+        "patent_id",
+        "location_id",
+        "disambig_assignee_individual_name_first",
+        "disambig_assignee_individual_name_last",
+        "disambig_assignee_organization",
+    ],
+    "g_us_patent_citation": ["patent_id", "citation_patent_id", "citation_date"],
+    "g_foreign_citation": [
+        "patent_id",
+        "citation_application_id",
+        "citation_date",
+        "citation_country",
+    ],
+}
+# The models whose rows belong to a patent, with the field of the patent. An incremental load
+# replaces the rows of the patents that changed, the other models are upserted.
+PATENT_ROWS = {
+    PatentCPCGroup: "patent",
+    PatentIPCSubgroup: "patent",
+    PCTData: "patent",
+    Inventor: "patent",
+    Assignee: "patent",
+    PatentCitation: "citing_patent",
+}
+# The references of the rows of the link tables, which are validated in their staging tables
+# before they are merged (see validate_staging), with whether rows without one are rejected.
+VALIDATED_REFERENCES = {
+    PatentCPCGroup: {"patent": True, "cpc_group": True},
+    PatentIPCSubgroup: {"patent": True, "ipc_subgroup": True},
+    PCTData: {"patent": True},
+    Inventor: {"patent": True, "location": True},
+    Assignee: {"patent": True, "location": True},
+    # Citations of patents that are not in the database keep their number instead
+    PatentCitation: {"citing_patent": False, "cited_patent": False},
+}
+# The denormalized counts of the patents, with the field of the rows that are counted.
+PATENT_COUNTS = {
+    "cpc_groups_count": PatentCPCGroup._meta.get_field("patent"),
+    "ipc_subgroups_count": PatentIPCSubgroup._meta.get_field("patent"),
+    "assignee_count": Assignee._meta.get_field("patent"),
+    "inventor_count": Inventor._meta.get_field("patent"),
+    "incoming_citations_count": PatentCitation._meta.get_field("cited_patent"),
+    "outgoing_citations_count": PatentCitation._meta.get_field("citing_patent"),
+}
+# The tables in the order they are processed, so they are prefetched in that order too.
+TABLES = [table for tables, _ in STAGES.values() for table in tables]
+# The models whose tables are loaded, see --bulk-load-mode
+LOADED_MODELS = list(
+    dict.fromkeys(model for _, models in STAGES.values() for model in models)
+)
+BULK_LOAD_STATE = f"{DATA_DIRECTORY}/bulk_load.json"
+CHECKPOINT_PATH = f"{DATA_DIRECTORY}/uspto_checkpoint.json"
+ID_MAP_DIRECTORY = f"{DATA_DIRECTORY}/id_maps"
+STAGING_CACHE_DIRECTORY = f"{DATA_DIRECTORY}/staging"
+REPORT_PATH = f"{DATA_DIRECTORY}/uspto_report.json"
+# The patents whose counts an incremental load recomputes, kept in a table so it survives --resume
+AFFECTED_PATENTS_TABLE = "uspto_affected_patents"
 os.makedirs(DATA_DIRECTORY, exist_ok=True)
 
-location_id_map = {}  # Will be used to map USPTO ids,
-# to new generated IDs so relationships can be created.
-
-patent_id_map = {}  # Will be used to map USPTO ids to new generated IDs
-# so relationships can be created.
+# Will be used to map USPTO ids to new generated IDs so relationships can be created.
+location_id_map = IdMap.from_pairs([], [])
+patent_id_map = IdMap.from_pairs([], [])
 
 
 class Command(BaseCommand):
-    help = 'This command downloads all the necessary data from the USPTO and inserts it  \
+    help = (
+        'This command downloads all the necessary data from the USPTO and inserts it  \
         "into the database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--endpoint",
+            default=ENDPOINT,
+            help="The URL the tables are downloaded from (e.g. a local mirror).",
+        )
+        parser.add_argument(
+            "--checksums",
+            default=None,
+            help="A file with the sha256 checksums of the tables in the sha256sum format.",
+        )
+        parser.add_argument(
+            "--download-workers",
+            type=int,
+            default=DOWNLOAD_WORKERS,
+            help="How many tables are downloaded concurrently in the background "
+            "while the data is processed, 0 disables prefetching.",
+        )
+        parser.add_argument(
+            "--mirror-dir",
+            default=None,
+            help="A directory with already downloaded tables (<table>.tsv.zip), "
+            "if given nothing is downloaded.",
+        )
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=PROCESSES,
+            help="The size of the process pool used to preprocess the data "
+            "(defaults to the number of CPUs).",
+        )
+        parser.add_argument(
+            "--copy-connections",
+            type=int,
+            default=COPY_CONNECTIONS,
+            help="How many database connections the big tables are copied over concurrently "
+            "(defaults to the number of CPUs).",
+        )
+        parser.add_argument(
+            "--id-map-dir",
+            default=ID_MAP_DIRECTORY,
+            help="The directory the USPTO to database id maps are saved to, they are "
+            "memory-mapped from there instead of kept in memory and reused by --resume.",
+        )
+        parser.add_argument(
+            "--staging-cache",
+            nargs="?",
+            const=STAGING_CACHE_DIRECTORY,
+            default=None,
+            help="Convert each table to Parquet once per release (in main/data/staging or the "
+            "given directory) and read the tables from there, so loading the same release "
+            "again doesn't parse the TSVs. Needs pyarrow.",
+        )
+        parser.add_argument(
+            "--max-memory",
+            type=parse_size,
+            default=None,
+            help="A memory budget for the command and its workers (e.g. 8G), the tables are "
+            "read in chunks sized by the memory the previous chunks took to stay under it. "
+            "Can't be combined with --staging-cache or --parallel-parse.",
+        )
+        parser.add_argument(
+            "--parallel-parse",
+            action="store_true",
+            help="Extract the link tables (e.g. citations and inventors) to disk and parse them "
+            "in byte ranges with the process pool, instead of with a single pd.read_csv.",
+        )
+        parser.add_argument(
+            "--sample",
+            type=parse_fraction,
+            default=None,
+            help="Load a fraction of the patents (e.g. 1%% or 0.01) and only the rows of the "
+            "other tables that belong to them, for development and benchmark databases. The "
+            "patents are chosen by a hash of their id, so every run loads the same ones.",
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="Skip the stages a previous run completed (see uspto_checkpoint.json in the "
+            "data directory) and roll back and rerun the stage it was in when it stopped.",
+        )
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            help="Load a new release into a database that has a previous one: only the rows "
+            "that were added or changed since are preprocessed and merged, and only the counts "
+            "of the patents they belong to are recomputed.",
+        )
+        parser.add_argument(
+            "--bulk-load-mode",
+            action="store_true",
+            help="Load into unlogged tables without foreign keys, unique constraints and "
+            "secondary indexes, and restore them (in parallel) once everything is loaded.",
+        )
+        parser.add_argument(
+            "--report",
+            default=REPORT_PATH,
+            help="The path of the JSON report with the time, throughput and memory of each stage "
+            "and chunk (defaults to main/data/uspto_report.json).",
+        )
+        parser.add_argument(
+            "--tracemalloc",
+            type=int,
+            default=0,
+            metavar="N",
+            help="Trace the allocations and add the N lines that allocated the most memory in "
+            "each stage to the report, it slows the run down.",
+        )
+        parser.add_argument(
+            "--keep-downloads",
+            action="store_true",
+            help="Keep the downloaded tables, so the data directory can be used as a mirror later.",
+        )
+
+    def load_checksums(self, path: str | None) -> dict:
+        """
+        Reads the expected sha256 checksums of the tables from a file in the sha256sum format.
+
+        Args:
+            path (str | None): The path of the file.
+
+        Returns:
+            dict: The checksums, keyed by file name.
+        """
+
+        if path is None:
+            return {}
+
+        checksums = {}
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    checksum, file_name = line.split()
+                    checksums[os.path.basename(file_name.lstrip("*"))] = checksum
+        return checksums
+
+    def table_path(self, table: str) -> str:
+        """
+        Returns the path of a zipped table, either in the mirror or in the data directory.
+
+        Args:
+            table (str): The name of the table.
+
+        Returns:
+            str: The path of the zipped table.
+        """
+
+        return f"{self.mirror_dir or DATA_DIRECTORY}/{table}.tsv.zip"
+
+    def prefetch_tables(self, workers: int, tables: list[str]):
+        """
+        Starts downloading the first tables in the background, so the network is busy while
+        the handlers process the tables that were already downloaded. The next tables are
+        downloaded as the handlers reach them (see prefetch_after).
+
+        Args:
+            workers (int): How many tables are downloaded concurrently.
+            tables (list[str]): The tables to download, in the order they are processed.
+        """
+
+        self.downloads: dict[str, Future] = {}
+        self.prefetch_order = tables
+        if self.mirror_dir or workers <= 0:
+            return
+
+        self.download_executor = ThreadPoolExecutor(workers, "uspto-download")
+        for table in tables[:PREFETCH_TABLES]:
+            self.downloads[table] = self.download_executor.submit(
+                self.fetch_table, table
+            )
+
+    def prefetch_after(self, table: str):
+        """
+        Starts downloading the tables that are processed after the given one, up to
+        PREFETCH_TABLES of them.
+
+        Args:
+            table (str): The table the handlers are about to process.
+        """
+
+        if not self.download_executor or table not in self.prefetch_order:
+            return
+
+        start = self.prefetch_order.index(table) + 1
+        for next_table in self.prefetch_order[start : start + PREFETCH_TABLES]:
+            if next_table not in self.downloads:
+                self.downloads[next_table] = self.download_executor.submit(
+                    self.fetch_table, next_table
+                )
 
-    def download_and_unzip(self, table: str):
+    def fetch_table(self, table: str) -> str:
         """
-        Downloads and unzips a table from the USPTO endpoint.
+        Downloads a zipped table from the USPTO endpoint.
+        The download is streamed to disk and resumed if it was interrupted.
 
         Args:
             table (str): The name of the table to download.
+
+        Returns:
+            str: The path of the zipped table.
+        """
+
+        return download_file(
+            f"{self.endpoint}{table}.tsv.zip",
+            self.table_path(table),
+            expected_sha256=self.checksums.get(f"{table}.tsv.zip"),
+            cancel=self.download_cancel,
+        )
+
+    def download_table(self, table: str) -> str:
+        """
+        Makes sure a table is available on disk, waiting for its background download if it was
+        prefetched, or reading it from the mirror directory if one is used.
+
+        Args:
+            table (str): The name of the table.
+
+        Raises:
+            CommandError: If the table is not in the mirror directory.
+
+        Returns:
+            str: The path of the zipped table.
+        """
+
+        if self.mirror_dir:
+            if not os.path.exists(self.table_path(table)):
+                raise CommandError(f"{self.table_path(table)} does not exist.")
+            return self.table_path(table)
+
+        self.prefetch_after(table)
+        with self.telemetry.timer("download"):
+            if table in self.downloads:
+                return self.downloads[table].result()
+            return self.fetch_table(table)
+
+    def read_table(self, table: str, **kwargs) -> pd.DataFrame | Iterator[pd.DataFrame]:
+        """
+        Reads a downloaded table (see parse_table) and records its size and the rows and chunks
+        that are read in the telemetry of the stage.
+
+        Args:
+            table (str): The name of the table to read.
+            kwargs: Extra arguments passed to pd.read_csv (e.g. usecols, dtype, chunksize).
+
+        Returns:
+            pd.DataFrame | Iterator[pd.DataFrame]: The table, or an iterator over its chunks if
+            chunksize is given.
+        """
+
+        self.telemetry.table(table, self.table_path(table))
+        if "chunksize" in kwargs:
+            return self.telemetry.chunks(table, self.parse_table(table, **kwargs))
+        df = self.parse_table(table, **kwargs)
+        self.telemetry.rows(table, len(df))
+        return df
+
+    def parse_table(
+        self, table: str, **kwargs
+    ) -> pd.DataFrame | Iterator[pd.DataFrame]:
+        """
+        Reads a downloaded table straight out of its zip, without extracting it to disk, or out
+        of the staging cache if one is used (see StagingCache). With --parallel-parse the link
+        tables are extracted and their chunks are parsed and transformed in parallel (see
+        read_tsv), each chunk is a byte range of the table so its size is not chunksize. With
+        --max-memory (which can't be combined with either) chunksize is only the size of the
+        first chunk, the next ones are sized by the memory budget (see MemoryGovernor).
+
+        Args:
+            table (str): The name of the table to read.
+            kwargs: Extra arguments passed to pd.read_csv (e.g. usecols, dtype, chunksize), and
+            a transform that is applied to each chunk (a picklable function, see read_tsv).
+
+        Returns:
+            pd.DataFrame | Iterator[pd.DataFrame]: The table, or an iterator over its chunks if
+            chunksize is given.
+        """
+
+        transform = kwargs.pop("transform", None)
+        if self.staging_cache:
+            chunks = self.staging_cache.read(self.table_path(table), **kwargs)
+        elif self.parallel_parse and table in LINK_TABLES and "chunksize" in kwargs:
+            path = extract_table(self.table_path(table), self.extracted_path(table))
+            # The transform runs in the workers, with the parsing
+            return read_tsv(path, transform=transform, **kwargs)
+        elif self.memory_governor and "chunksize" in kwargs:
+            chunksize = kwargs.pop("chunksize")
+            reader = pd.read_csv(
+                self.table_path(table),
+                sep="\t",
+                compression="zip",
+                iterator=True,
+                **kwargs,
+            )
+            chunks = self.memory_governor.chunks(table, reader, chunksize)
+        else:
+            chunks = pd.read_csv(
+                self.table_path(table), sep="\t", compression="zip", **kwargs
+            )
+        return map(transform, chunks) if transform else chunks
+
+    def sampled(
+        self, chunks: Iterator[pd.DataFrame], column: str = "patent_id"
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Keeps the rows of the patents in the sample of a sampled load (see --sample).
+
+        Args:
+            chunks (Iterator[pd.DataFrame]): The chunks of a table.
+            column (str, optional): The column with the PatentsView id of the patent of each
+            row. Defaults to "patent_id".
+
+        Yields:
+            pd.DataFrame: The rows of the chunks whose patents are sampled.
+        """
+
+        for chunk in chunks:
+            if self.sample:
+                chunk = chunk[sample_mask(chunk[column], self.sample)]
+            yield chunk
+
+    def extracted_path(self, table: str) -> str:
+        """
+        Returns the path a table is extracted to by --parallel-parse.
+
+        Args:
+            table (str): The name of the table.
+
+        Returns:
+            str: The path of the extracted TSV.
+        """
+
+        return f"{DATA_DIRECTORY}/{table}.tsv"
+
+    def remove_table(self, table: str):
+        """
+        Removes a downloaded table from the disk, tables of the mirror directory are kept.
+        The extracted TSV of the table is always removed.
+
+        Args:
+            table (str): The name of the table to remove.
+        """
+
+        if os.path.exists(self.extracted_path(table)):
+            os.remove(self.extracted_path(table))
+        if not self.mirror_dir and not self.keep_downloads:
+            os.remove(self.table_path(table))
+
+    def parse_dates(self, dates: pd.Series) -> pd.Series:
+        """
+        Parses a column of dates in the YYYY-MM-DD format in one vectorized pass.
+
+        Args:
+            dates (pd.Series): The dates as strings.
+
+        Returns:
+            pd.Series: The parsed dates, invalid or missing dates are NaT.
+        """
+
+        well_formed = dates.str.fullmatch(r"\d{4}-\d{2}-\d{2}", na=False)
+        return pd.to_datetime(
+            dates.where(well_formed), format="%Y-%m-%d", errors="coerce"
+        )
+
+    def store_id_map(self, name: str, id_map: IdMap) -> IdMap:
+        """
+        Saves an id map to the id map directory and memory-maps it back so it doesn't take up
+        memory and can be reused by later stages and resumed runs.
+
+        Args:
+            name (str): The name of the map (e.g. patent).
+            id_map (IdMap): The map.
+
+        Returns:
+            IdMap: The memory-mapped map.
+        """
+
+        print(
+            f"{name.capitalize()} id map: {len(id_map)} ids, {id_map.nbytes / 2**20:.1f} MiB"
+        )
+        return id_map.save(os.path.join(self.id_map_dir, name))
+
+    def restore_stage(self, stage: str):
+        """
+        Rebuilds the state a stage completed by a previous run left in memory, which is the id
+        maps of the location and patent stages.
+
+        Args:
+            stage (str): The name of the stage.
+
+        Raises:
+            CommandError: If the location id map wasn't saved.
+        """
+
+        global location_id_map, patent_id_map
+
+        if stage == "location":
+            path = os.path.join(self.id_map_dir, "location")
+            if not os.path.exists(f"{path}.keys.npy"):
+                raise CommandError(
+                    f"The location id map is not in {self.id_map_dir}, so the run can't be "
+                    "resumed or load incrementally (the USPTO location ids are not in the "
+                    "database)."
+                )
+            location_id_map = IdMap.load(path)
+        elif stage == "patent":
+            path = os.path.join(self.id_map_dir, "patent")
+            if os.path.exists(f"{path}.keys.npy"):
+                patent_id_map = IdMap.load(path)
+            else:
+                patent_id_map = self.store_id_map(
+                    "patent",
+                    IdMap.from_queryset(
+                        Patent.objects.filter(office="US"), "office_patent_id"
+                    ),
+                )
+
+    def model_stages(self, model: type[Model]) -> list[str]:
+        """
+        Returns the stages that load a model, in the order they run.
+
+        Args:
+            model (type[Model]): The model.
+
+        Returns:
+            list[str]: The stages.
+        """
+
+        return [stage for stage, (_, models) in STAGES.items() if model in models]
+
+    def fingerprint_path(self, table: str) -> str:
+        """
+        Returns the path the fingerprints of a table are saved to, next to the id maps.
+
+        Args:
+            table (str): The name of the table.
+
+        Returns:
+            str: The path of the fingerprints.
+        """
+
+        return os.path.join(self.id_map_dir, "fingerprints", f"{table}.npy")
+
+    def pipeline(self, model: type[Model], **kwargs) -> CopyPipeline:
+        """
+        Returns a pipeline that copies into the table of a model or, for the link tables and in
+        an incremental load, into a staging table that is validated and merged into it once the
+        stage is done (see merge_stage).
+
+        Args:
+            model (type[Model]): The model.
+            kwargs: Extra arguments passed to CopyPipeline (e.g. connections).
+
+        Returns:
+            CopyPipeline: The pipeline.
+        """
+
+        if not self.incremental and model not in VALIDATED_REFERENCES:
+            pipeline = CopyPipeline(model, **kwargs)
+            self.telemetry.add_pipeline(pipeline)
+            return pipeline
+
+        if model not in self.staging:
+            with connection.cursor() as cursor:
+                staging_table = create_staging_table(
+                    cursor, model, list(VALIDATED_REFERENCES.get(model, []))
+                )
+                self.staging[model] = (staging_table, [])
+        staging_table, pipelines = self.staging[model]
+        pipelines.append(CopyPipeline(model, table=staging_table, **kwargs))
+        self.telemetry.add_pipeline(pipelines[-1])
+        return pipelines[-1]
+
+    def read_links(self, table: str, model: type[Model]):
+        """
+        Reads the chunks of a link table as strings and fingerprints the rows of each patent.
+        In an incremental load only the rows of the patents that changed are returned.
+
+        Args:
+            table (str): The name of the table, one of LINK_TABLES.
+            model (type[Model]): The model the table is loaded into.
+
+        Yields:
+            pd.DataFrame: The chunks.
+        """
+
+        if self.incremental:
+            changed = self.changed_patents(model)
+        else:
+            self.fingerprints[table] = Fingerprints()
+
+        for chunk, patent_ids, hashes in self.read_fingerprinted(table):
+            if not self.incremental:
+                self.fingerprints[table].add(patent_ids, hashes)
+                yield chunk
+                continue
+
+            selected = patent_ids.notna().to_numpy()
+            selected[selected] = np.isin(
+                patent_ids[selected].to_numpy(dtype=np.int64), changed
+            )
+            yield chunk[selected]
+
+    def read_fingerprinted(
+        self, table: str
+    ) -> Iterator[tuple[pd.DataFrame, pd.Series, np.ndarray]]:
+        """
+        Reads the chunks of a link table as strings, with the database id of the patent and the
+        hash of each row. With --parallel-parse they are computed by the workers that parse the
+        chunks (see fingerprint_rows).
+
+        Args:
+            table (str): The name of the table, one of LINK_TABLES.
+
+        Yields:
+            tuple[pd.DataFrame, pd.Series, np.ndarray]: The rows of each chunk (only the sampled
+            ones in a sampled load), their patent ids and their hashes.
+        """
+
+        chunks = self.read_table(
+            table,
+            usecols=LINK_TABLES[table],
+            dtype=str,
+            chunksize=CHUNK_SIZE,
+            transform=partial(
+                fingerprint_rows,
+                patent_id_map_path=os.path.join(self.id_map_dir, "patent"),
+            ),
+        )
+        for chunk in self.sampled(chunks):
+            patent_ids = chunk.pop(FINGERPRINT_PATENT_ID)
+            hashes = chunk.pop(FINGERPRINT_HASH).to_numpy(dtype=np.uint64)
+            yield chunk, patent_ids, hashes
+
+    def changed_patents(self, model: type[Model]) -> np.ndarray:
+        """
+        Finds the patents whose rows in a model changed since the last load, by fingerprinting
+        the rows of every table that is loaded into the model and comparing the fingerprints
+        with the saved ones. The rows of those patents are replaced together, so the tables are
+        compared at once even when they are loaded by different stages (e.g. the citations).
+
+        Args:
+            model (type[Model]): The model.
+
+        Returns:
+            np.ndarray: The sorted database ids of the patents.
+        """
+
+        if model in self.changed:
+            return self.changed[model]
+
+        tables = [
+            table
+            for stage in self.model_stages(model)
+            for table in STAGES[stage][0]
+            if table in LINK_TABLES
+        ]
+        changed = [np.empty(0, dtype=np.int64)]
+        for table in tables:
+            self.download_table(table)
+            fingerprints = Fingerprints()
+            for _, patent_ids, hashes in self.read_fingerprinted(table):
+                fingerprints.add(patent_ids, hashes)
+            self.fingerprints[table] = fingerprints
+            changed.append(
+                fingerprints.changed(Fingerprints.load(self.fingerprint_path(table)))
+            )
+
+        self.changed[model] = np.unique(np.concatenate(changed))
+        print(
+            f"{len(self.changed[model])} patents have changed rows in {', '.join(tables)}"
+        )
+        return self.changed[model]
+
+    def merge_stage(self, stage: str):
+        """
+        Merges the staging tables of a stage into the tables of their models, in a single
+        transaction. The rows with invalid references are deleted first and counted by reason.
+        The rows of the link tables replace the rows of the patents that changed in an
+        incremental load (and are just inserted otherwise), the rows of the other tables are
+        upserted. The patents whose counts change are recorded, so only their counts are
+        recomputed.
+
+        Args:
+            stage (str): The name of the stage.
+        """
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            for model in STAGES[stage][1]:
+                if model not in self.staging:
+                    continue
+                staging_table, pipelines = self.staging.pop(model)
+                columns = list(
+                    dict.fromkeys(
+                        column for pipeline in pipelines for column in pipeline.columns
+                    )
+                )
+
+                if model in VALIDATED_REFERENCES:
+                    rejected = validate_staging(
+                        cursor, model, staging_table, VALIDATED_REFERENCES[model]
+                    )
+                    for reason, count in rejected.items():
+                        if count:
+                            print(f"{model.__name__}: {count} rows rejected ({reason})")
+
+                if model in PATENT_ROWS:
+                    patent_column = model._meta.get_field(PATENT_ROWS[model]).column
+                    changed_table = None
+                    # The first stage that loads the model deletes the rows of the patents, the
+                    # next ones only add theirs
+                    if self.incremental and self.model_stages(model)[0] == stage:
+                        changed_table = f"{model._meta.db_table}_changed"
+                        copy_ids(cursor, changed_table, self.changed[model])
+                    if self.incremental:
+                        self.add_affected_patents(
+                            cursor, model, staging_table, patent_column, changed_table
+                        )
+                    deleted, inserted = replace_from_staging(
+                        cursor, model, staging_table, patent_column, changed_table
+                    )
+                    print(
+                        f"{model.__name__}: {deleted} rows deleted and {inserted} inserted"
+                    )
+                else:
+                    merged = upsert_from_staging(cursor, model, staging_table, columns)
+                    print(f"{model.__name__}: {merged} rows inserted or updated")
+
+                cursor.execute(f'DROP TABLE "{staging_table}"')
+
+    def add_affected_patents(
+        self,
+        cursor,
+        model: type[Model],
+        staging_table: str,
+        patent_column: str,
+        changed_table: str | None,
+    ):
+        """
+        Records the patents counted by the rows of a model that are replaced, both the rows that
+        are deleted and the ones that are inserted.
+
+        Args:
+            cursor: The database cursor to use.
+            model (type[Model]): The model.
+            staging_table (str): The staging table with the rows that are inserted.
+            patent_column (str): The column of the model with the patent of each row.
+            changed_table (str | None): The table with the patents whose rows are deleted.
+        """
+
+        table = model._meta.db_table
+        for field in PATENT_COUNTS.values():
+            if field.model is not model:
+                continue
+            cursor.execute(
+                f'INSERT INTO "{AFFECTED_PATENTS_TABLE}" (id) '
+                f'SELECT DISTINCT "{field.column}" FROM "{staging_table}" '
+                f'WHERE "{field.column}" IS NOT NULL ON CONFLICT DO NOTHING'
+            )
+            if changed_table is not None:
+                cursor.execute(
+                    f'INSERT INTO "{AFFECTED_PATENTS_TABLE}" (id) '
+                    f'SELECT DISTINCT "{field.column}" FROM "{table}" '
+                    f'WHERE "{patent_column}" IN (SELECT id FROM "{changed_table}") '
+                    f'AND "{field.column}" IS NOT NULL ON CONFLICT DO NOTHING'
+                )
+
+    def save_fingerprints(self, stage: str):
+        """
+        Saves the fingerprints of the tables of the models whose last stage this is. They are
+        only saved once all the rows of a model were merged, so a stage that is run again by
+        --resume finds the same changes.
+
+        Args:
+            stage (str): The name of the stage that was completed.
         """
 
-        res = r.get(f"{ENDPOINT}{table}.tsv.zip")
-        with open(f"{DATA_DIRECTORY}/{table}.tsv.zip", "wb") as f:
-            f.write(res.content)
+        for model in STAGES[stage][1]:
+            if self.model_stages(model)[-1] != stage:
+                continue
+            for model_stage in self.model_stages(model):
+                for table in STAGES[model_stage][0]:
+                    if table in self.fingerprints:
+                        self.fingerprints.pop(table).save(self.fingerprint_path(table))
+
+    def add_levels(
+        self,
+        parts: dict[str, list[pd.DataFrame]],
+        chunk: pd.DataFrame,
+        levels: dict[str, list[str]],
+    ):
+        """
+        Adds the distinct rows of each level of a hierarchy (e.g. the CPC classes and subclasses)
+        in a chunk to the parts of the levels.
 
-        with zipfile.ZipFile(f"{DATA_DIRECTORY}/{table}.tsv.zip", "r") as z:
-            z.extractall(DATA_DIRECTORY)
-        os.remove(f"{DATA_DIRECTORY}/{table}.tsv.zip")
+        Args:
+            parts (dict[str, list[pd.DataFrame]]): The parts of each level found so far.
+            chunk (pd.DataFrame): The chunk.
+            levels (dict[str, list[str]]): The columns of each level, the first is the key.
+        """
+
+        for level, columns in levels.items():
+            parts[level].append(chunk[columns].drop_duplicates(subset=columns[0]))
+
+    def merge_levels(
+        self, parts: dict[str, list[pd.DataFrame]], levels: dict[str, list[str]]
+    ) -> dict[str, pd.DataFrame]:
+        """
+        Merges the parts of each level of a hierarchy, keeping the first row of each key.
+
+        Args:
+            parts (dict[str, list[pd.DataFrame]]): The parts of each level.
+            levels (dict[str, list[str]]): The columns of each level, the first is the key.
+
+        Returns:
+            dict[str, pd.DataFrame]: The rows of each level.
+        """
+
+        return {
+            level: pd.concat(parts[level]).drop_duplicates(
+                subset=columns[0], ignore_index=True
+            )
+            for level, columns in levels.items()
+        }
 
     def handle_location(self):
         global location_id_map
 
-        self.download_and_unzip("g_location_disambiguated")
+        self.download_table("g_location_disambiguated")
 
-        locations = pd.read_csv(
-            f"{DATA_DIRECTORY}/g_location_disambiguated.tsv",
-            sep="\t",
+        locations = self.read_table(
+            "g_location_disambiguated",
             usecols=[
                 "location_id",
                 "disambig_country",
@@ -114,86 +973,94 @@ class Command(BaseCommand):
             inplace=True,
         )
 
-        location_old_ids = locations["location_id"].copy()
-        locations.drop(columns=["location_id"], inplace=True)
+        location_old_ids = locations.pop("location_id")
 
-        locations["point"] = locations.apply(
-            lambda x: Point(x["longitude"], x["latitude"]), axis=1
+        # The points are encoded as EWKB, which PostGIS takes as is
+        locations["point"] = ewkb_points(
+            locations.pop("longitude"),
+            locations.pop("latitude"),
+            Location._meta.get_field("point").srid,
         )
-        locations.drop(columns=["longitude", "latitude"], inplace=True)
-        locations = locations.astype(object).replace(np.nan, None).to_dict("records")
 
-        locations = [Location(**location) for location in locations]
-        Location.objects.bulk_create(locations)
+        # The ids are taken before copying, so the id map doesn't have to be read back.
+        # Locations of a previous load keep their ids, so they are updated instead.
+        location_ids = location_id_map.map(location_old_ids)
+        new = location_ids.isna().to_numpy()
+        with connection.cursor() as cursor:
+            location_ids[new] = reserve_ids(cursor, Location, new.sum())
+        locations["id"] = location_ids.to_numpy(dtype=np.int64)
+
+        # An incremental load merges the locations later, so the map is saved first and a
+        # stage that is run again finds the same ids
+        location_id_map = self.store_id_map(
+            "location",
+            location_id_map.update(location_old_ids[new], locations["id"][new]),
+        )
 
-        for i in range(len(location_old_ids)):
-            location_id_map[location_old_ids[i]] = locations[i].id
+        with self.pipeline(Location) as pipeline:
+            pipeline.put(locations)
 
-        os.remove(f"{DATA_DIRECTORY}/g_location_disambiguated.tsv")
+        self.remove_table("g_location_disambiguated")
         print("Location table inserted successfully!")
 
     def handle_cpc(self):
-        self.download_and_unzip("g_cpc_title")
-        cpcs = pd.read_csv(f"{DATA_DIRECTORY}/g_cpc_title.tsv", sep="\t")
+        self.download_table("g_cpc_title")
+        cpcs = self.read_table("g_cpc_title", dtype=str, chunksize=CHUNK_SIZE)
+
+        # Each row is a group, so classes and subclasses repeat for each of their groups
+        levels = {
+            "classes": ["cpc_class", "cpc_class_title"],
+            "subclasses": ["cpc_subclass", "cpc_class", "cpc_subclass_title"],
+            "groups": ["cpc_group", "cpc_subclass", "cpc_group_title"],
+        }
+        parts = {level: [] for level in levels}
+        for cpc_chunk in cpcs:
+            self.add_levels(parts, cpc_chunk, levels)
+        levels = self.merge_levels(parts, levels)
 
         # Create CPCClasses
-        cpc_classes = cpcs.groupby("cpc_class", as_index=False)[
-            ["cpc_class_title"]
-        ].first()
-        cpc_classes["section_id"] = cpc_classes["cpc_class"].str[0]
-        cpc_classes = cpc_classes.rename(
+        cpc_classes = levels["classes"].rename(
             columns={"cpc_class": "_class", "cpc_class_title": "title"}
         )
-        cpc_classes = [
-            CPCClass(**cpc_class) for cpc_class in cpc_classes.to_dict("records")
-        ]
-        CPCClass.objects.bulk_create(cpc_classes)
+        cpc_classes["section_id"] = cpc_classes["_class"].str[0]
+        with self.pipeline(CPCClass) as pipeline:
+            pipeline.put(cpc_classes)
 
         # Create CPCSubclasses
-        cpc_subclasses = cpcs.groupby("cpc_subclass", as_index=False)[
-            ["cpc_class", "cpc_subclass_title"]
-        ].first()
-        cpc_subclasses = cpc_subclasses.rename(
+        cpc_subclasses = levels["subclasses"].rename(
             columns={
                 "cpc_class": "_class_id",
                 "cpc_subclass": "subclass",
                 "cpc_subclass_title": "title",
             }
         )
-        cpc_subclasses = [
-            CPCSubclass(**cpc_subclass)
-            for cpc_subclass in cpc_subclasses.to_dict("records")
-        ]
-        CPCSubclass.objects.bulk_create(cpc_subclasses)
+        with self.pipeline(CPCSubclass) as pipeline:
+            pipeline.put(cpc_subclasses)
 
         # Create CPCGroups
-        cpc_groups = cpcs[["cpc_group", "cpc_subclass", "cpc_group_title"]]
-        cpc_groups = cpc_groups.rename(
+        cpc_groups = levels["groups"].rename(
             columns={
                 "cpc_group": "group",
                 "cpc_subclass": "subclass_id",
                 "cpc_group_title": "title",
             }
         )
-        cpc_groups = [
-            CPCGroup(**cpc_group) for cpc_group in cpc_groups.to_dict("records")
-        ]
-        CPCGroup.objects.bulk_create(cpc_groups)
+        with self.pipeline(CPCGroup) as pipeline:
+            pipeline.put(cpc_groups)
 
-        os.remove(f"{DATA_DIRECTORY}/g_cpc_title.tsv")
+        self.remove_table("g_cpc_title")
         print("CPC tables inserted successfully!")
 
     def handle_patent(self):
         global patent_id_map
 
-        self.download_and_unzip("g_patent")
-        self.download_and_unzip("g_application")
-        self.download_and_unzip("g_figures")
+        self.download_table("g_patent")
+        self.download_table("g_application")
+        self.download_table("g_figures")
 
         # Preprocess data
-        patents = pd.read_csv(
-            f"{DATA_DIRECTORY}/g_patent.tsv",
-            sep="\t",
+        patents = self.read_table(
+            "g_patent",
             usecols=lambda col: col not in ["wipo_kind", "filename"],
             dtype={
                 "patent_id": str,
@@ -208,674 +1075,627 @@ class Command(BaseCommand):
             chunksize=CHUNK_SIZE / 50,
         )
 
-        application = pd.read_csv(
-            f"{DATA_DIRECTORY}/g_application.tsv",
-            sep="\t",
-            usecols=["patent_id", "filing_date"],
-            dtype={"patent_id": str, "filing_date": str},
+        # Indexed once by patent id, so each chunk is joined with a lookup instead of a merge
+        application = SideTable(
+            self.sampled(
+                self.read_table(
+                    "g_application",
+                    usecols=["patent_id", "filing_date"],
+                    dtype={"patent_id": str, "filing_date": str},
+                    chunksize=CHUNK_SIZE,
+                )
+            ),
+            "patent_id",
         )
 
-        figures = pd.read_csv(
-            f"{DATA_DIRECTORY}/g_figures.tsv",
-            sep="\t",
-            usecols=["patent_id", "num_figures", "num_sheets"],
-            dtype={"patent_id": str, "num_figures": "Int64", "num_sheets": "Int64"},
+        figures = SideTable(
+            self.sampled(
+                self.read_table(
+                    "g_figures",
+                    usecols=["patent_id", "num_figures", "num_sheets"],
+                    dtype={
+                        "patent_id": str,
+                        "num_figures": "Int64",
+                        "num_sheets": "Int64",
+                    },
+                    chunksize=CHUNK_SIZE,
+                )
+            ),
+            "patent_id",
         )
 
-        for i, patent_chunk in enumerate(patents):
-            patent_chunk = pd.merge(
-                patent_chunk, application, on="patent_id", how="left"
-            )
-
-            patent_chunk = pd.merge(patent_chunk, figures, on="patent_id", how="left")
-
-            patent_chunk = patent_chunk.astype(object).replace(np.nan, None)
-            patent_chunk = patent_chunk.rename(
-                columns={
-                    "patent_id": "office_patent_id",
-                    "patent_type": "type",
-                    "patent_date": "granted_date",
-                    "num_sheets": "sheets_count",
-                    "filing_date": "application_filed_date",
-                    "patent_title": "title",
-                    "patent_abstract": "abstract_processed",
-                    "num_figures": "figures_count",
-                    "num_claims": "claims_count",
-                }
-            )
-
-            # Drop invalid patents
-            patent_chunk.drop(
-                patent_chunk[
-                    (patent_chunk["granted_date"].astype(bool) == False)
-                    | (patent_chunk["application_filed_date"].astype(bool) == False)
-                ].index,
-                inplace=True,
-            )
-
-            patent_chunk.drop(
-                patent_chunk[
-                    ~(
-                        patent_chunk["application_filed_date"].str.contains(
-                            "^\d{4}-\d{2}-\d{2}$"
-                        )
-                    )
-                    | ~(
-                        patent_chunk["granted_date"].str.contains("^\d{4}-\d{2}-\d{2}$")
-                    )
-                ].index,
-                inplace=True,
-            )
-
-            patent_chunk["office"] = "US"
-
-            # Precalculate fields
-            patent_chunk["granted_year"] = (
-                patent_chunk["granted_date"].str[:4].astype("Int64")
-            )
-            patent_chunk["application_year"] = (
-                patent_chunk["application_filed_date"].str[:4].astype("Int64")
-            )
+        # The patents are fingerprinted as they are read, so an incremental load only
+        # preprocesses the new ones and the ones that changed since the last load
+        if self.incremental:
+            fingerprints = Fingerprints.load(self.fingerprint_path("g_patent"))
+        else:
+            fingerprints = Fingerprints()
+        self.fingerprints["g_patent"] = fingerprints
+        new_office_ids, new_ids = [], []
+
+        # The patents dropped for their dates are never given ids, so their row hashes are kept
+        # by USPTO id, otherwise every incremental load would take them for changed patents
+        rejected_path = os.path.join(self.id_map_dir, "rejected_patent")
+        if self.incremental and os.path.exists(f"{rejected_path}.keys.npy"):
+            rejected = IdMap.load(rejected_path)
+        else:
+            rejected = IdMap.from_pairs([], [])
+        rejected_office_ids, rejected_hashes = [], []
+
+        with self.pipeline(Patent, connections=self.copy_connections) as pipeline:
+            for patent_chunk in self.sampled(patents):
+                patent_chunk = figures.join(application.join(patent_chunk))
+
+                hashes = row_hashes(patent_chunk)
+                ids = patent_id_map.map(patent_chunk["patent_id"])
+                changed = ids.isna().to_numpy() | (
+                    fingerprints.get(ids.fillna(0).to_numpy(dtype=np.int64)) != hashes
+                )
+                rejected_hash = rejected.map(patent_chunk["patent_id"])
+                unchanged = ids.isna() & (rejected_hash == hashes.view(np.int64))
+                changed &= ~unchanged.fillna(False).to_numpy(dtype=bool)
+                patent_chunk, ids, hashes = (
+                    patent_chunk[changed],
+                    ids[changed],
+                    hashes[changed],
+                )
+                if patent_chunk.empty:
+                    continue
+
+                patent_chunk = patent_chunk.astype(object).replace(np.nan, None)
+                patent_chunk = patent_chunk.rename(
+                    columns={
+                        "patent_id": "office_patent_id",
+                        "patent_type": "type",
+                        "patent_date": "granted_date",
+                        "num_sheets": "sheets_count",
+                        "filing_date": "application_filed_date",
+                        "patent_title": "title",
+                        "patent_abstract": "abstract_processed",
+                        "num_figures": "figures_count",
+                        "num_claims": "claims_count",
+                    }
+                )
 
-            # Remove patents with invalid years
-            patent_chunk.drop(
-                patent_chunk[
-                    (
-                        ~patent_chunk["granted_year"].between(
-                            USPTO_CREATION_YEAR, CURRENT_YEAR
-                        )
-                    )
-                    | (
-                        ~patent_chunk["application_year"].between(
-                            USPTO_CREATION_YEAR, CURRENT_YEAR
-                        )
-                    )
-                ].index,
-                inplace=True,
-            )
+                # Parse the dates column-wise, missing or malformed dates (e.g. 2000-02-30) become NaT
+                granted_date = self.parse_dates(patent_chunk["granted_date"])
+                application_filed_date = self.parse_dates(
+                    patent_chunk["application_filed_date"]
+                )
 
-            patent_chunk["years_to_get_granted"] = (
-                np.array(
-                    multiprocessing_apply(
-                        patent_chunk["granted_date"], string_to_timestamp
-                    )
+                # Drop patents with invalid dates or years
+                valid = granted_date.dt.year.between(
+                    USPTO_CREATION_YEAR, CURRENT_YEAR
+                ) & application_filed_date.dt.year.between(
+                    USPTO_CREATION_YEAR, CURRENT_YEAR
                 )
-                - np.array(
-                    multiprocessing_apply(
-                        patent_chunk["application_filed_date"], string_to_timestamp
-                    )
+                rejected_office_ids.append(patent_chunk["office_patent_id"][~valid])
+                rejected_hashes.append(hashes[~valid.to_numpy()].view(np.int64))
+                patent_chunk = patent_chunk[valid].copy()
+                granted_date = granted_date[valid]
+                application_filed_date = application_filed_date[valid]
+                ids, hashes = ids[valid], hashes[valid.to_numpy()]
+                if patent_chunk.empty:
+                    continue
+
+                # The ids are taken before copying, so the id map doesn't have to be read back
+                new = ids.isna().to_numpy()
+                with connection.cursor() as cursor:
+                    ids[new] = reserve_ids(cursor, Patent, new.sum())
+                patent_chunk["id"] = ids.to_numpy(dtype=np.int64)
+                new_office_ids.append(patent_chunk["office_patent_id"][new])
+                new_ids.append(patent_chunk["id"][new])
+                fingerprints.set(patent_chunk["id"].to_numpy(), hashes)
+
+                patent_chunk["office"] = "US"
+
+                # Precalculate fields
+                patent_chunk["granted_year"] = granted_date.dt.year.astype("Int64")
+                patent_chunk["application_year"] = (
+                    application_filed_date.dt.year.astype("Int64")
                 )
-            ) / 31536000.0  # 365 * 24 * 60 * 60 seconds in a year
-            patent_chunk["title_word_count_without_processing"] = (
-                patent_chunk["title"].str.split().str.len()
-            ).astype("Int64")
-            patent_chunk["abstract_word_count_without_processing"] = (
-                patent_chunk["abstract_processed"].str.split().str.len()
-            ).astype("Int64")
-            patent_chunk[
-                ["title_word_count_with_processing", "title_processed"]
-            ] = multiprocessing_apply(patent_chunk["title"], lemma_text)
-            patent_chunk[
-                ["abstract_word_count_with_processing", "abstract_processed"]
-            ] = multiprocessing_apply(patent_chunk["abstract_processed"], lemma_text)
-
-            patent_chunk.to_csv(
-                f"{DATA_DIRECTORY}/g_patent_preprocessed.csv",
-                index=False,
-                header=i == 0,
-                mode="a",
-            )
-
-        # Load data
-        Patent.objects.from_csv(f"{DATA_DIRECTORY}/g_patent_preprocessed.csv")
-        patent_id_map = dict(
-            Patent.objects.filter(office="US").values_list("office_patent_id", "id")
+                patent_chunk["years_to_get_granted"] = (
+                    granted_date - application_filed_date
+                ).dt.total_seconds() / 31536000.0  # 365 * 24 * 60 * 60 seconds in a year
+                patent_chunk["title_word_count_without_processing"] = (
+                    patent_chunk["title"].str.split().str.len()
+                ).astype("Int64")
+                patent_chunk["abstract_word_count_without_processing"] = (
+                    patent_chunk["abstract_processed"].str.split().str.len()
+                ).astype("Int64")
+                with self.telemetry.timer("lemmatize"):
+                    patent_chunk[
+                        ["title_word_count_with_processing", "title_processed"]
+                    ] = lemmatize_column(patent_chunk["title"])
+                    patent_chunk[
+                        ["abstract_word_count_with_processing", "abstract_processed"]
+                    ] = lemmatize_column(patent_chunk["abstract_processed"])
+
+                pipeline.put(patent_chunk)
+
+        # Saved before an incremental load merges the patents, like the location id map
+        patent_id_map = self.store_id_map(
+            "patent",
+            patent_id_map.update(
+                pd.concat([pd.Series(dtype=object), *new_office_ids]),
+                pd.concat([pd.Series(dtype=np.int64), *new_ids]),
+            ),
         )
-
-        os.remove(f"{DATA_DIRECTORY}/g_patent_preprocessed.csv")
-        os.remove(f"{DATA_DIRECTORY}/g_patent.tsv")
-        os.remove(f"{DATA_DIRECTORY}/g_application.tsv")
-        os.remove(f"{DATA_DIRECTORY}/g_figures.tsv")
+        rejected.update(
+            pd.concat([pd.Series(dtype=object), *rejected_office_ids]),
+            np.concatenate([np.empty(0, dtype=np.int64), *rejected_hashes]),
+        ).save(rejected_path)
+
+        self.remove_table("g_patent")
+        self.remove_table("g_application")
+        self.remove_table("g_figures")
         print("Patent table inserted successfully!")
 
     def handle_patent_cpc_group(self):
-        self.download_and_unzip("g_cpc_current")
-
-        # Preprocess data
-        valid_cpcs = CPCGroup.objects.values_list("group", flat=True)
-
-        patent_cpc_groups = pd.read_csv(
-            f"{DATA_DIRECTORY}/g_cpc_current.tsv",
-            sep="\t",
-            usecols=["patent_id", "cpc_group"],
-            dtype={"patent_id": "str", "cpc_group": str},
-            chunksize=CHUNK_SIZE,
-        )
-
-        for i, patent_cpc_groups_chunk in enumerate(patent_cpc_groups):
-            patent_cpc_groups_chunk = patent_cpc_groups_chunk.rename(
-                columns={"cpc_group": "cpc_group_id"}
-            )
-            patent_cpc_groups_chunk["patent_id"] = (
-                patent_cpc_groups_chunk["patent_id"].map(patent_id_map).astype("Int64")
-            )
-
-            # Some CPC groups might have invalid patent ids, so we need to remove them
-            patent_cpc_groups_chunk = patent_cpc_groups_chunk[
-                patent_cpc_groups_chunk["patent_id"].notna()
-            ]
-
-            # About 800 patents have invalid CPC groups, so we need to ignore them
-            patent_cpc_groups_chunk = patent_cpc_groups_chunk[
-                patent_cpc_groups_chunk["cpc_group_id"].isin(valid_cpcs)
-            ]
-
-            patent_cpc_groups_chunk.to_csv(
-                f"{DATA_DIRECTORY}/g_cpc_current_preprocessed.csv",
-                index=False,
-                header=i == 0,
-                mode="a",
-            )
+        self.download_table("g_cpc_current")
+
+        # Preprocess data, the rows with invalid patent ids or CPC groups (about 800 patents have
+        # some) are removed when they are merged (see VALIDATED_REFERENCES)
+        patent_cpc_groups = self.read_links("g_cpc_current", PatentCPCGroup)
+
+        with self.pipeline(
+            PatentCPCGroup, connections=self.copy_connections
+        ) as pipeline:
+            for patent_cpc_groups_chunk in patent_cpc_groups:
+                patent_cpc_groups_chunk = patent_cpc_groups_chunk.rename(
+                    columns={"cpc_group": "cpc_group_id"}
+                )
+                patent_cpc_groups_chunk["patent_id"] = patent_id_map.map(
+                    patent_cpc_groups_chunk["patent_id"]
+                )
 
-        # Load data
-        PatentCPCGroup.objects.from_csv(
-            f"{DATA_DIRECTORY}/g_cpc_current_preprocessed.csv"
-        )
+                pipeline.put(patent_cpc_groups_chunk)
 
-        os.remove(f"{DATA_DIRECTORY}/g_cpc_current_preprocessed.csv")
-        os.remove(f"{DATA_DIRECTORY}/g_cpc_current.tsv")
+        self.remove_table("g_cpc_current")
         print("PatentCPCGroup table inserted successfully!")
 
     def handle_ipc(self):
-        self.download_and_unzip("g_ipc_at_issue")
+        self.download_table("g_ipc_at_issue")
 
         valid_sections = ["A", "B", "C", "D", "E", "F", "G", "H"]
 
-        df = pd.read_csv(
-            f"{DATA_DIRECTORY}/g_ipc_at_issue.tsv",
-            sep="\t",
-            usecols=[
-                "patent_id",
-                "section",
-                "ipc_class",
-                "subclass",
-                "main_group",
-                "subgroup",
-            ],
-            dtype=str
-        )
-
-        # Preprocess
-        df = df[df["section"].isin(valid_sections)]
-        df.dropna(inplace=True)
-
-        # A portion of subgroup and main_group contains "/" but not all of them.
-        df["subgroup"] = df["subgroup"].str.replace("/", "")
-        df["main_group"] = df["main_group"].str.replace("/", "")
-        df["ipc_class"] = df["section"] + df["ipc_class"]
-        df["subclass"] = df["ipc_class"] + df["subclass"]
-        df["main_group"] = df["subclass"] + " " + df["main_group"]
-        df["subgroup"] = df["main_group"] + "/" + df["subgroup"]
-
-        # There are some duplicates, so we need to remove them
-        df["merged"] = df["patent_id"] + df["subgroup"]
-        df.drop_duplicates(subset=["merged"], inplace=True)
-        df.drop(columns=["merged"], inplace=True)
-
-        # Create IPC data
-        sections = [IPCSection(section=sec) for sec in valid_sections]
-        IPCSection.objects.bulk_create(sections)
-
-        classes = (
-            df.groupby("ipc_class", as_index=False)
-            .agg(lambda x: x.iloc[0])
-            .apply(
-                lambda row: IPCClass(
-                    section_id=row["section"], _class=row["ipc_class"]
-                ),
-                axis=1,
-            )
-            .to_list()
-        )
-        IPCClass.objects.bulk_create(classes)
-
-        subclasses = (
-            df.groupby("subclass", as_index=False)
-            .agg(lambda x: x.iloc[0])
-            .apply(
-                lambda row: IPCSubclass(
-                    _class_id=row["ipc_class"], subclass=row["subclass"]
-                ),
-                axis=1,
-            )
-            .to_list()
-        )
-        IPCSubclass.objects.bulk_create(subclasses)
-
-        groups = (
-            df.groupby("main_group", as_index=False)
-            .agg(lambda x: x.iloc[0])
-            .apply(
-                lambda row: IPCGroup(
-                    subclass_id=row["subclass"], group=row["main_group"]
-                ),
-                axis=1,
-            )
-            .to_list()
-        )
-        IPCGroup.objects.bulk_create(groups)
-
-        subgroups = (
-            df.groupby("subgroup", as_index=False)
-            .agg(lambda x: x.iloc[0])
-            .apply(
-                lambda row: IPCSubgroup(
-                    group_id=row["main_group"], subgroup=row["subgroup"]
-                ),
-                axis=1,
-            )
-            .to_list()
-        )
-        IPCSubgroup.objects.bulk_create(subgroups)
-
-        # Create PatentIPCSubgroup
-        df.rename(columns={"subgroup": "ipc_subgroup_id"}, inplace=True)
-
-        # Map the office IDs to database IDs
-        df["patent_id"] = df["patent_id"].map(patent_id_map).astype("Int64")
-        df.dropna(inplace=True)
-        df.to_csv(
-            f"{DATA_DIRECTORY}/patent_ipc_subgroup.csv",
-            index=False,
-            columns=["patent_id", "ipc_subgroup_id"],
-        )
-        PatentIPCSubgroup.objects.from_csv(f"{DATA_DIRECTORY}/patent_ipc_subgroup.csv")
+        ipcs = self.read_links("g_ipc_at_issue", PatentIPCSubgroup)
+
+        levels = {
+            "classes": ["ipc_class", "section"],
+            "subclasses": ["subclass", "ipc_class"],
+            "groups": ["main_group", "subclass"],
+            "subgroups": ["subgroup", "main_group"],
+        }
+        parts = {level: [] for level in levels}
+
+        # There are some duplicates, also across chunks, so the links that were already copied
+        # are kept as patent id * IPC_SUBGROUP_CODES + the code of the subgroup
+        subgroup_codes = {}
+        copied_links = np.empty(0, dtype=np.int64)
+
+        with self.pipeline(PatentIPCSubgroup) as links_pipeline:
+            for df in ipcs:
+                # Preprocess
+                df = df[df["section"].isin(valid_sections)].dropna()
+
+                # A portion of subgroup and main_group contains "/" but not all of them.
+                df["subgroup"] = df["subgroup"].str.replace("/", "")
+                df["main_group"] = df["main_group"].str.replace("/", "")
+                df["ipc_class"] = df["section"] + df["ipc_class"]
+                df["subclass"] = df["ipc_class"] + df["subclass"]
+                df["main_group"] = df["subclass"] + " " + df["main_group"]
+                df["subgroup"] = df["main_group"] + "/" + df["subgroup"]
+
+                self.add_levels(parts, df, levels)
+
+                # Create PatentIPCSubgroup
+                links = df[["patent_id", "subgroup"]].drop_duplicates()
+                links = links.rename(columns={"subgroup": "ipc_subgroup_id"})
+
+                # Map the office IDs to database IDs
+                links["patent_id"] = patent_id_map.map(links["patent_id"])
+                links = links.dropna()
+
+                for subgroup in links["ipc_subgroup_id"].unique():
+                    subgroup_codes.setdefault(subgroup, len(subgroup_codes))
+                patent_ids = links["patent_id"].to_numpy(dtype=np.int64)
+                codes = links["ipc_subgroup_id"].map(subgroup_codes).to_numpy(np.int64)
+                keys = patent_ids * IPC_SUBGROUP_CODES + codes
+                links_pipeline.put(links[~np.isin(keys, copied_links)])
+                copied_links = np.union1d(copied_links, keys)
+
+            # Create IPC data, it's committed before the links so their foreign keys are valid
+            levels = self.merge_levels(parts, levels)
+            with self.pipeline(IPCSection) as pipeline:
+                pipeline.put(pd.DataFrame({"section": valid_sections}))
+            with self.pipeline(IPCClass) as pipeline:
+                pipeline.put(
+                    levels["classes"].rename(
+                        columns={"ipc_class": "_class", "section": "section_id"}
+                    )
+                )
+            with self.pipeline(IPCSubclass) as pipeline:
+                pipeline.put(
+                    levels["subclasses"].rename(columns={"ipc_class": "_class_id"})
+                )
+            with self.pipeline(IPCGroup) as pipeline:
+                pipeline.put(
+                    levels["groups"].rename(
+                        columns={"main_group": "group", "subclass": "subclass_id"}
+                    )
+                )
+            with self.pipeline(IPCSubgroup) as pipeline:
+                pipeline.put(
+                    levels["subgroups"].rename(columns={"main_group": "group_id"})
+                )
 
-        os.remove(f"{DATA_DIRECTORY}/patent_ipc_subgroup.csv")
-        os.remove(f"{DATA_DIRECTORY}/g_ipc_at_issue.tsv")
+        self.remove_table("g_ipc_at_issue")
         print("IPCData tables and PatentIPCSubgroup inserted successfully!")
 
     def handle_pct(self):
-        self.download_and_unzip("g_pct_data")
+        self.download_table("g_pct_data")
 
         # Preprocess data
-        pct_data = pd.read_csv(
-            f"{DATA_DIRECTORY}/g_pct_data.tsv",
-            sep="\t",
-            usecols=[
-                "patent_id",
-                "published_or_filed_date",
-                "filed_country",
-                "pct_doc_number",
-                "pct_doc_type",
-            ],
-            dtype={
-                "patent_id": str,
-                "published_or_filed_date": str,
-                "filed_country": str,
-                "pct_doc_number": str,
-                "pct_doc_type": str,
-            },
-            chunksize=CHUNK_SIZE,
-        )
-
-        for i, pct_data_chunk in enumerate(pct_data):
-            pct_data_chunk.rename(
-                columns={"pct_doc_number": "pct_id", "pct_doc_type": "granted"},
-                inplace=True,
-            )
+        pct_data = self.read_links("g_pct_data", PCTData)
 
-            pct_data_chunk["patent_id"] = (
-                pct_data_chunk["patent_id"].map(patent_id_map).astype("Int64")
-            )
-            pct_data_chunk["granted"] = pct_data_chunk["granted"].map(
-                {"wo_grant": True, "pct_application": False}
-            )
+        with self.pipeline(PCTData, connections=self.copy_connections) as pipeline:
+            for pct_data_chunk in pct_data:
+                pct_data_chunk.rename(
+                    columns={"pct_doc_number": "pct_id", "pct_doc_type": "granted"},
+                    inplace=True,
+                )
 
-            # Remove rows that don't have a published or filed date or have an invalid patent id
-            pct_data_chunk.drop(
-                pct_data_chunk[
-                    pct_data_chunk["patent_id"].isna()
-                    | pct_data_chunk["published_or_filed_date"].isna()
-                ].index,
-                inplace=True,
-            )
+                pct_data_chunk["patent_id"] = patent_id_map.map(
+                    pct_data_chunk["patent_id"]
+                )
+                pct_data_chunk["granted"] = pct_data_chunk["granted"].map(
+                    {"wo_grant": True, "pct_application": False}
+                )
 
-            # Precalculate fields
-            pct_data_chunk["representation"] = pct_data_chunk[
-                "published_or_filed_date"
-            ] + pct_data_chunk["granted"].apply(
-                lambda x: " - granted" if x else " - not granted"
-            )
+                # Remove rows that don't have a published or filed date
+                pct_data_chunk.drop(
+                    pct_data_chunk[
+                        pct_data_chunk["published_or_filed_date"].isna()
+                    ].index,
+                    inplace=True,
+                )
 
-            pct_data_chunk.to_csv(
-                f"{DATA_DIRECTORY}/g_pct_data_preprocessed.csv",
-                index=False,
-                header=i == 0,
-                mode="a",
-            )
+                # Precalculate fields
+                pct_data_chunk["representation"] = pct_data_chunk[
+                    "published_or_filed_date"
+                ] + pct_data_chunk["granted"].apply(
+                    lambda x: " - granted" if x else " - not granted"
+                )
 
-        # Load data
-        PCTData.objects.from_csv(f"{DATA_DIRECTORY}/g_pct_data_preprocessed.csv")
+                pipeline.put(pct_data_chunk)
 
-        os.remove(f"{DATA_DIRECTORY}/g_pct_data.tsv")
-        os.remove(f"{DATA_DIRECTORY}/g_pct_data_preprocessed.csv")
+        self.remove_table("g_pct_data")
         print("PCTData table inserted successfully!")
 
     def handle_inventor(self):
-        self.download_and_unzip("g_inventor_disambiguated")
+        self.download_table("g_inventor_disambiguated")
 
         # Preprocess data
-        inventors_chunks = pd.read_csv(
-            f"{DATA_DIRECTORY}/g_inventor_disambiguated.tsv",
-            sep="\t",
-            usecols=[
-                "patent_id",
-                "location_id",
-                "disambig_inventor_name_first",
-                "disambig_inventor_name_last",
-            ],
-            dtype={
-                "patent_id": str,
-                "location_id": str,
-                "disambig_inventor_name_first": str,
-                "disambig_inventor_name_last": str,
-            },
-            chunksize=CHUNK_SIZE,
-        )
-
-        for i, inventors_chunk in enumerate(inventors_chunks):
-            # Process chunk
-            inventors_chunk = inventors_chunk.rename(
-                columns={
-                    "disambig_inventor_name_first": "first_name",
-                    "disambig_inventor_name_last": "last_name",
-                }
-            )
+        inventors_chunks = self.read_links("g_inventor_disambiguated", Inventor)
+
+        with self.pipeline(Inventor, connections=self.copy_connections) as pipeline:
+            for inventors_chunk in inventors_chunks:
+                # Process chunk
+                inventors_chunk = inventors_chunk.rename(
+                    columns={
+                        "disambig_inventor_name_first": "first_name",
+                        "disambig_inventor_name_last": "last_name",
+                    }
+                )
 
-            inventors_chunk["patent_id"] = (
-                inventors_chunk["patent_id"].map(patent_id_map).astype("Int64")
-            )
-            inventors_chunk["location_id"] = (
-                inventors_chunk["location_id"].map(location_id_map).astype("Int64")
-            )
-            inventors_chunk = inventors_chunk[inventors_chunk["patent_id"].notna()]
-            # There are some invalid location ids, so we need to remove them
-            inventors_chunk = inventors_chunk[inventors_chunk["location_id"].notna()]
-            inventors_chunk["location_id"] = inventors_chunk["location_id"].astype(
-                "Int64"
-            )
+                inventors_chunk["patent_id"] = patent_id_map.map(
+                    inventors_chunk["patent_id"]
+                )
+                inventors_chunk["location_id"] = location_id_map.map(
+                    inventors_chunk["location_id"]
+                )
+                # Rows with invalid patent or location ids are removed when they are merged
 
-            inventors_chunk.to_csv(
-                f"{DATA_DIRECTORY}/g_inventor_disambiguated_preprocessed.csv",
-                index=False,
-                header=i == 0,
-                mode="a",
-            )
+                pipeline.put(inventors_chunk)
 
-        # Load data
-        Inventor.objects.from_csv(
-            f"{DATA_DIRECTORY}/g_inventor_disambiguated_preprocessed.csv"
-        )
-        os.remove(f"{DATA_DIRECTORY}/g_inventor_disambiguated.tsv")
-        os.remove(f"{DATA_DIRECTORY}/g_inventor_disambiguated_preprocessed.csv")
+        self.remove_table("g_inventor_disambiguated")
         print("Inventor table inserted successfully!")
 
     def handle_assignee(self):
-        self.download_and_unzip("g_assignee_disambiguated")
+        self.download_table("g_assignee_disambiguated")
 
         # Preprocess data
-        assignee_chunks = pd.read_csv(
-            f"{DATA_DIRECTORY}/g_assignee_disambiguated.tsv",
-            sep="\t",
-            usecols=[
-                "patent_id",
-                "location_id",
-                "disambig_assignee_individual_name_first",
-                "disambig_assignee_individual_name_last",
-                "disambig_assignee_organization",
-            ],
-            dtype={
-                "patent_id": str,
-                "location_id": str,
-                "disambig_assignee_organization": str,
-                "disambig_assignee_individual_name_first": str,
-                "disambig_assignee_individual_name_last": str,
-            },
-            chunksize=CHUNK_SIZE,
-        )
-
-        for i, assignee_chunk in enumerate(assignee_chunks):
-            # Process chunk
-            assignee_chunk = assignee_chunk.rename(
-                columns={
-                    "disambig_assignee_individual_name_first": "first_name",
-                    "disambig_assignee_individual_name_last": "last_name",
-                    "disambig_assignee_organization": "organization",
-                }
-            )
-
-            assignee_chunk["patent_id"] = (
-                assignee_chunk["patent_id"].map(patent_id_map).astype("Int64")
-            )
-            assignee_chunk["location_id"] = (
-                assignee_chunk["location_id"].map(location_id_map).astype("Int64")
-            )
-            # There are some invalid location ids, so we need to remove them
-            assignee_chunk = assignee_chunk[assignee_chunk["location_id"].notna()]
-            assignee_chunk = assignee_chunk[assignee_chunk["patent_id"].notna()]
+        assignee_chunks = self.read_links("g_assignee_disambiguated", Assignee)
+
+        with self.pipeline(Assignee, connections=self.copy_connections) as pipeline:
+            for assignee_chunk in assignee_chunks:
+                # Process chunk
+                assignee_chunk = assignee_chunk.rename(
+                    columns={
+                        "disambig_assignee_individual_name_first": "first_name",
+                        "disambig_assignee_individual_name_last": "last_name",
+                        "disambig_assignee_organization": "organization",
+                    }
+                )
 
-            # Precalculate fields
-            assignee_chunk["is_organization"] = assignee_chunk["organization"].apply(
-                lambda x: not pd.isnull(x)
-            )
+                assignee_chunk["patent_id"] = patent_id_map.map(
+                    assignee_chunk["patent_id"]
+                )
+                assignee_chunk["location_id"] = location_id_map.map(
+                    assignee_chunk["location_id"]
+                )
+                # Rows with invalid patent or location ids are removed when they are merged
 
-            assignee_chunk.to_csv(
-                f"{DATA_DIRECTORY}/g_assignee_disambiguated_preprocessed.csv",
-                index=False,
-                header=i == 0,
-                mode="a",
-            )
+                # Precalculate fields
+                assignee_chunk["is_organization"] = assignee_chunk[
+                    "organization"
+                ].apply(lambda x: not pd.isnull(x))
 
-        # Load data
-        Assignee.objects.from_csv(
-            f"{DATA_DIRECTORY}/g_assignee_disambiguated_preprocessed.csv"
-        )
+                pipeline.put(assignee_chunk)
 
-        os.remove(f"{DATA_DIRECTORY}/g_assignee_disambiguated_preprocessed.csv")
-        os.remove(f"{DATA_DIRECTORY}/g_assignee_disambiguated.tsv")
+        self.remove_table("g_assignee_disambiguated")
         print("Assignee table inserted successfully!")
 
     def handle_us_patent_citation(self):
-        global citations_made, citations_received
-        self.download_and_unzip("g_us_patent_citation")
+        self.download_table("g_us_patent_citation")
 
         # Preprocess data
-        citations_chunks = pd.read_csv(
-            f"{DATA_DIRECTORY}/g_us_patent_citation.tsv",
-            sep="\t",
-            usecols=["patent_id", "citation_patent_id", "citation_date"],
-            dtype={"patent_id": str, "citation_patent_id": str, "citation_date": str},
-            chunksize=CHUNK_SIZE,
-        )
-
-        for i, citations_chunk in enumerate(citations_chunks):
-            citations_chunk.rename(
-                columns={"patent_id": "citing_patent_id"}, inplace=True
-            )
-
-            citations_chunk["citing_patent_id"] = (
-                citations_chunk["citing_patent_id"].map(patent_id_map).astype("Int64")
-            )
+        citations_chunks = self.read_links("g_us_patent_citation", PatentCitation)
+
+        with self.pipeline(
+            PatentCitation, connections=self.copy_connections
+        ) as pipeline:
+            # A sampled load only keeps the citations between sampled patents (read_links keeps
+            # the ones of the citing patents)
+            for citations_chunk in self.sampled(
+                citations_chunks, column="citation_patent_id"
+            ):
+                citations_chunk.rename(
+                    columns={"patent_id": "citing_patent_id"}, inplace=True
+                )
 
-            citations_chunk["cited_patent_id"] = (
-                citations_chunk["citation_patent_id"].map(patent_id_map).astype("Int64")
-            )
+                citations_chunk["citing_patent_id"] = patent_id_map.map(
+                    citations_chunk["citing_patent_id"]
+                )
 
-            # There could be cited patents that are not in the database, so we need to add their
-            # number and country instead of their id
-            na = citations_chunk["cited_patent_id"].isna()
-            citations_chunk.loc[na, "cited_patent_office"] = "US"
-            citations_chunk.loc[na, "cited_patent_number"] = citations_chunk.loc[
-                na, "citation_patent_id"
-            ]
-            citations_chunk.drop(columns=["citation_patent_id"], inplace=True)
-
-            # Precalculate fields
-            citations_chunk["citation_year"] = (
-                citations_chunk["citation_date"].str[:4].astype("Int64")
-            )
+                citations_chunk["cited_patent_id"] = patent_id_map.map(
+                    citations_chunk["citation_patent_id"]
+                )
 
-            # Remove rows with invalid citation years
-            citations_chunk.drop(
-                citations_chunk[
-                    ~citations_chunk["citation_year"].between(
-                        USPTO_CREATION_YEAR, CURRENT_YEAR
-                    )
-                ].index,
-                inplace=True,
-            )
+                # There could be cited patents that are not in the database, so we need to add their
+                # number and country instead of their id
+                na = citations_chunk["cited_patent_id"].isna()
+                citations_chunk.loc[na, "cited_patent_office"] = "US"
+                citations_chunk.loc[na, "cited_patent_number"] = citations_chunk.loc[
+                    na, "citation_patent_id"
+                ]
+                citations_chunk.drop(columns=["citation_patent_id"], inplace=True)
+
+                # Precalculate fields
+                citations_chunk["citation_year"] = (
+                    citations_chunk["citation_date"].str[:4].astype("Int64")
+                )
 
-            citations_chunk.to_csv(
-                f"{DATA_DIRECTORY}/g_us_patent_citation_preprocessed.csv",
-                index=False,
-                header=i == 0,
-                mode="a",
-            )
+                # Remove rows with invalid citation years
+                citations_chunk.drop(
+                    citations_chunk[
+                        ~citations_chunk["citation_year"].between(
+                            USPTO_CREATION_YEAR, CURRENT_YEAR
+                        )
+                    ].index,
+                    inplace=True,
+                )
 
-        # Load data
-        PatentCitation.objects.from_csv(
-            f"{DATA_DIRECTORY}/g_us_patent_citation_preprocessed.csv"
-        )
+                pipeline.put(citations_chunk)
 
-        os.remove(f"{DATA_DIRECTORY}/g_us_patent_citation.tsv")
-        os.remove(f"{DATA_DIRECTORY}/g_us_patent_citation_preprocessed.csv")
+        self.remove_table("g_us_patent_citation")
         print("PatentCitation table (US) inserted successfully!")
 
     def handle_foreign_citation(self):
-        global citations_made
-        self.download_and_unzip("g_foreign_citation")
+        self.download_table("g_foreign_citation")
 
         # Preprocess data
-        citations = pd.read_csv(
-            f"{DATA_DIRECTORY}/g_foreign_citation.tsv",
-            sep="\t",
-            usecols=[
-                "patent_id",
-                "citation_application_id",
-                "citation_date",
-                "citation_country",
-            ],
-            dtype={
-                "patent_id": str,
-                "citation_application_id": str,
-                "citation_date": str,
-                "citation_country": str,
-            },
-            chunksize=CHUNK_SIZE,
-        )
-
-        for i, citation_chunk in enumerate(citations):
-            citation_chunk.rename(
-                columns={
-                    "patent_id": "citing_patent_id",
-                    "citation_application_id": "cited_patent_number",
-                    "citation_country": "cited_patent_office",
-                },
-                inplace=True,
-            )
+        citations = self.read_links("g_foreign_citation", PatentCitation)
+
+        with self.pipeline(
+            PatentCitation, connections=self.copy_connections
+        ) as pipeline:
+            for citation_chunk in citations:
+                citation_chunk.rename(
+                    columns={
+                        "patent_id": "citing_patent_id",
+                        "citation_application_id": "cited_patent_number",
+                        "citation_country": "cited_patent_office",
+                    },
+                    inplace=True,
+                )
 
-            citation_chunk["citing_patent_id"] = (
-                citation_chunk["citing_patent_id"].map(patent_id_map).astype("Int64")
-            )
+                citation_chunk["citing_patent_id"] = patent_id_map.map(
+                    citation_chunk["citing_patent_id"]
+                )
 
-            # Precalculate fields
-            citation_chunk["citation_year"] = (
-                citation_chunk["citation_date"].str[:4].astype("Int64")
-            )
+                # Precalculate fields
+                citation_chunk["citation_year"] = (
+                    citation_chunk["citation_date"].str[:4].astype("Int64")
+                )
 
-            # Remove rows with invalid citation years
-            citation_chunk.drop(
-                citation_chunk[
-                    ~citation_chunk["citation_year"].between(
-                        USPTO_CREATION_YEAR, CURRENT_YEAR
-                    )
-                ].index,
-                inplace=True,
-            )
+                # Remove rows with invalid citation years
+                citation_chunk.drop(
+                    citation_chunk[
+                        ~citation_chunk["citation_year"].between(
+                            USPTO_CREATION_YEAR, CURRENT_YEAR
+                        )
+                    ].index,
+                    inplace=True,
+                )
 
-            citation_chunk.to_csv(
-                f"{DATA_DIRECTORY}/g_foreign_citation_preprocessed.csv",
-                index=False,
-                header=i == 0,
-                mode="a",
-            )
+                pipeline.put(citation_chunk)
 
-        # Load data
-        PatentCitation.objects.from_csv(
-            f"{DATA_DIRECTORY}/g_foreign_citation_preprocessed.csv"
-        )
-
-        os.remove(f"{DATA_DIRECTORY}/g_foreign_citation.tsv")
-        os.remove(f"{DATA_DIRECTORY}/g_foreign_citation_preprocessed.csv")
+        self.remove_table("g_foreign_citation")
         print("PatentCitation table (global) inserted successfully!")
 
     def handle_counts(self):
-        Patent.objects.update(
-            cpc_groups_count=Subquery(
-                PatentCPCGroup.objects.filter(patent_id=OuterRef("id"))
-                .values("patent_id")
-                .annotate(count=Count("patent_id"))
-                .values("count"),
-                output_field=IntegerField(),
-            ),
-            ipc_subgroups_count=Subquery(
-                PatentIPCSubgroup.objects.filter(patent_id=OuterRef("id"))
-                .values("patent_id")
-                .annotate(count=Count("patent_id"))
-                .values("count"),
-                output_field=IntegerField(),
-            ),
-            assignee_count=Subquery(
-                Assignee.objects.filter(patent_id=OuterRef("id"))
-                .values("patent_id")
-                .annotate(count=Count("patent_id"))
-                .values("count"),
-                output_field=IntegerField(),
-            ),
-            inventor_count=Subquery(
-                Inventor.objects.filter(patent_id=OuterRef("id"))
-                .values("patent_id")
-                .annotate(count=Count("patent_id"))
-                .values("count"),
-                output_field=IntegerField(),
-            ),
-            incoming_citations_count=Subquery(
-                PatentCitation.objects.filter(cited_patent_id=OuterRef("id"))
-                .values("cited_patent_id")
-                .annotate(count=Count("cited_patent_id"))
-                .values("count"),
-                output_field=IntegerField(),
-            ),
-            outgoing_citations_count=Subquery(
-                PatentCitation.objects.filter(citing_patent_id=OuterRef("id"))
-                .values("citing_patent_id")
-                .annotate(count=Count("citing_patent_id"))
-                .values("count"),
-                output_field=IntegerField(),
-            ),
-        )
+        # Each count is aggregated with one GROUP BY over its table into a temporary table, and
+        # then all of them are set with a single UPDATE. Patents without rows keep a NULL count.
+        # An incremental load only counts the rows of the patents whose rows it changed.
+        patent_table = Patent._meta.db_table
+        patent_pk = Patent._meta.pk.column
+        affected = f'IN (SELECT id FROM "{AFFECTED_PATENTS_TABLE}")'
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            for count, field in PATENT_COUNTS.items():
+                restriction = (
+                    f'AND "{field.column}" {affected}' if self.incremental else ""
+                )
+                cursor.execute(
+                    f'CREATE TEMP TABLE "{count}" ON COMMIT DROP AS '
+                    f'SELECT "{field.column}" AS patent_id, COUNT(*) AS count '
+                    f'FROM "{field.model._meta.db_table}" '
+                    f'WHERE "{field.column}" IS NOT NULL {restriction} '
+                    f'GROUP BY "{field.column}"'
+                )
+                cursor.execute(f'ALTER TABLE "{count}" ADD PRIMARY KEY (patent_id)')
+                cursor.execute(f'ANALYZE "{count}"')
+
+            assignments = ", ".join(
+                f'"{Patent._meta.get_field(count).column}" = "{count}".count'
+                for count in PATENT_COUNTS
+            )
+            joins = " ".join(
+                f'LEFT JOIN "{count}" ON "{count}".patent_id = counted."{patent_pk}"'
+                for count in PATENT_COUNTS
+            )
+            restriction = (
+                f'AND counted."{patent_pk}" {affected}' if self.incremental else ""
+            )
+            cursor.execute(
+                f'UPDATE "{patent_table}" SET {assignments} '
+                f'FROM "{patent_table}" AS counted {joins} '
+                f'WHERE "{patent_table}"."{patent_pk}" = counted."{patent_pk}" {restriction}'
+            )
+            if self.incremental:
+                print(f"Recounted the rows of {cursor.rowcount} patents")
+
         print("Patent counts updated successfully!")
 
     def handle(self, *args, **options):
-        self.handle_location()
-        self.handle_cpc()
-        self.handle_patent()
-        self.handle_patent_cpc_group()
-        self.handle_ipc()
-        self.handle_pct()
-        self.handle_inventor()
-        self.handle_assignee()
-        self.handle_us_patent_citation()
-        self.handle_foreign_citation()
-        self.handle_counts()
+        self.telemetry = Telemetry(options["report"], options["tracemalloc"])
+        self.endpoint = options["endpoint"]
+        self.checksums = self.load_checksums(options["checksums"])
+        self.mirror_dir = options["mirror_dir"]
+        self.keep_downloads = options["keep_downloads"]
+        self.download_executor = None
+        self.download_cancel = threading.Event()
+        self.copy_connections = options["copy_connections"]
+        self.id_map_dir = options["id_map_dir"]
+        self.incremental = options["incremental"]
+        self.parallel_parse = options["parallel_parse"]
+        self.sample = options["sample"]
+        self.memory_governor = None
+        if options["max_memory"]:
+            self.memory_governor = MemoryGovernor(options["max_memory"])
+        self.staging_cache = None
+        if options["staging_cache"]:
+            try:
+                self.staging_cache = StagingCache(options["staging_cache"])
+            except ImportError as e:
+                raise CommandError(
+                    f"--staging-cache needs pyarrow, install it with pip ({e})."
+                )
+        # By table, they are saved by save_fingerprints
+        self.fingerprints: dict[str, Fingerprints] = {}
+        self.changed: dict[type[Model], np.ndarray] = {}  # See changed_patents
+        self.staging: dict[type[Model], tuple[str, list[CopyPipeline]]] = {}
+
+        if self.incremental and self.sample:
+            raise CommandError(
+                "--incremental would remove the rows of the patents --sample leaves out, "
+                "load a sampled database from scratch instead."
+            )
+        if self.incremental and options["bulk_load_mode"]:
+            raise CommandError(
+                "--bulk-load-mode drops the unique constraints an incremental load merges with."
+            )
+        # The chunks of the staging cache and of read_tsv are not sized by the memory budget
+        for option in ["staging_cache", "parallel_parse"]:
+            if self.memory_governor and options[option]:
+                raise CommandError(
+                    f"--max-memory can't be combined with --{option.replace('_', '-')}, its "
+                    "chunks are not sized by the memory budget."
+                )
+
+        if self.sample:
+            print(f"Loading a {self.sample:.2%} sample of the patents.")
+
+        start = time.perf_counter()
+        bulk_load = None
+        if options["bulk_load_mode"]:
+            bulk_load = BulkLoad(LOADED_MODELS, BULK_LOAD_STATE, self.copy_connections)
+            bulk_load.prepare()
+
+        checkpoint = Checkpoint(CHECKPOINT_PATH)
+        if not options["resume"]:
+            checkpoint.reset()
+
+        if self.incremental:
+            # The ids of the loaded release, new rows are added to them
+            self.restore_stage("location")
+            self.restore_stage("patent")
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'CREATE UNLOGGED TABLE IF NOT EXISTS "{AFFECTED_PATENTS_TABLE}" '
+                    "(id bigint PRIMARY KEY)"
+                )
+                if not options["resume"]:
+                    cursor.execute(f'TRUNCATE "{AFFECTED_PATENTS_TABLE}"')
+        remaining_tables = [
+            table
+            for stage, (tables, _) in STAGES.items()
+            if not checkpoint.is_completed(stage)
+            for table in tables
+        ]
+
+        # The pool is started before any data is loaded, so its workers are forked small.
+        start_pool(options["processes"])
+        self.prefetch_tables(options["download_workers"], remaining_tables)
+        try:
+            for stage, (_, models) in STAGES.items():
+                if checkpoint.is_completed(stage):
+                    print(f"Skipping the {stage} stage, a previous run completed it.")
+                    self.restore_stage(stage)
+                    continue
+
+                if self.incremental:
+                    # The upserts can be run again, only the rows added to the link tables have
+                    # to be rolled back
+                    models = [model for model in models if model in PATENT_ROWS]
+                checkpoint.start(stage, models)
+                with self.telemetry.stage(stage) as record:
+                    getattr(self, f"handle_{stage}")()
+                    with self.telemetry.timer("merge"):
+                        self.merge_stage(stage)
+                    self.save_fingerprints(stage)
+                checkpoint.complete(stage)
+                record["rows_loaded"] = checkpoint.stages[stage].get("rows", {})
+        except BaseException:
+            if bulk_load:
+                print(
+                    "The tables are left unlogged and without their constraints and indexes, "
+                    f"they are restored from {BULK_LOAD_STATE} when a bulk load finishes."
+                )
+            raise
+        finally:
+            if self.download_executor:
+                # Stops the running downloads too, their partial files are resumed next time
+                self.download_cancel.set()
+                self.download_executor.shutdown(cancel_futures=True)
+            close_pool()
+
+        if self.incremental:
+            with connection.cursor() as cursor:
+                cursor.execute(f'DROP TABLE "{AFFECTED_PATENTS_TABLE}"')
+        if bulk_load:
+            bulk_load.finish()
+        self.telemetry.print_summary()
+        print(f"Ingestion finished in {time.perf_counter() - start:.0f}s")
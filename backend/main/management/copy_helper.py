@@ -0,0 +1,570 @@
+"""
+This module contains helpers to load pandas data frames into the database with COPY.
+
+Data frames are encoded in memory in the binary COPY format of PostgreSQL, so numbers and dates
+are neither formatted as text by pandas nor parsed again by PostgreSQL. Each column of the data
+frame is mapped explicitly to a field of the model, and the field decides how the column is
+encoded.
+
+The CopyPipeline streams the chunks of a table into the database in background threads that have
+their own database connections, so the database copies a chunk while the next chunk is
+preprocessed, and big tables can be copied over several connections at once.
+"""
+
+from io import BytesIO, StringIO
+from queue import Queue, Empty, Full
+from threading import Barrier, BrokenBarrierError, Event, Lock, Thread
+import struct
+import time
+
+from django.db import connections as db_connections, transaction, DEFAULT_DB_ALIAS
+from django.db.models import Field, Model
+import numpy as np
+import pandas as pd
+
+# Chunks waiting to be copied, the producer blocks when the queue is full
+PIPELINE_QUEUE_SIZE = 2
+_DONE = object()  # Sentinel that tells the consumer to commit
+_ABORT = object()  # Sentinel that tells the consumer to roll back
+
+# https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+PGCOPY_TRAILER = struct.pack("!h", -1)
+POSTGRES_EPOCH = np.datetime64("2000-01-01", "D")
+
+# The binary COPY type of each field type, foreign keys use the type of the field they point to
+COPY_TYPES = {
+    "AutoField": "int4",
+    "IntegerField": "int4",
+    "BigAutoField": "int8",
+    "BigIntegerField": "int8",
+    "FloatField": "float8",
+    "BooleanField": "bool",
+    "DateField": "date",
+    "CharField": "text",
+    "TextField": "text",
+    "PointField": "geometry",
+}
+SERIAL_FIELD_TYPES = {"AutoField", "BigAutoField", "SmallAutoField"}
+FIXED_WIDTH_TYPES = {"int4": ">i4", "int8": ">i8", "float8": ">f8", "bool": "?"}
+
+# https://libgeos.org/specifications/wkb/#extended-wkb
+EWKB_POINT = np.dtype(
+    [("order", "u1"), ("type", "<u4"), ("srid", "<u4"), ("x", "<f8"), ("y", "<f8")]
+)
+EWKB_LITTLE_ENDIAN = 1
+EWKB_POINT_WITH_SRID = 0x20000001
+
+
+class CopyError(Exception):
+    """
+    Raised when a chunk can't be copied into the database.
+    """
+
+
+class _Aborted(Exception):
+    """
+    Raised inside the consumer to roll back the transaction when the producer failed.
+    """
+
+
+def model_fields(model: type[Model], columns: list[str]) -> list[Field]:
+    """
+    This function maps the columns of a data frame to the fields of a model.
+    A column can be named either after a field (e.g. patent) or its attribute (e.g. patent_id).
+
+    Args:
+        model (type[Model]): The model the data frame is loaded into.
+        columns (list[str]): The columns of the data frame.
+
+    Raises:
+        CopyError: If a column doesn't match any field of the model.
+
+    Returns:
+        list[Field]: The fields, in the same order as the columns.
+    """
+
+    fields = {}
+    for field in model._meta.concrete_fields:
+        fields[field.name] = field
+        fields[field.attname] = field
+
+    unknown = [column for column in columns if column not in fields]
+    if unknown:
+        raise CopyError(f"{model.__name__} has no fields named {', '.join(unknown)}.")
+    return [fields[column] for column in columns]
+
+
+def copy_type(field: Field) -> str:
+    """
+    This function returns the type a field is encoded as in the binary COPY format.
+
+    Args:
+        field (Field): The field of the model.
+
+    Raises:
+        CopyError: If the field type is not supported.
+
+    Returns:
+        str: The type (e.g. int8, text).
+    """
+
+    while field.is_relation:
+        field = field.target_field
+    internal_type = field.get_internal_type()
+    if internal_type not in COPY_TYPES:
+        raise CopyError(f"{internal_type} fields can't be copied in binary format.")
+    return COPY_TYPES[internal_type]
+
+
+def encode_column(values: pd.Series, type: str) -> tuple[np.ndarray, np.ndarray]:
+    """
+    This function encodes the values of a column for the binary COPY format, for the whole
+    column at once.
+
+    Args:
+        values (pd.Series): The column to encode, missing values are encoded as NULL.
+        type (str): The binary COPY type of the column (see COPY_TYPES).
+
+    Raises:
+        CopyError: If a value can't be converted to the type of the column.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The length of each value (-1 for NULL) and the bytes of
+        all the values that are not NULL, one after the other.
+    """
+
+    missing = values.isna().to_numpy()
+    if type == "text":
+        # Empty strings are loaded as NULL, like the CSV format does
+        missing |= (values == "").to_numpy()
+    present = values[~missing]
+
+    try:
+        if type == "date":
+            # numpy parses ISO dates itself and works for dates pandas can't represent
+            dates = present.to_numpy(dtype="datetime64[D]")
+            present, type = pd.Series((dates - POSTGRES_EPOCH).astype(np.int64)), "int4"
+
+        if type in FIXED_WIDTH_TYPES:
+            dtype = np.dtype(FIXED_WIDTH_TYPES[type])
+            data = present.to_numpy(dtype=dtype).view(np.uint8)
+            lengths = np.full(len(values), dtype.itemsize, dtype=np.int64)
+        else:
+            if type == "geometry":
+                # Geometries are sent as EWKB, either already encoded or as GEOS objects
+                encoded = [
+                    value if isinstance(value, bytes) else bytes(value.ewkb)
+                    for value in present.tolist()
+                ]
+            else:
+                encoded = [str(value).encode() for value in present.tolist()]
+            data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+            lengths = np.zeros(len(values), dtype=np.int64)
+            lengths[~missing] = np.fromiter(map(len, encoded), np.int64, len(encoded))
+    except (ValueError, TypeError, OverflowError) as e:
+        raise CopyError(f"Column {values.name} can't be encoded as {type}: {e}") from e
+
+    lengths[missing] = -1
+    return lengths, data
+
+
+def encode_dataframe(df: pd.DataFrame, fields: list[Field]) -> BytesIO:
+    """
+    This function encodes a data frame in the binary COPY format.
+    The values of each column are scattered to their place in the output with numpy, so there's
+    no Python work per value apart from encoding strings.
+
+    Args:
+        df (pd.DataFrame): The data frame to encode.
+        fields (list[Field]): The model field of each column of the data frame.
+
+    Returns:
+        BytesIO: A buffer with the encoded data frame.
+    """
+
+    columns = [
+        encode_column(df[column], copy_type(field))
+        for column, field in zip(df.columns, fields)
+    ]
+
+    # Each row is the field count followed by the length and the bytes of each value
+    row_sizes = 2 + sum(4 + np.maximum(lengths, 0) for lengths, _ in columns)
+    row_starts = len(PGCOPY_HEADER) + np.cumsum(row_sizes) - row_sizes
+    out = np.empty(
+        len(PGCOPY_HEADER) + int(row_sizes.sum()) + len(PGCOPY_TRAILER), np.uint8
+    )
+    out[: len(PGCOPY_HEADER)] = np.frombuffer(PGCOPY_HEADER, np.uint8)
+    out[len(out) - len(PGCOPY_TRAILER) :] = np.frombuffer(PGCOPY_TRAILER, np.uint8)
+    _scatter(out, row_starts, struct.pack("!h", len(columns)))
+
+    offsets = row_starts + 2
+    for lengths, data in columns:
+        _scatter(out, offsets, lengths.astype(">i4").view(np.uint8).reshape(-1, 4))
+        offsets += 4
+        sizes = np.maximum(lengths, 0)
+        # Where each byte of data goes: the offset of its value plus its position in the value
+        data_starts = np.cumsum(sizes) - sizes
+        out[np.repeat(offsets - data_starts, sizes) + np.arange(len(data))] = data
+        offsets += sizes
+
+    return BytesIO(out.tobytes())
+
+
+def _scatter(out: np.ndarray, offsets: np.ndarray, values: bytes | np.ndarray):
+    """
+    This function writes a fixed number of bytes at each of the given offsets.
+
+    Args:
+        out (np.ndarray): The output buffer.
+        offsets (np.ndarray): The offsets to write to.
+        values (bytes | np.ndarray): The bytes to write at every offset, or a row of bytes per
+        offset.
+    """
+
+    if isinstance(values, bytes):
+        values = np.frombuffer(values, np.uint8)
+    out[offsets[:, None] + np.arange(values.shape[-1])] = values
+
+
+def ewkb_points(x: pd.Series, y: pd.Series, srid: int) -> pd.Series:
+    """
+    This function encodes coordinates as EWKB points, for the whole columns at once.
+
+    Args:
+        x (pd.Series): The x coordinates (e.g. longitudes).
+        y (pd.Series): The y coordinates (e.g. latitudes).
+        srid (int): The spatial reference system of the coordinates (e.g. 4326).
+
+    Returns:
+        pd.Series: The EWKB of each point, missing where a coordinate is missing.
+    """
+
+    points = np.empty(len(x), dtype=EWKB_POINT)
+    points["order"] = EWKB_LITTLE_ENDIAN
+    points["type"] = EWKB_POINT_WITH_SRID
+    points["srid"] = srid
+    points["x"] = x.to_numpy(dtype=float, na_value=np.nan)
+    points["y"] = y.to_numpy(dtype=float, na_value=np.nan)
+
+    buffer = points.tobytes()
+    size = EWKB_POINT.itemsize
+    ewkb = pd.Series(
+        [buffer[start : start + size] for start in range(0, len(buffer), size)],
+        index=x.index,
+        dtype=object,
+    )
+    return ewkb.where(x.notna().to_numpy() & y.notna().to_numpy(), None)
+
+
+def reserve_ids(cursor, model: type[Model], count: int) -> np.ndarray:
+    """
+    This function takes ids for new rows from the sequence of a model's table in a single
+    query, so the rows can be copied with their ids and referenced before they are loaded.
+
+    Args:
+        cursor: The database cursor to use.
+        model (type[Model]): The model the rows belong to.
+        count (int): How many ids to take.
+
+    Returns:
+        np.ndarray: The ids.
+    """
+
+    cursor.execute(
+        "SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)",
+        # Counts are often numpy integers (e.g. mask.sum()), which psycopg2 can't adapt
+        [model._meta.db_table, model._meta.pk.column, int(count)],
+    )
+    return np.fromiter((id for id, in cursor.fetchall()), np.int64, int(count))
+
+
+def copy_dataframe(
+    cursor,
+    model: type[Model],
+    df: pd.DataFrame,
+    table: str | None = None,
+    format: str = "binary",
+) -> int:
+    """
+    This function copies a data frame into the table of a model.
+
+    Args:
+        cursor: The database cursor to use.
+        model (type[Model]): The model the data frame is loaded into.
+        df (pd.DataFrame): The data frame to load, its columns must be named after the model's fields.
+        table (str | None, optional): The table to copy into, if it's not the model's table
+        (e.g. a staging table with the same columns). Defaults to None.
+        format (str, optional): The COPY format, binary or csv. Defaults to "binary".
+
+    Returns:
+        int: The number of rows copied.
+    """
+
+    fields = model_fields(model, list(df.columns))
+    columns = ", ".join(f'"{field.column}"' for field in fields)
+
+    if format == "binary":
+        buffer = encode_dataframe(df, fields)
+    else:
+        buffer = StringIO()
+        df.to_csv(buffer, index=False, header=False)
+        buffer.seek(0)
+
+    cursor.copy_expert(
+        f'COPY "{table or model._meta.db_table}" ({columns}) '
+        f"FROM STDIN WITH (FORMAT {format})",
+        buffer,
+    )
+    return len(df)
+
+
+class CopyPipeline:
+    """
+    Copies the chunks of a table into the database while the next chunks are preprocessed.
+
+    The chunks are handed to consumer threads through a bounded queue, so the producer blocks
+    (instead of piling chunks up in memory) when the database is slower than the preprocessing.
+    With more than one connection every chunk is split in shards that are copied concurrently,
+    each consumer thread on its own connection and in its own transaction.
+
+    The consumers wait for each other before committing and all of them roll back if any of
+    them (or the producer) fails. If a commit fails after other shards were already committed
+    the rows they inserted (the ones above the primary key of the table before the load) are
+    deleted, so the table is either fully loaded or left as it was. Tables without a serial
+    primary key can only be copied over a single connection. Once committed, the rows in
+    the table are reconciled with the rows that were put in the pipeline.
+
+    The shards are written once, straight into the table, so the shards commit one after the
+    other and a reader could see some of them for a moment. Loads that others read while they run
+    should copy into another table with the same columns instead (e.g. a staging table that is
+    merged into the model's table in a single transaction afterwards, like an incremental uspto
+    load does). Such a table is expected to be empty, so it is reconciled by its rows and emptied
+    if the load fails.
+
+    Usage:
+        with CopyPipeline(Patent, connections=8) as pipeline:
+            for chunk in chunks:
+                pipeline.put(preprocess(chunk))
+    """
+
+    def __init__(
+        self,
+        model: type[Model],
+        queue_size: int = PIPELINE_QUEUE_SIZE,
+        using: str = DEFAULT_DB_ALIAS,
+        connections: int = 1,
+        table: str | None = None,
+    ):
+        """
+        Args:
+            model (type[Model]): The model the chunks are loaded into.
+            queue_size (int, optional): The chunks that can wait to be copied. Defaults to 2.
+            using (str, optional): The database to load the chunks into. Defaults to "default".
+            connections (int, optional): The connections the chunks are copied over. Defaults to 1.
+            table (str | None, optional): An empty table with the model's columns to copy into
+            instead of the model's table. Defaults to None.
+        """
+
+        self.model = model
+        self.table = table or model._meta.db_table
+        self.staging = table is not None
+        self.pk = model._meta.pk.column
+        # Rows with a serial key can be told apart from the rows that were there before the load
+        self.serial_pk = (
+            model._meta.pk.get_internal_type() in SERIAL_FIELD_TYPES
+            and not self.staging
+        )
+        self.using = using
+        self.shards = max(1, connections)
+        if self.shards > 1 and not self.serial_pk and not self.staging:
+            raise CopyError(
+                f"{self.table} has no serial primary key, so it can only be copied over "
+                "a single connection."
+            )
+        self.queue = Queue(queue_size * self.shards)
+        self.expected_rows = 0  # Rows put in the pipeline
+        self.columns = []  # Columns of the chunks put in the pipeline
+        self.shard_rows = [0] * self.shards  # Rows copied by each consumer
+        self.copy_seconds = [0.0] * self.shards  # Time each consumer spent copying
+        self.put_wait_seconds = 0.0  # Time the producer waited for the queue
+        self.committed = [False] * self.shards
+        self.error = None
+        self.lock = Lock()
+        self.stop = Event()  # Set when the load is aborted
+        # Consumers commit once all of them are done copying
+        self.barrier = Barrier(self.shards)
+        self.threads = [
+            Thread(
+                target=self._consume, args=(shard,), name=f"copy-{self.table}-{shard}"
+            )
+            for shard in range(self.shards)
+        ]
+
+    @property
+    def rows(self) -> int:
+        """
+        The rows copied so far by all the consumers.
+        """
+
+        return sum(self.shard_rows)
+
+    def __enter__(self) -> "CopyPipeline":
+        with db_connections[self.using].cursor() as cursor:
+            if self.serial_pk:
+                cursor.execute(f'SELECT MAX("{self.pk}") FROM "{self.table}"')
+            else:
+                cursor.execute(f'SELECT COUNT(*) FROM "{self.table}"')
+            self.watermark = cursor.fetchone()[0] or 0
+
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        if exc_type is not None:
+            self.stop.set()
+        for _ in self.threads:
+            # On failure the consumers roll back, otherwise they commit
+            self._put(_DONE)
+        for thread in self.threads:
+            thread.join()
+
+        if self.error is None and exc_type is None:
+            self._reconcile()
+        if (self.error is not None or exc_type is not None) and any(self.committed):
+            self._delete_loaded_rows()
+
+        if exc_type is None and self.error is not None:
+            raise CopyError(
+                f"Could not copy the data into {self.table}: {self.error}"
+            ) from self.error
+        return False
+
+    def put(self, chunk: pd.DataFrame):
+        """
+        Queues a chunk to be copied into the database. It blocks while the queue is full.
+
+        Args:
+            chunk (pd.DataFrame): The chunk, its columns must be named after the model's fields.
+
+        Raises:
+            CopyError: If a consumer failed to copy a previous chunk.
+        """
+
+        self.expected_rows += len(chunk)
+        self.columns = list(dict.fromkeys([*self.columns, *chunk.columns]))
+        shard_size = max(1, -(-len(chunk) // self.shards))  # Ceiling division
+        start_time = time.perf_counter()
+        for start in range(0, len(chunk), shard_size):
+            if not self._put(chunk.iloc[start : start + shard_size]):
+                raise CopyError(
+                    f"Could not copy the data into {self.table}: {self.error}"
+                ) from self.error
+        self.put_wait_seconds += time.perf_counter() - start_time
+
+    def _put(self, item) -> bool:
+        """
+        Puts an item in the queue, waiting while the queue is full unless a consumer died.
+
+        Args:
+            item: The item to put in the queue.
+
+        Returns:
+            bool: False if a consumer died, True otherwise.
+        """
+
+        while self.error is None and any(thread.is_alive() for thread in self.threads):
+            try:
+                self.queue.put(item, timeout=1)
+                return True
+            except Full:
+                continue
+        return self.error is None
+
+    def _get(self):
+        """
+        Takes the next item from the queue, waiting while the queue is empty.
+
+        Returns:
+            The next item, or _ABORT if the load was aborted.
+        """
+
+        while not self.stop.is_set():
+            try:
+                return self.queue.get(timeout=1)
+            except Empty:
+                continue
+        return _ABORT
+
+    def _consume(self, shard: int):
+        """
+        Copies the queued chunks into the database until the producer is done.
+
+        Args:
+            shard (int): The number of the consumer.
+        """
+
+        connection = db_connections[self.using]  # Each thread gets its own connection
+        try:
+            with transaction.atomic(using=self.using), connection.cursor() as cursor:
+                while (chunk := self._get()) is not _DONE:
+                    if chunk is _ABORT:
+                        raise _Aborted()
+                    start_time = time.perf_counter()
+                    self.shard_rows[shard] += copy_dataframe(
+                        cursor, self.model, chunk, self.table
+                    )
+                    self.copy_seconds[shard] += time.perf_counter() - start_time
+
+                # Wait for the other shards, so either all of them commit or none does
+                self.barrier.wait()
+                if self.stop.is_set():
+                    raise _Aborted()
+            self.committed[shard] = True
+        except (_Aborted, BrokenBarrierError):
+            pass
+        except Exception as e:
+            with self.lock:
+                if self.error is None:
+                    self.error = e
+            self.stop.set()
+            self.barrier.abort()
+        finally:
+            connection.close()
+
+    def _reconcile(self):
+        """
+        Checks that every row put in the pipeline was copied and is in the table.
+        """
+
+        with db_connections[self.using].cursor() as cursor:
+            if self.serial_pk:
+                cursor.execute(
+                    f'SELECT COUNT(*) FROM "{self.table}" WHERE "{self.pk}" > %s',
+                    [self.watermark],
+                )
+                loaded_rows = cursor.fetchone()[0]
+            else:
+                cursor.execute(f'SELECT COUNT(*) FROM "{self.table}"')
+                loaded_rows = cursor.fetchone()[0] - self.watermark
+
+        if not self.expected_rows == self.rows == loaded_rows:
+            self.error = CopyError(
+                f"{self.expected_rows} rows were put in the pipeline, {self.rows} were copied "
+                f"and {loaded_rows} are in the table."
+            )
+
+    def _delete_loaded_rows(self):
+        """
+        Deletes the rows the committed shards inserted, when other shards failed.
+        """
+
+        with db_connections[self.using].cursor() as cursor:
+            if self.staging:
+                cursor.execute(f'DELETE FROM "{self.table}"')
+            else:
+                cursor.execute(
+                    f'DELETE FROM "{self.table}" WHERE "{self.pk}" > %s',
+                    [self.watermark],
+                )
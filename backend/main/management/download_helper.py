@@ -0,0 +1,271 @@
+"""
+This module contains helpers to download big files (like the PatentsView tables) over HTTP.
+
+The files are streamed to disk chunk by chunk so the memory usage stays flat no matter how big the
+file is. Interrupted downloads are kept as `<file>.part` and resumed with HTTP range requests, and
+every finished download is verified against its expected size and hash before it's moved in place.
+"""
+
+import hashlib
+import os
+import re
+import threading
+
+import requests as r
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MiB per read from the socket
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_TIMEOUT = 60  # seconds to wait for the server before giving up on a request
+
+# S3 (where PatentsView hosts its tables) uses the md5 of the file as the ETag of objects that
+# were not uploaded in parts, so in that case the ETag can be used as a checksum.
+MD5_ETAG_REGEX = re.compile(r'^"?([0-9a-f]{32})"?$')
+
+
+class DownloadError(Exception):
+    """
+    Raised when a download can't be completed or the downloaded file fails verification.
+    """
+
+
+class DownloadCancelled(DownloadError):
+    """
+    Raised when a download is cancelled, the partial file is kept so it can be resumed later.
+    """
+
+
+def download_file(
+    url: str,
+    path: str,
+    expected_size: int | None = None,
+    expected_sha256: str | None = None,
+    retries: int = DOWNLOAD_RETRIES,
+    chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+    timeout: int = DOWNLOAD_TIMEOUT,
+    cancel: threading.Event | None = None,
+) -> str:
+    """
+    This function streams a file from the given URL to the given path. If a partial download
+    exists from a previous attempt it's resumed instead of starting over.
+
+    Args:
+        url (str): The URL of the file.
+        path (str): The path the file will be saved to.
+        expected_size (int | None, optional): The expected size of the file in bytes. Defaults to None.
+        expected_sha256 (str | None, optional): The expected sha256 hex digest of the file. Defaults to None.
+        retries (int, optional): How many times to retry after a network error. Defaults to 5.
+        chunk_size (int, optional): The size of the chunks written to disk. Defaults to 1 MiB.
+        timeout (int, optional): The timeout of each request in seconds. Defaults to 60.
+        cancel (threading.Event | None, optional): An event that stops the download when it's
+            set, checked after every chunk. Defaults to None.
+
+    Raises:
+        DownloadError: If the download fails after all retries or the file fails verification.
+        DownloadCancelled: If the cancel event was set.
+
+    Returns:
+        str: The path of the downloaded file.
+    """
+
+    if os.path.exists(path):
+        _verify(path, os.path.getsize(path), expected_size, expected_sha256, None)
+        return path
+
+    cancel = cancel or threading.Event()
+    last_error = None
+    for attempt in range(retries + 1):
+        try:
+            _download(
+                url, path, expected_size, expected_sha256, chunk_size, timeout, cancel
+            )
+            return path
+        except (
+            r.ConnectionError,
+            r.Timeout,
+            r.exceptions.ChunkedEncodingError,
+        ) as e:
+            # The partial file is kept, so the next attempt continues where this one stopped.
+            last_error = e
+            if cancel.wait(min(2**attempt, 30)):
+                raise DownloadCancelled(f"The download of {url} was cancelled.")
+
+    raise DownloadError(f"Could not download {url}: {last_error}")
+
+
+def _download(
+    url: str,
+    path: str,
+    expected_size: int | None,
+    expected_sha256: str | None,
+    chunk_size: int,
+    timeout: int,
+    cancel: threading.Event,
+):
+    """
+    This function makes a single attempt to download (or resume downloading) a file.
+
+    Args:
+        url (str): The URL of the file.
+        path (str): The path the file will be saved to.
+        expected_size (int | None): The expected size of the file in bytes.
+        expected_sha256 (str | None): The expected sha256 hex digest of the file.
+        chunk_size (int): The size of the chunks written to disk.
+        timeout (int): The timeout of the request in seconds.
+        cancel (threading.Event): An event that stops the download when it's set.
+
+    Raises:
+        DownloadCancelled: If the cancel event was set.
+    """
+
+    part_path = f"{path}.part"
+    validator_path = f"{path}.part.validator"
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+    headers = {}
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+        # If-Range makes the server send the whole file if it changed since the partial download
+        if os.path.exists(validator_path):
+            with open(validator_path) as f:
+                headers["If-Range"] = f.read()
+
+    with r.get(url, headers=headers, stream=True, timeout=timeout) as res:
+        if res.status_code == 416:
+            # The range starts at the end of the file, so the partial file may be complete already.
+            total = _content_range_total(res.headers.get("Content-Range"))
+            if total != offset:
+                _remove(part_path, validator_path)
+                raise DownloadError(
+                    f"The partial download of {url} is not valid anymore."
+                )
+            etag = _read_validator(validator_path)
+        else:
+            res.raise_for_status()
+            if res.status_code == 206:
+                start = int(
+                    re.match(r"bytes (\d+)-", res.headers["Content-Range"]).group(1)
+                )
+                if start != offset:
+                    raise DownloadError(f"Server resumed {url} from the wrong offset.")
+                total = _content_range_total(res.headers["Content-Range"])
+                mode = "ab"
+            else:
+                # The server ignored the range (or the file changed), so start over.
+                offset = 0
+                total = (
+                    int(res.headers["Content-Length"])
+                    if "Content-Length" in res.headers
+                    else None
+                )
+                mode = "wb"
+
+            etag = res.headers.get("ETag")
+            validator = etag or res.headers.get("Last-Modified")
+            if validator:
+                with open(validator_path, "w") as f:
+                    f.write(validator)
+
+            with open(part_path, mode) as f:
+                for block in res.iter_content(chunk_size=chunk_size):
+                    if cancel.is_set():
+                        raise DownloadCancelled(f"The download of {url} was cancelled.")
+                    f.write(block)
+
+    size = os.path.getsize(part_path)
+    if total is not None and size != total:
+        # Connection was closed early without an error, retrying will resume the download.
+        raise r.ConnectionError(f"Received {size} of {total} bytes of {url}.")
+
+    try:
+        _verify(part_path, size, expected_size, expected_sha256, etag)
+    except DownloadError:
+        _remove(part_path, validator_path)
+        raise
+
+    os.replace(part_path, path)
+    _remove(validator_path)
+
+
+def _verify(
+    path: str,
+    size: int,
+    expected_size: int | None,
+    expected_sha256: str | None,
+    etag: str | None,
+):
+    """
+    This function verifies the size and the hash of a downloaded file.
+
+    Args:
+        path (str): The path of the file.
+        size (int): The size of the file in bytes.
+        expected_size (int | None): The expected size of the file in bytes.
+        expected_sha256 (str | None): The expected sha256 hex digest of the file.
+        etag (str | None): The ETag the server sent for the file.
+
+    Raises:
+        DownloadError: If the file doesn't match the expected size or hash.
+    """
+
+    if expected_size is not None and size != expected_size:
+        raise DownloadError(f"{path} has {size} bytes instead of {expected_size}.")
+
+    md5_etag = MD5_ETAG_REGEX.match(etag or "")
+    hashers = {}
+    if expected_sha256:
+        hashers[hashlib.sha256()] = expected_sha256.lower()
+    if md5_etag:
+        hashers[hashlib.md5()] = md5_etag.group(1)
+    if not hashers:
+        return
+
+    with open(path, "rb") as f:
+        while block := f.read(DOWNLOAD_CHUNK_SIZE):
+            for hasher in hashers:
+                hasher.update(block)
+
+    for hasher, expected in hashers.items():
+        if hasher.hexdigest() != expected:
+            raise DownloadError(f"{path} has a wrong {hasher.name} checksum.")
+
+
+def _content_range_total(content_range: str | None) -> int | None:
+    """
+    This function extracts the total size of the file from a Content-Range header.
+
+    Args:
+        content_range (str | None): The value of the header.
+
+    Returns:
+        int | None: The total size, or None if it's unknown.
+    """
+
+    match = re.search(r"/(\d+)$", content_range or "")
+    return int(match.group(1)) if match else None
+
+
+def _read_validator(validator_path: str) -> str | None:
+    """
+    This function reads the ETag (or Last-Modified date) stored next to a partial download.
+
+    Args:
+        validator_path (str): The path of the validator file.
+
+    Returns:
+        str | None: The validator, or None if there isn't one.
+    """
+
+    if not os.path.exists(validator_path):
+        return None
+    with open(validator_path) as f:
+        return f.read()
+
+
+def _remove(*paths: str):
+    """
+    This function removes the given files if they exist.
+    """
+
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
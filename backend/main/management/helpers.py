@@ -1,12 +1,16 @@
+import re
 import string
+from functools import lru_cache
+from collections import deque
 from multiprocessing import Pool
-from typing import Iterable
-from datetime import datetime
+from typing import Iterable, Iterator, Sequence
+import os
 
 import nltk
 from nltk.stem import WordNetLemmatizer
 from nltk.corpus import stopwords
 from nltk.tokenize import word_tokenize
+import pandas as pd
 from pydrive2.auth import GoogleAuth
 from pydrive2.drive import GoogleDrive, GoogleDriveFile
 
@@ -16,6 +20,64 @@ nltk.download("punkt", quiet=True)
 nltk.download("wordnet", quiet=True)
 lemma = WordNetLemmatizer()
 
+LEMMA_CACHE_SIZE = 2**20  # Distinct tokens kept in the token -> lemma memo
+STOPWORDS = frozenset(stopwords.words("english"))
+PUNCTUATION_TABLE = str.maketrans("", "", string.punctuation)
+# Text made only of these characters is split by word_tokenize on whitespace and the words below.
+PLAIN_TEXT_REGEX = re.compile(r"[a-z0-9 \t\n\r\f\v]*")
+CONTRACTIONS = {
+    "cannot": ("can", "not"),
+    "gimme": ("gim", "me"),
+    "gonna": ("gon", "na"),
+    "gotta": ("got", "ta"),
+    "lemme": ("lem", "me"),
+    "wanna": ("wan", "na"),
+}
+
+_pool = None  # The process pool shared by the multiprocessing helpers, see start_pool
+_pool_size = 0
+
+
+@lru_cache(maxsize=LEMMA_CACHE_SIZE)
+def lemmatize_token(token: str) -> str:
+    """
+    This function lemmatizes a single token, the results are memoized because the vocabulary of
+    patent texts is small compared to their volume.
+
+    Args:
+        token (str): The token to lemmatize.
+
+    Returns:
+        str: The lemma of the token.
+    """
+
+    return lemma.lemmatize(token)
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    This function tokenizes a lowercased text without punctuation exactly like word_tokenize does.
+    Plain alphanumeric text is tokenized with a whitespace split, which is what word_tokenize
+    amounts to once punctuation is removed, anything else falls back to word_tokenize.
+
+    Args:
+        text (str): The text to tokenize.
+
+    Returns:
+        list[str]: The tokens of the text.
+    """
+
+    if not PLAIN_TEXT_REGEX.fullmatch(text):
+        return word_tokenize(text)
+
+    tokens = []
+    for token in text.split():
+        if token in CONTRACTIONS:
+            tokens.extend(CONTRACTIONS[token])
+        else:
+            tokens.append(token)
+    return tokens
+
 
 def lemma_text(text: str | None) -> tuple[int, str]:
     """
@@ -32,45 +94,125 @@ def lemma_text(text: str | None) -> tuple[int, str]:
     if not text:
         return 0, ""
     tokens = [
-        lemma.lemmatize(w)
-        for w in word_tokenize(text.lower().translate(str.maketrans("", "", string.punctuation)))
-        if w not in stopwords.words("english")
+        lemmatize_token(w)
+        for w in tokenize(text.lower().translate(PUNCTUATION_TABLE))
+        if w not in STOPWORDS
     ]
     return len(tokens) - tokens.count("."), " ".join(tokens)
 
 
-def multiprocessing_apply(iterable: Iterable, func: callable, processes=8) -> list:
+def _init_worker():
+    """
+    This function initializes a worker of the process pool. It loads the NLTK data once per
+    worker, instead of once per task.
+    """
+
+    lemmatize_token("patents")  # WordNet is loaded lazily on the first lemmatization
+
+
+def start_pool(processes: int | None = None) -> Pool:
     """
-    This function applies a function to an iterable in parallel.
+    This function starts the process pool that is shared by all the multiprocessing_apply and
+    multiprocessing_imap calls.
+    If the pool is already running it's returned as is.
 
     Args:
-        iterable (Iterable): The iterable to apply the function to.
+        processes (int | None, optional): The processes to use. Defaults to the number of CPUs.
+
+    Returns:
+        Pool: The process pool.
+    """
+
+    global _pool, _pool_size
+
+    if _pool is None:
+        _pool_size = processes or os.cpu_count()
+        _pool = Pool(_pool_size, initializer=_init_worker)
+    return _pool
+
+
+def close_pool():
+    """
+    This function stops the shared process pool, if it's running.
+    """
+
+    global _pool
+
+    if _pool is not None:
+        _pool.close()
+        _pool.join()
+        _pool = None
+
+
+def multiprocessing_apply(
+    iterable: Sequence, func: callable, chunksize: int | None = None
+) -> list:
+    """
+    This function applies a function to a sequence in parallel using the shared process pool.
+    The sequence is sent to the workers in batches of chunksize items.
+
+    Args:
+        iterable (Sequence): The sequence to apply the function to.
         func (callable): The function to apply.
-        processes (int, optional): The processes to use. Defaults to 8.
+        chunksize (int | None, optional): The items sent to a worker at once. Defaults to
+        splitting the sequence in 4 batches per worker.
 
     Returns:
-        list: The result of the function applied to the iterable.
+        list: The result of the function applied to the sequence.
+    """
+
+    pool = start_pool()
+    if chunksize is None:
+        chunksize = max(1, len(iterable) // (_pool_size * 4))
+    return list(pool.imap(func, iterable, chunksize=chunksize))
+
+
+def multiprocessing_imap(
+    iterable: Iterable, func: callable, window: int | None = None
+) -> Iterator:
+    """
+    This function applies a function to the items of an iterable in parallel using the shared
+    process pool, and yields the results in the order of the items as soon as they are ready.
+    Unlike Pool.imap, at most window items are given to the workers ahead of the one that is
+    yielded, so the results don't pile up in memory when they are consumed slower.
+
+    Args:
+        iterable (Iterable): The items to apply the function to, read lazily.
+        func (callable): The function to apply.
+        window (int | None, optional): The items processed at once. Defaults to twice the
+        processes of the pool.
+
+    Yields:
+        The result of the function applied to each item.
     """
 
-    pool = Pool(processes)
-    data = pool.map(func, iterable)
-    pool.close()
-    pool.join()
-    return data
+    pool = start_pool()
+    window = window or _pool_size * 2
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
 
 
-def string_to_timestamp(string: str) -> float | None:
+def lemmatize_column(texts: pd.Series) -> list[tuple[int, str]]:
     """
-    This function converts a string to a timestamp.
+    This function lemmatizes a column of texts in parallel using the shared process pool.
+    Identical texts (e.g. common titles) are lemmatized only once.
 
     Args:
-        string (str): The string to convert.
+        texts (pd.Series): The texts to lemmatize.
 
     Returns:
-        float | None: The timestamp.
+        list[tuple[int, str]]: The word count and the lemmatized text of each text.
     """
 
-    return datetime.strptime(string, "%Y-%m-%d").timestamp()
+    codes, unique_texts = pd.factorize(texts)
+    results = multiprocessing_apply(unique_texts, lemma_text)
+    results.append(lemma_text(None))  # Missing texts have the code -1
+    return [results[code] for code in codes]
 
 
 def login_with_service_account() -> GoogleAuth:
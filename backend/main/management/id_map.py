@@ -0,0 +1,217 @@
+"""
+This module contains the IdMap, a compact map from the ids of an external source (e.g. the USPTO
+patent ids) to the ids of the rows in the database.
+
+The keys are kept as a sorted numpy array of fixed-width byte strings and the values as an array
+of integers next to it, so millions of ids take a few bytes each instead of the ~100 bytes of a
+dict entry, and whole columns are looked up at once with a binary search. A map can be saved to
+disk and memory-mapped back, so it survives across stages without living in the process memory.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+from django.db.models import QuerySet
+
+ID_MAP_BATCH_SIZE = 100000  # Rows fetched from the database at once when building a map
+MISSING_ID = -1  # Stored in place of the database id of keys without one
+
+
+class IdMap:
+    """
+    Maps external ids to database ids with vectorized lookups.
+
+    Usage:
+        patent_id_map = IdMap.from_queryset(
+            Patent.objects.filter(office="US"), "office_patent_id", "id"
+        )
+        chunk["patent_id"] = patent_id_map.map(chunk["patent_id"])
+    """
+
+    def __init__(self, keys: np.ndarray, values: np.ndarray):
+        """
+        Args:
+            keys (np.ndarray): The external ids as byte strings, sorted.
+            values (np.ndarray): The database id of each key.
+        """
+
+        self.keys = keys
+        self.values = values
+
+    @classmethod
+    def from_pairs(cls, keys, values) -> "IdMap":
+        """
+        Builds a map from the external ids and their database ids.
+
+        Args:
+            keys: The external ids, missing ones are skipped.
+            values: The database id of each key.
+
+        Returns:
+            IdMap: The map.
+        """
+
+        keys = pd.Series(keys, dtype=object).reset_index(drop=True)
+        values = np.asarray(values, dtype=np.int64)
+        present = keys.notna().to_numpy()
+        keys = _encode_keys(keys[present])
+        values = values[present]
+
+        order = np.argsort(keys, kind="stable")
+        return cls(keys[order], values[order])
+
+    @classmethod
+    def from_queryset(
+        cls, queryset: QuerySet, key_field: str, value_field: str = "id"
+    ) -> "IdMap":
+        """
+        Builds a map from the rows of a queryset, fetching them in batches so the rows are never
+        all in memory as Python objects.
+
+        Args:
+            queryset (QuerySet): The rows to build the map from.
+            key_field (str): The field with the external ids.
+            value_field (str, optional): The field with the database ids. Defaults to "id".
+
+        Returns:
+            IdMap: The map.
+        """
+
+        keys, values, batch = [], [], []
+        rows = queryset.values_list(key_field, value_field).iterator(
+            chunk_size=ID_MAP_BATCH_SIZE
+        )
+        for row in rows:
+            batch.append(row)
+            if len(batch) == ID_MAP_BATCH_SIZE:
+                keys.append(np.array([key for key, _ in batch], dtype=object))
+                values.append(np.array([value for _, value in batch], dtype=np.int64))
+                batch = []
+        keys.append(np.array([key for key, _ in batch], dtype=object))
+        values.append(np.array([value for _, value in batch], dtype=np.int64))
+
+        return cls.from_pairs(np.concatenate(keys), np.concatenate(values))
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "IdMap":
+        """
+        Loads a map saved with save.
+
+        Args:
+            path (str): The path the map was saved to, without extension.
+            mmap (bool, optional): Memory-map the arrays instead of reading them. Defaults to True.
+
+        Returns:
+            IdMap: The map.
+        """
+
+        mmap_mode = "r" if mmap else None
+        return cls(
+            np.load(f"{path}.keys.npy", mmap_mode=mmap_mode),
+            np.load(f"{path}.values.npy", mmap_mode=mmap_mode),
+        )
+
+    def save(self, path: str, mmap: bool = True) -> "IdMap":
+        """
+        Saves the map to disk, as two .npy files.
+
+        Args:
+            path (str): The path to save the map to, without extension.
+            mmap (bool, optional): Return the saved map memory-mapped. Defaults to True.
+
+        Returns:
+            IdMap: The saved map, memory-mapped if mmap is True.
+        """
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        np.save(f"{path}.keys.npy", self.keys)
+        np.save(f"{path}.values.npy", self.values)
+        return IdMap.load(path) if mmap else self
+
+    def update(self, keys, values) -> "IdMap":
+        """
+        Builds a map with more ids, keys that are already in the map get the new values.
+
+        Args:
+            keys: The external ids, missing ones are skipped.
+            values: The database id of each key.
+
+        Returns:
+            IdMap: The new map, this one is left as it was.
+        """
+
+        other = IdMap.from_pairs(keys, values)
+        dtype = max(self.keys.dtype, other.keys.dtype, key=lambda dtype: dtype.itemsize)
+        old_keys, new_keys = self.keys.astype(dtype), other.keys.astype(dtype)
+        kept = ~np.isin(old_keys, new_keys)
+
+        keys = np.concatenate([old_keys[kept], new_keys])
+        values = np.concatenate([self.values[kept], other.values])
+        order = np.argsort(keys, kind="stable")
+        return IdMap(keys[order], values[order])
+
+    def map(self, keys: pd.Series) -> pd.Series:
+        """
+        Looks up the database ids of a column of external ids.
+
+        Args:
+            keys (pd.Series): The external ids.
+
+        Returns:
+            pd.Series: The database ids (Int64), missing for unknown or missing keys.
+        """
+
+        ids = np.full(len(keys), MISSING_ID, dtype=np.int64)
+        present = keys.notna().to_numpy()
+
+        if len(self.keys) and present.any():
+            encoded = _encode_keys(keys[present])
+            if encoded.dtype.itemsize > self.keys.dtype.itemsize:
+                # Longer keys would be truncated to the width of the map and match a wrong key
+                fits = np.char.str_len(encoded) <= self.keys.dtype.itemsize
+                present[present] = fits
+                encoded = encoded[fits]
+            encoded = encoded.astype(self.keys.dtype)
+            # Sorted keys are found much faster, since each search starts where the last ended
+            order = np.argsort(encoded, kind="stable")
+            positions = np.empty(len(encoded), dtype=np.int64)
+            positions[order] = np.searchsorted(self.keys, encoded[order])
+            positions[positions == len(self.keys)] = 0
+            found = self.keys[positions] == encoded
+            ids[np.flatnonzero(present)[found]] = self.values[positions[found]]
+
+        return pd.Series(
+            pd.arrays.IntegerArray(ids, ids == MISSING_ID),
+            index=keys.index,
+            name=keys.name,
+        )
+
+    @property
+    def nbytes(self) -> int:
+        """
+        The memory taken by the keys and values of the map.
+        """
+
+        return self.keys.nbytes + self.values.nbytes
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+
+def _encode_keys(keys: pd.Series) -> np.ndarray:
+    """
+    This function converts ids to an array of fixed-width byte strings.
+
+    Args:
+        keys (pd.Series): The ids, without missing values.
+
+    Returns:
+        np.ndarray: The encoded ids.
+    """
+
+    keys = keys.astype(str)
+    try:
+        return np.array(keys.to_numpy(), dtype=bytes)
+    except UnicodeEncodeError:
+        return np.array(keys.str.encode("utf-8").to_numpy(), dtype=bytes)
@@ -0,0 +1,317 @@
+"""
+This module contains what an incremental load needs to tell the rows of a new release that changed
+apart from the loaded ones, and to merge only those into the database.
+
+The rows of a table are fingerprinted per patent: the hashes of the rows of each patent are summed
+into an array indexed by the database id of the patent. The sum doesn't depend on the order of the
+rows, so two releases can be compared one chunk at a time, and a patent whose fingerprint differs
+from the saved one had rows added, changed or removed. Comparing the fingerprints needs no database
+access at all, so only the rows of the patents that changed are preprocessed and copied.
+
+The rows that changed are copied into staging tables and merged with one statement each: rows with
+a key (e.g. patents and the lookup tables) are upserted, the rows of the link tables (e.g. the
+inventors of a patent) are replaced for the patents that changed.
+"""
+
+import os
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+from django.db.models import Model
+
+from main.management.copy_helper import model_fields
+from main.management.id_map import IdMap
+
+# The columns fingerprint_rows adds to the chunks
+FINGERPRINT_PATENT_ID = "fingerprint_patent_id"
+FINGERPRINT_HASH = "fingerprint_hash"
+
+
+class Fingerprints:
+    """
+    The sums of the hashes of the rows of each patent in a table, by the database id of the patent.
+
+    Usage:
+        fingerprints = Fingerprints()
+        for chunk in chunks:
+            fingerprints.add(patent_id_map.map(chunk["patent_id"]), row_hashes(chunk))
+        changed = fingerprints.changed(Fingerprints.load("g_inventor.npy"))
+    """
+
+    def __init__(self, values: np.ndarray | None = None):
+        """
+        Args:
+            values (np.ndarray | None, optional): The fingerprint of each patent id. Defaults to
+            None, no fingerprints.
+        """
+
+        self.values = np.zeros(0, dtype=np.uint64) if values is None else values
+
+    @classmethod
+    def load(cls, path: str) -> "Fingerprints":
+        """
+        Loads fingerprints saved with save, if they were never saved there are none.
+
+        Args:
+            path (str): The path of the .npy file.
+
+        Returns:
+            Fingerprints: The fingerprints.
+        """
+
+        if not os.path.exists(path):
+            return cls()
+        return cls(np.load(path))
+
+    def save(self, path: str):
+        """
+        Saves the fingerprints, replacing the previous ones atomically.
+
+        Args:
+            path (str): The path of the .npy file.
+        """
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(f"{path}.tmp", "wb") as f:
+            np.save(f, self.values)
+        os.replace(f"{path}.tmp", path)
+
+    def add(self, ids: pd.Series, hashes: np.ndarray):
+        """
+        Adds the hashes of rows to the fingerprints of their patents.
+
+        Args:
+            ids (pd.Series): The database id of the patent of each row, rows without one are
+            skipped.
+            hashes (np.ndarray): The hash of each row.
+        """
+
+        present = ids.notna().to_numpy()
+        ids = ids[present].to_numpy(dtype=np.int64)
+        if len(ids):
+            self._grow(ids.max() + 1)
+            # The sum wraps around, which keeps it independent of the order of the rows
+            np.add.at(self.values, ids, hashes[present])
+
+    def set(self, ids: np.ndarray, hashes: np.ndarray):
+        """
+        Sets the fingerprints of patents, for tables with a row per patent.
+
+        Args:
+            ids (np.ndarray): The database ids of the patents.
+            hashes (np.ndarray): The hash of the row of each patent.
+        """
+
+        if len(ids):
+            self._grow(ids.max() + 1)
+            self.values[ids] = hashes
+
+    def get(self, ids: np.ndarray) -> np.ndarray:
+        """
+        Returns the fingerprints of patents, 0 for patents without one.
+
+        Args:
+            ids (np.ndarray): The database ids of the patents.
+
+        Returns:
+            np.ndarray: The fingerprints.
+        """
+
+        fingerprints = np.zeros(len(ids), dtype=np.uint64)
+        known = ids < len(self.values)
+        fingerprints[known] = self.values[ids[known]]
+        return fingerprints
+
+    def changed(self, other: "Fingerprints") -> np.ndarray:
+        """
+        Compares the fingerprints with other fingerprints of the same table.
+
+        Args:
+            other (Fingerprints): The other fingerprints (e.g. the ones of the loaded release).
+
+        Returns:
+            np.ndarray: The database ids of the patents whose fingerprints differ.
+        """
+
+        size = max(len(self.values), len(other.values))
+        return np.flatnonzero(self._padded(size) != other._padded(size))
+
+    def _grow(self, size: int):
+        if size > len(self.values):
+            values = np.zeros(max(size, len(self.values) * 2), dtype=np.uint64)
+            values[: len(self.values)] = self.values
+            self.values = values
+
+    def _padded(self, size: int) -> np.ndarray:
+        values = np.zeros(size, dtype=np.uint64)
+        values[: len(self.values)] = self.values
+        return values
+
+
+def row_hashes(df: pd.DataFrame) -> np.ndarray:
+    """
+    This function hashes the rows of a data frame. The hashes only depend on the values of the rows
+    (not on the index), so they are the same in every run.
+
+    Args:
+        df (pd.DataFrame): The data frame.
+
+    Returns:
+        np.ndarray: The hash of each row, as uint64.
+    """
+
+    return pd.util.hash_pandas_object(df, index=False).to_numpy(dtype=np.uint64)
+
+
+def fingerprint_rows(chunk: pd.DataFrame, patent_id_map_path: str) -> pd.DataFrame:
+    """
+    This function adds the database id of the patent of each row (FINGERPRINT_PATENT_ID) and the
+    hash of the row (FINGERPRINT_HASH) to a chunk of a link table. The patent id map is loaded
+    from disk, so the function can run in the workers of the process pool (see read_tsv).
+
+    Args:
+        chunk (pd.DataFrame): The chunk, with the PatentsView ids in its patent_id column.
+        patent_id_map_path (str): The path the patent id map was saved to (see IdMap.save).
+
+    Returns:
+        pd.DataFrame: The chunk with the two columns.
+    """
+
+    hashes = row_hashes(chunk)
+    patent_ids = IdMap.load(patent_id_map_path).map(chunk["patent_id"])
+    return chunk.assign(**{FINGERPRINT_PATENT_ID: patent_ids, FINGERPRINT_HASH: hashes})
+
+
+def create_staging_table(
+    cursor, model: type[Model], nullable: list[str] | None = None
+) -> str:
+    """
+    This function creates an empty unlogged table with the columns and defaults of a model's table,
+    replacing the one a failed run might have left behind. It's a regular table rather than a
+    temporary one, so it can be copied into over several connections.
+
+    Args:
+        cursor: The database cursor to use.
+        model (type[Model]): The model.
+        nullable (list[str] | None, optional): Fields of the model that can be missing in the
+        staging table even if they can't in the model's table (e.g. references that are
+        validated before merging). Defaults to None.
+
+    Returns:
+        str: The name of the staging table.
+    """
+
+    table = model._meta.db_table
+    staging_table = f"{table}_staging"
+    cursor.execute(f'DROP TABLE IF EXISTS "{staging_table}"')
+    cursor.execute(
+        f'CREATE UNLOGGED TABLE "{staging_table}" (LIKE "{table}" INCLUDING DEFAULTS)'
+    )
+    for field in model_fields(model, nullable or []):
+        cursor.execute(
+            f'ALTER TABLE "{staging_table}" ALTER COLUMN "{field.column}" DROP NOT NULL'
+        )
+    return staging_table
+
+
+def copy_ids(cursor, table: str, ids: np.ndarray):
+    """
+    This function copies ids into a new temporary table with an id column, which is dropped when
+    the transaction ends.
+
+    Args:
+        cursor: The database cursor to use.
+        table (str): The name of the temporary table.
+        ids (np.ndarray): The ids.
+    """
+
+    cursor.execute(
+        f'CREATE TEMP TABLE "{table}" (id bigint PRIMARY KEY) ON COMMIT DROP'
+    )
+    cursor.copy_expert(
+        f'COPY "{table}" (id) FROM STDIN',
+        StringIO("".join(f"{id}\n" for id in np.unique(ids))),
+    )
+    cursor.execute(f'ANALYZE "{table}"')
+
+
+def upsert_from_staging(
+    cursor, model: type[Model], staging_table: str, columns: list[str]
+) -> int:
+    """
+    This function inserts the rows of a staging table into the model's table, updating the rows
+    whose primary key is already there if any of their values differ.
+
+    Args:
+        cursor: The database cursor to use.
+        model (type[Model]): The model.
+        staging_table (str): The staging table.
+        columns (list[str]): The columns copied into the staging table (named after the fields of
+        the model or their attributes), including the primary key.
+
+    Returns:
+        int: The number of rows inserted or updated.
+    """
+
+    table, pk = model._meta.db_table, model._meta.pk.column
+    columns = [field.column for field in model_fields(model, columns)]
+    values = [column for column in columns if column != pk]
+
+    names = ", ".join(f'"{column}"' for column in columns)
+    if values:
+        assignments = ", ".join(
+            f'"{column}" = EXCLUDED."{column}"' for column in values
+        )
+        current = ", ".join(f'"{table}"."{column}"' for column in values)
+        excluded = ", ".join(f'EXCLUDED."{column}"' for column in values)
+        conflict = (
+            f"DO UPDATE SET {assignments} "
+            f"WHERE ROW({current}) IS DISTINCT FROM ROW({excluded})"
+        )
+    else:
+        conflict = "DO NOTHING"
+
+    cursor.execute(
+        f'INSERT INTO "{table}" ({names}) SELECT {names} FROM "{staging_table}" '
+        f'ON CONFLICT ("{pk}") {conflict}'
+    )
+    return cursor.rowcount
+
+
+def replace_from_staging(
+    cursor,
+    model: type[Model],
+    staging_table: str,
+    patent_column: str,
+    changed_table: str | None,
+) -> tuple[int, int]:
+    """
+    This function replaces the rows of the patents that changed with the rows of a staging table.
+
+    Args:
+        cursor: The database cursor to use.
+        model (type[Model]): The model.
+        staging_table (str): The staging table, with the new rows of the patents that changed.
+        patent_column (str): The column of the model with the patent of each row.
+        changed_table (str | None): A table with the ids of the patents that changed, whose rows
+        are deleted first, or None to only insert the rows.
+
+    Returns:
+        tuple[int, int]: The number of rows deleted and inserted.
+    """
+
+    table = model._meta.db_table
+    deleted = 0
+    if changed_table is not None:
+        cursor.execute(
+            f'DELETE FROM "{table}" WHERE "{patent_column}" IN '
+            f'(SELECT id FROM "{changed_table}")'
+        )
+        deleted = cursor.rowcount
+
+    names = ", ".join(f'"{field.column}"' for field in model._meta.concrete_fields)
+    cursor.execute(
+        f'INSERT INTO "{table}" ({names}) SELECT {names} FROM "{staging_table}"'
+    )
+    return deleted, cursor.rowcount
@@ -0,0 +1,149 @@
+"""
+This module contains the SideTable, which joins the rows of a small table (e.g. the application of
+each patent) to the chunks of a big one without a hash join per chunk.
+
+The side table is read once, in chunks, and kept as compact arrays: its keys in an IdMap (which maps
+each key to the position of its row) and its columns as arrays next to it, texts as fixed-width
+byte strings instead of Python objects. Joining a chunk is a binary search of its keys and a gather
+of the found rows, so the cost of a chunk depends on the size of the chunk and not on the size of
+the side table, and the memory is a few bytes per row of the side table.
+"""
+
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+
+from main.management.id_map import IdMap
+
+
+class SideTable:
+    """
+    A table indexed by a key column, joined to chunks of another table like a left pd.merge.
+
+    Usage:
+        application = SideTable(
+            read_csv("g_application.tsv", usecols=["patent_id", "filing_date"], chunksize=...),
+            "patent_id",
+        )
+        for chunk in patents:
+            chunk = application.join(chunk)
+    """
+
+    def __init__(self, chunks: Iterable[pd.DataFrame], key: str):
+        """
+        Args:
+            chunks (Iterable[pd.DataFrame]): The chunks of the table.
+            key (str): The column the table is joined on.
+        """
+
+        self.key = key
+        keys, columns = [], {}
+        for chunk in chunks:
+            keys.append(chunk[key].reset_index(drop=True))
+            for column in chunk.columns.drop(key):
+                columns.setdefault(column, []).append(_compact(chunk[column]))
+
+        keys = pd.concat([pd.Series(dtype=object), *keys], ignore_index=True)
+        self.positions = IdMap.from_pairs(keys, np.arange(len(keys)))
+        self.columns = {column: _concat(arrays) for column, arrays in columns.items()}
+
+    def join(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Adds the columns of the side table to the rows with the same key. Rows without one get
+        missing values, and if a key is in the side table more than once its first row is used.
+
+        Args:
+            df (pd.DataFrame): The rows to join.
+
+        Returns:
+            pd.DataFrame: The rows with the columns of the side table after their own.
+        """
+
+        positions = self.positions.map(df[self.key]).fillna(-1).to_numpy(np.int64)
+        df = df.copy()
+        for column, values in self.columns.items():
+            df[column] = _gather(values, positions, df.index)
+        return df
+
+    @property
+    def nbytes(self) -> int:
+        """
+        The memory taken by the keys and columns of the table.
+        """
+
+        return self.positions.nbytes + sum(
+            (
+                values.nbytes
+                if isinstance(values, pd.api.extensions.ExtensionArray)
+                # Texts are kept as an array of bytes and a mask of the missing ones
+                else values[0].nbytes + values[1].nbytes
+            )
+            for values in self.columns.values()
+        )
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+
+def _compact(values: pd.Series):
+    """
+    This function converts a column to the array it's kept as: texts to fixed-width utf-8 byte
+    strings with a mask of the missing ones, other columns to their pandas array.
+
+    Args:
+        values (pd.Series): The column.
+
+    Returns:
+        The compact column.
+    """
+
+    if values.dtype != object:
+        return values.array
+    missing = values.isna().to_numpy()
+    texts = values.where(~missing, "").astype(str)
+    try:
+        encoded = np.array(texts.to_numpy(), dtype=bytes)
+    except UnicodeEncodeError:
+        encoded = np.array(texts.str.encode("utf-8").to_numpy(), dtype=bytes)
+    return encoded, missing
+
+
+def _concat(arrays: list):
+    """
+    This function concatenates the compact arrays of the chunks of a column.
+    """
+
+    if isinstance(arrays[0], tuple):
+        return (
+            np.concatenate([encoded for encoded, _ in arrays]),
+            np.concatenate([missing for _, missing in arrays]),
+        )
+    return type(arrays[0])._concat_same_type(arrays)
+
+
+def _gather(values, positions: np.ndarray, index: pd.Index) -> pd.Series:
+    """
+    This function takes the values of a compact column at some positions.
+
+    Args:
+        values: The compact column.
+        positions (np.ndarray): The positions, -1 for a missing value.
+        index (pd.Index): The index of the result.
+
+    Returns:
+        pd.Series: The values, texts as str (NaN if missing) like pd.read_csv gives them.
+    """
+
+    if not isinstance(values, tuple):
+        return pd.Series(values.take(positions, allow_fill=True), index=index)
+
+    encoded, missing = values
+    found = positions != -1
+    texts = np.full(len(positions), np.nan, dtype=object)
+    taken = positions[found]
+    present = ~missing[taken]
+    texts[np.flatnonzero(found)[present]] = np.char.decode(
+        encoded[taken[present]], "utf-8"
+    ).astype(object)
+    return pd.Series(texts, index=index)
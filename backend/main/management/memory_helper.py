@@ -0,0 +1,329 @@
+"""
+This module contains the MemoryGovernor, which sizes the chunks the tables are read in so the
+ingestion stays under a memory budget.
+
+The memory a chunk takes is not known before it's read: it depends on the table, on the columns that
+are read and on what the stage does with them (e.g. the patents are lemmatized by the workers of the
+process pool). So the governor measures it: it reads the resident memory of the process and of its
+workers before a chunk is read and their peak until the next one is asked for, and divides the
+growth by the rows of the chunk. The peaks are reset before each chunk, since big arrays are given
+back to the system as soon as they are freed, so the memory after a chunk says little about it.
+
+The workers are forked, so they share most of their pages with the process and summing the resident
+memory of every process counts those pages once per worker. The memory in use is measured as the
+proportional set size instead, which splits each shared page between the processes that share it.
+
+The next chunk of the table gets as many rows as fit in what's left of the budget at that rate, so
+a box with more memory reads bigger chunks and a smaller one reads smaller chunks instead of being
+killed.
+"""
+
+import multiprocessing
+import os
+import weakref
+from typing import Iterator
+
+import pandas as pd
+
+MEMORY_HEADROOM = 0.8  # The share of the free budget a chunk is sized to fill
+MEMORY_MAX_GROWTH = 2  # How much bigger than the last one a chunk can get
+MEMORY_MAX_CHUNK_FACTOR = 4  # How much bigger than the requested size a chunk can get
+MEMORY_MIN_CHUNK_SIZE = 1000
+SIZE_UNITS = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+
+_open_peaks = weakref.WeakSet()  # The PeakRSS that are measuring, see reset_peaks
+
+
+def parse_size(text: str) -> int:
+    """
+    This function parses a size in bytes with an optional binary unit (e.g. 8G or 512M).
+
+    Args:
+        text (str): The size.
+
+    Raises:
+        ValueError: If the size is not valid.
+
+    Returns:
+        int: The size in bytes.
+    """
+
+    text = text.strip().upper().removesuffix("B").removesuffix("I")
+    unit = text[-1:] if text[-1:] in SIZE_UNITS else ""
+    size = float(text.removesuffix(unit)) * SIZE_UNITS[unit]
+    if size <= 0:
+        raise ValueError(f"{text} is not a positive size.")
+    return int(size)
+
+
+def format_size(size: float) -> str:
+    """
+    This function formats a size in bytes with a binary unit (e.g. 1.5G).
+    """
+
+    for unit in ["", "K", "M", "G"]:
+        if abs(size) < 1024:
+            return f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}T"
+
+
+def process_memory(pid: int | str = "self") -> tuple[int, int]:
+    """
+    This function reads the resident memory of a process and its peak from /proc.
+
+    Args:
+        pid (int | str, optional): The id of the process. Defaults to "self".
+
+    Returns:
+        tuple[int, int]: The resident memory and its peak since it was last reset (see
+        reset_peaks) in bytes, 0 if they can't be read (e.g. the process ended or the system has
+        no /proc).
+    """
+
+    memory = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("VmRSS", "VmHWM"):
+                    memory[key] = int(value.split()[0]) * 1024
+    except (OSError, ValueError):
+        pass
+    return memory.get("VmRSS", 0), memory.get("VmHWM", 0)
+
+
+def process_pss(pid: int | str = "self") -> int | None:
+    """
+    This function reads the proportional set size of a process from /proc, its resident memory
+    with every page shared with other processes (e.g. with forked workers) divided between them.
+
+    Args:
+        pid (int | str, optional): The id of the process. Defaults to "self".
+
+    Returns:
+        int | None: The proportional set size in bytes, None if it can't be read (e.g. the
+        process ended or the kernel is older than 4.14).
+    """
+
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key == "Pss":
+                    return int(value.split()[0]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def process_ids() -> list[int | str]:
+    """
+    This function returns the process and its child processes (e.g. the workers of the process
+    pool), whose memory all counts against the memory of the box.
+    """
+
+    return ["self", *(child.pid for child in multiprocessing.active_children())]
+
+
+def total_rss() -> int:
+    """
+    This function returns the resident memory of the process and of its child processes.
+    """
+
+    return sum(process_memory(pid)[0] for pid in process_ids())
+
+
+def total_pss() -> int:
+    """
+    This function returns the memory the process and its child processes use together, as the
+    sum of their proportional set sizes, so the pages they share are counted once. The resident
+    memory is used for the processes whose proportional set size can't be read.
+    """
+
+    total = 0
+    for pid in process_ids():
+        pss = process_pss(pid)
+        total += process_memory(pid)[0] if pss is None else pss
+    return total
+
+
+def total_peak_rss() -> int:
+    """
+    This function returns the sum of the peak resident memory of the process and of each of its
+    child processes since their peaks were last reset. The peaks might not be at the same time,
+    so it's an upper bound of the peak of the whole.
+    """
+
+    return sum(process_memory(pid)[1] for pid in process_ids())
+
+
+def reset_peaks() -> bool:
+    """
+    This function resets the peak resident memory of the process and of its child processes to
+    their current resident memory. The peaks so far are kept by the PeakRSS that are measuring.
+
+    Returns:
+        bool: Whether all of them were reset, it's not supported by every kernel.
+    """
+
+    peak = total_peak_rss()
+    for window in list(_open_peaks):
+        window.peak = max(window.peak, peak)
+
+    reset = True
+    for pid in process_ids():
+        try:
+            with open(f"/proc/{pid}/clear_refs", "w") as f:
+                f.write("5")
+        except OSError:
+            reset = False
+    return reset
+
+
+class PeakRSS:
+    """
+    Measures the peak resident memory of the process and of its child processes from when it's
+    created until it's stopped. Any number of them can measure at once (e.g. the peak of a stage
+    and of each of its chunks), since the peaks are reset only through reset_peaks. The peaks of
+    the processes are summed (see total_peak_rss), so the value is an upper bound of the peak.
+
+    Usage:
+        peak = PeakRSS()
+        process(chunk)
+        print(peak.stop())
+    """
+
+    def __init__(self):
+        # Without resetting the peaks only the memory at the time it's read can be measured
+        self.exact = reset_peaks()
+        self.peak = total_rss()
+        _open_peaks.add(self)
+
+    @property
+    def value(self) -> int:
+        """
+        The peak so far, in bytes.
+        """
+
+        if self not in _open_peaks:
+            return self.peak
+        return max(self.peak, total_peak_rss() if self.exact else total_rss())
+
+    def stop(self) -> int:
+        """
+        Stops measuring.
+
+        Returns:
+            int: The peak, in bytes.
+        """
+
+        self.peak = self.value
+        _open_peaks.discard(self)
+        return self.peak
+
+
+class MemoryGovernor:
+    """
+    Sizes the chunks of the tables that are read to stay under a memory budget.
+
+    Usage:
+        governor = MemoryGovernor(parse_size("8G"))
+        reader = pd.read_csv("g_patent.tsv.zip", sep="\\t", iterator=True)
+        for chunk in governor.chunks("g_patent", reader, 20000):
+            ...
+    """
+
+    def __init__(self, budget: int):
+        """
+        Args:
+            budget (int): The memory budget in bytes, for the process and its workers.
+        """
+
+        self.budget = budget
+        self.bytes_per_row: dict[str, float] = {}  # By table, measured by chunks
+        self.last_rows: dict[str, int] = {}  # By table, the rows of the last chunk
+
+    def chunk_size(self, table: str, requested: int, used: int) -> int:
+        """
+        Returns the rows of the next chunk of a table.
+
+        Args:
+            table (str): The name of the table.
+            requested (int): The chunk size the stage asked for, used until a chunk of the table
+            was measured.
+            used (int): The memory in use before the chunk is read (see total_pss).
+
+        Returns:
+            int: The rows of the chunk.
+        """
+
+        if used >= self.budget:
+            rows = MEMORY_MIN_CHUNK_SIZE
+        elif table not in self.bytes_per_row:
+            rows = requested
+        else:
+            free = max(self.budget - used, 0) * MEMORY_HEADROOM
+            rows = int(free / max(self.bytes_per_row[table], 1))
+            # The rate of bigger chunks wasn't measured, so they grow gradually
+            rows = min(rows, self.last_rows[table] * MEMORY_MAX_GROWTH)
+        return max(
+            MEMORY_MIN_CHUNK_SIZE, min(rows, requested * MEMORY_MAX_CHUNK_FACTOR)
+        )
+
+    def observe(self, table: str, rows: int, growth: int):
+        """
+        Records the memory a chunk of a table took, the rate of a table is the highest one seen,
+        so a chunk that happened to free memory doesn't make the next one too big.
+
+        Args:
+            table (str): The name of the table.
+            rows (int): The rows of the chunk.
+            growth (int): How much the resident memory grew while the chunk was read and processed.
+        """
+
+        if rows:
+            self.last_rows[table] = rows
+            self.bytes_per_row[table] = max(
+                self.bytes_per_row.get(table, 0), growth / rows
+            )
+
+    def chunks(
+        self, table: str, reader: pd.io.parsers.TextFileReader, requested: int
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Reads the chunks of a table, sizing each of them by the memory the previous ones took.
+
+        Args:
+            table (str): The name of the table, chunks of the same table are sized alike.
+            reader (pd.io.parsers.TextFileReader): The reader of the table (pd.read_csv with
+            iterator=True).
+            requested (int): The chunk size the stage asked for.
+
+        Yields:
+            pd.DataFrame: The chunks.
+        """
+
+        requested = int(requested)
+        warned = False
+        with reader:
+            while True:
+                used = total_pss()
+                if used > self.budget and not warned:
+                    print(
+                        f"Using {format_size(used)} of the {format_size(self.budget)} memory "
+                        f"budget before reading {table}, it's read in the smallest chunks."
+                    )
+                    warned = True
+                rows = self.chunk_size(table, requested, used)
+                # The growth is measured with the resident memory, since there's no peak of the
+                # proportional set size, the pages a chunk adds are private to one process anyway
+                before = total_rss()
+                peak = PeakRSS()
+                try:
+                    chunk = reader.get_chunk(rows)
+                except StopIteration:
+                    return
+                yield chunk
+                # The chunk was processed by the time the next one is asked for
+                self.observe(table, len(chunk), peak.stop() - before)
@@ -0,0 +1,54 @@
+"""
+This module contains what a sampled load needs to choose a subset of the patents that is the same
+in every run and in every table.
+
+A patent is in the sample if the hash of its PatentsView id is below the sampled fraction of the
+hash range. The hash only depends on the id, so the sample doesn't depend on the order or the
+chunks of a table, and the rows of a sampled patent are sampled in every table that has its id
+(e.g. its inventors, or the citations it receives) without knowing which patents were sampled.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def parse_fraction(text: str) -> float:
+    """
+    This function parses a fraction, either as a percentage (e.g. 1%) or as a number (e.g. 0.01).
+
+    Args:
+        text (str): The fraction.
+
+    Raises:
+        ValueError: If the fraction is not valid or not in (0, 1].
+
+    Returns:
+        float: The fraction.
+    """
+
+    text = text.strip()
+    if text.endswith("%"):
+        fraction = float(text.removesuffix("%")) / 100
+    else:
+        fraction = float(text)
+    if not 0 < fraction <= 1:
+        raise ValueError(f"{text} is not a fraction between 0 and 1.")
+    return fraction
+
+
+def sample_mask(ids: pd.Series, fraction: float) -> np.ndarray:
+    """
+    This function tells which ids are in a sample.
+
+    Args:
+        ids (pd.Series): The PatentsView ids (as strings).
+        fraction (float): The fraction of the ids that are sampled.
+
+    Returns:
+        np.ndarray: Whether each id is sampled.
+    """
+
+    if fraction >= 1:
+        return np.ones(len(ids), dtype=bool)
+    hashes = pd.util.hash_pandas_object(ids, index=False).to_numpy(dtype=np.uint64)
+    return hashes < np.uint64(fraction * 2.0**64)
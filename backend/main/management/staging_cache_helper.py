@@ -0,0 +1,228 @@
+"""
+This module contains the StagingCache, which converts the zipped PatentsView tables to Parquet once
+so later loads of the same release read them without parsing the TSVs again.
+
+The tables are converted with the multithreaded CSV reader of pyarrow and streamed into a Parquet
+file one block at a time, compressed with zstd. Every column is kept as text, which is the type of
+all of them in the TSVs, and is cast to the dtype the reader asks for when it's read, the same way
+pd.read_csv casts them. Only the columns that are asked for are read from the file.
+
+The converted files are keyed by the release of the table, i.e. the CRC32 and the size of the TSV
+inside the zip (which are stored in the zip, so they are known without reading the table), so a
+new release is converted again while the old one is still there for the loads that need it.
+
+pyarrow is only imported when a cache is used, so the other loads don't pay for importing it.
+"""
+
+import csv
+import os
+import zipfile
+from typing import Callable, Iterator
+
+import numpy as np
+import pandas as pd
+
+# pd.read_csv reads these as missing values by default, so the cache does too
+from pandas._libs.parsers import STR_NA_VALUES
+
+STAGING_CACHE_BLOCK_SIZE = 64 * 2**20  # Bytes of the TSV parsed at once
+STAGING_CACHE_COMPRESSION = "zstd"
+TRUE_VALUES = ["True", "TRUE", "true", "1"]
+FALSE_VALUES = ["False", "FALSE", "false", "0"]
+
+
+class StagingCache:
+    """
+    Reads zipped TSV tables through Parquet files converted once per release.
+
+    Usage:
+        cache = StagingCache("main/data/staging")
+        for chunk in cache.read("g_patent.tsv.zip", usecols=["patent_id"], chunksize=10000):
+            ...
+    """
+
+    def __init__(self, directory: str):
+        """
+        Args:
+            directory (str): The directory of the converted files.
+
+        Raises:
+            ImportError: If pyarrow is not installed.
+        """
+
+        import pyarrow
+        import pyarrow.csv
+        import pyarrow.parquet
+
+        self.pa = pyarrow
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, zip_path: str) -> str:
+        """
+        Returns the path of the converted file of a zipped table, for its release.
+
+        Args:
+            zip_path (str): The path of the zipped table.
+
+        Returns:
+            str: The path of the converted file.
+        """
+
+        member = _table_member(zip_path)
+        table = os.path.basename(zip_path).removesuffix(".tsv.zip")
+        return os.path.join(
+            self.directory, f"{table}-{member.CRC:08x}-{member.file_size}.parquet"
+        )
+
+    def convert(self, zip_path: str) -> str:
+        """
+        Converts a zipped table to Parquet, unless the release was already converted.
+
+        Args:
+            zip_path (str): The path of the zipped table.
+
+        Returns:
+            str: The path of the converted file.
+        """
+
+        path = self.path(zip_path)
+        if os.path.exists(path):
+            return path
+
+        print(f"Converting {os.path.basename(zip_path)} to {path}...")
+        with zipfile.ZipFile(zip_path) as archive:
+            member = archive.infolist()[0]
+            with archive.open(member) as f:
+                header = next(
+                    csv.reader([f.readline().decode("utf-8")], delimiter="\t")
+                )
+            with archive.open(member) as f:
+                reader = self.pa.csv.open_csv(
+                    f,
+                    read_options=self.pa.csv.ReadOptions(
+                        block_size=STAGING_CACHE_BLOCK_SIZE
+                    ),
+                    parse_options=self.pa.csv.ParseOptions(
+                        delimiter="\t", newlines_in_values=True
+                    ),
+                    convert_options=self.pa.csv.ConvertOptions(
+                        column_types={column: self.pa.string() for column in header},
+                        null_values=list(STR_NA_VALUES),
+                        strings_can_be_null=True,
+                    ),
+                )
+                # Written next to the final file and moved in place, so it's never half written
+                with self.pa.parquet.ParquetWriter(
+                    f"{path}.tmp", reader.schema, compression=STAGING_CACHE_COMPRESSION
+                ) as writer:
+                    for batch in reader:
+                        writer.write_batch(batch)
+        os.replace(f"{path}.tmp", path)
+        return path
+
+    def read(
+        self,
+        zip_path: str,
+        usecols: list[str] | Callable[[str], bool] | None = None,
+        dtype=None,
+        chunksize: int | None = None,
+    ) -> pd.DataFrame | Iterator[pd.DataFrame]:
+        """
+        Reads a zipped table through its converted file, converting it first if needed.
+        The arguments are the ones of pd.read_csv and the result is the same.
+
+        Args:
+            zip_path (str): The path of the zipped table.
+            usecols (list[str] | Callable[[str], bool] | None, optional): The columns to read.
+            Defaults to None, all of them.
+            dtype (optional): The dtype of all the columns or of each column. Defaults to None,
+            text.
+            chunksize (int | None, optional): Read the table in chunks of that many rows.
+            Defaults to None.
+
+        Returns:
+            pd.DataFrame | Iterator[pd.DataFrame]: The table, or an iterator over its chunks if
+            chunksize is given.
+        """
+
+        parquet_file = self.pa.parquet.ParquetFile(self.convert(zip_path))
+        columns = parquet_file.schema_arrow.names
+        if callable(usecols):
+            columns = [column for column in columns if usecols(column)]
+        elif usecols is not None:
+            # In the order of the file, like pd.read_csv
+            columns = [column for column in columns if column in usecols]
+
+        if chunksize is None:
+            return _to_frame(parquet_file.read(columns=columns), dtype, 0)
+        return self._read_chunks(parquet_file, columns, dtype, int(chunksize))
+
+    def _read_chunks(
+        self, parquet_file, columns: list[str], dtype, chunksize: int
+    ) -> Iterator[pd.DataFrame]:
+        start = 0
+        for batch in parquet_file.iter_batches(batch_size=chunksize, columns=columns):
+            yield _to_frame(batch, dtype, start)
+            start += batch.num_rows
+
+
+def _table_member(zip_path: str) -> zipfile.ZipInfo:
+    """
+    This function returns the TSV inside a zipped table.
+    """
+
+    with zipfile.ZipFile(zip_path) as archive:
+        return archive.infolist()[0]
+
+
+def _to_frame(table, dtype, start: int) -> pd.DataFrame:
+    """
+    This function converts a pyarrow table or record batch to a data frame with the dtypes
+    pd.read_csv gives.
+
+    Args:
+        table: The table or record batch, with text columns.
+        dtype: The dtype of all the columns or of each column, text if missing.
+        start (int): The first value of the index, chunks of pd.read_csv continue the index.
+
+    Returns:
+        pd.DataFrame: The data frame.
+    """
+
+    # Deduplicating the strings takes longer than creating them
+    df = table.to_pandas(deduplicate_objects=False)
+    df.index = pd.RangeIndex(start, start + len(df))
+    for column in df.columns:
+        column_dtype = dtype.get(column) if isinstance(dtype, dict) else dtype
+        df[column] = _cast(df[column], column_dtype)
+    return df
+
+
+def _cast(values: pd.Series, dtype) -> pd.Series:
+    """
+    This function casts a text column to a dtype the way pd.read_csv parses it.
+
+    Args:
+        values (pd.Series): The texts, None if missing.
+        dtype: The dtype, None or str to keep the texts.
+
+    Raises:
+        ValueError: If a value can't be cast to the dtype.
+
+    Returns:
+        pd.Series: The cast column, missing texts are NaN.
+    """
+
+    if dtype is None or dtype in (str, object, "str", "object"):
+        return values.where(values.notna(), np.nan)
+
+    if pd.api.types.pandas_dtype(dtype) == bool:
+        parsed = values.map(
+            {**dict.fromkeys(TRUE_VALUES, True), **dict.fromkeys(FALSE_VALUES, False)}
+        )
+        if parsed.isna().any():
+            raise ValueError(f"{values.name} has values that are not booleans.")
+        return parsed.astype(bool)
+
+    return pd.to_numeric(values).astype(dtype)
@@ -0,0 +1,736 @@
+"""
+This module contains the SyntheticPatentsView, which writes zipped tables with the schemas of the
+PatentsView tables the uspto command reads, filled with synthetic data at any scale.
+
+The data is random but shaped like the real one where it matters for the ingestion:
+    - The citations per patent, inventors per patent and rows per location are heavy tailed, and
+      a few patents are cited far more often than the rest.
+    - Titles and abstracts are made of real and made up words, so the lemmatization has work to do
+      and most of the texts are distinct.
+    - A small share of the rows is dirty the way the real tables are: malformed or out of range
+      dates, ids that are not in the referenced tables (patents, locations, CPC groups), invalid
+      IPC sections and missing values.
+
+The patents are generated in blocks and every table is written one block at a time, so the memory
+doesn't depend on the number of patents. The output only depends on the seed and the number of
+patents.
+"""
+
+import os
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+SYNTHETIC_BLOCK_SIZE = 100000  # Patents generated at once
+SYNTHETIC_COMPRESSION_LEVEL = 1  # The tables are written once and read a few times
+# The columns of each table, in the order of the PatentsView tables
+SYNTHETIC_SCHEMAS = {
+    "g_location_disambiguated": [
+        "location_id",
+        "disambig_city",
+        "disambig_state",
+        "disambig_country",
+        "latitude",
+        "longitude",
+        "county",
+        "state_fips",
+        "county_fips",
+    ],
+    "g_cpc_title": [
+        "cpc_subclass",
+        "cpc_subclass_title",
+        "cpc_group",
+        "cpc_group_title",
+        "cpc_class",
+        "cpc_class_title",
+    ],
+    "g_patent": [
+        "patent_id",
+        "patent_type",
+        "patent_date",
+        "patent_title",
+        "patent_abstract",
+        "wipo_kind",
+        "num_claims",
+        "withdrawn",
+        "filename",
+    ],
+    "g_application": [
+        "application_id",
+        "patent_id",
+        "patent_application_type",
+        "filing_date",
+        "series_code",
+        "rule_47_flag",
+    ],
+    "g_figures": ["patent_id", "num_figures", "num_sheets"],
+    "g_cpc_current": [
+        "patent_id",
+        "cpc_sequence",
+        "cpc_section",
+        "cpc_class",
+        "cpc_subclass",
+        "cpc_group",
+        "cpc_type",
+    ],
+    "g_ipc_at_issue": [
+        "patent_id",
+        "ipc_sequence",
+        "classification_level",
+        "section",
+        "ipc_class",
+        "subclass",
+        "main_group",
+        "subgroup",
+        "symbol_position",
+        "classification_value",
+        "classification_status",
+        "classification_data_source",
+        "action_date",
+        "ipc_version_indicator",
+    ],
+    "g_pct_data": [
+        "patent_id",
+        "published_or_filed_date",
+        "pct_371_date",
+        "pct_102_date",
+        "filed_country",
+        "application_kind",
+        "pct_doc_number",
+        "pct_doc_kind",
+        "pct_doc_type",
+    ],
+    "g_inventor_disambiguated": [
+        "patent_id",
+        "inventor_sequence",
+        "inventor_id",
+        "disambig_inventor_name_first",
+        "disambig_inventor_name_last",
+        "gender_code",
+        "location_id",
+    ],
+    "g_assignee_disambiguated": [
+        "patent_id",
+        "assignee_sequence",
+        "assignee_id",
+        "disambig_assignee_individual_name_first",
+        "disambig_assignee_individual_name_last",
+        "disambig_assignee_organization",
+        "assignee_type",
+        "location_id",
+    ],
+    "g_us_patent_citation": [
+        "patent_id",
+        "citation_sequence",
+        "citation_patent_id",
+        "citation_date",
+        "record_name",
+        "wipo_kind",
+        "citation_category",
+    ],
+    "g_foreign_citation": [
+        "patent_id",
+        "citation_sequence",
+        "citation_application_id",
+        "citation_date",
+        "citation_category",
+        "citation_country",
+    ],
+}
+CPC_SECTIONS = list("ABCDEFGHY")  # The sections of the cpc_section.json fixture
+IPC_SECTIONS = list("ABCDEFGH")
+COUNTRIES = ["US", "JP", "DE", "CN", "KR", "FR", "GB", "TW", "CA", "CH"]
+US_STATES = ["CA", "NY", "TX", "MA", "WA", "IL", "MI", "NJ", "MN", "PA"]
+FOREIGN_OFFICES = ["WO", "EP", "JP", "DE", "GB", "FR", "CN", "KR"]
+WORDS = (
+    "system method apparatus device assembly composition process circuit signal data "
+    "network wireless communication memory storage image display control unit module "
+    "sensor vehicle engine battery power energy light optical medical compound polymer "
+    "protein cell antibody semiconductor substrate layer film electrode wafer chip "
+    "processor computer program user interface access management receiving transmitting "
+    "generating determining providing forming using having including based improved "
+    "the a an of for and with in on to by from at which"
+).split()
+SYLLABLES = ["al", "ter", "on", "bi", "cro", "dyn", "ex", "flu", "gra", "hy", "ion"]
+
+
+class SyntheticPatentsView:
+    """
+    Writes synthetic PatentsView tables.
+
+    Usage:
+        SyntheticPatentsView(patents=100000, seed=0).write("main/data/synthetic")
+    """
+
+    def __init__(self, patents: int, seed: int = 0, dirty: float = 0.001):
+        """
+        Args:
+            patents (int): How many patents to generate.
+            seed (int, optional): The seed of the random generator. Defaults to 0.
+            dirty (float, optional): The share of dirty values of each kind (e.g. invalid dates
+            or unknown ids). Defaults to 0.001.
+        """
+
+        self.patents = patents
+        self.seed = seed
+        self.dirty = dirty
+        rng = np.random.default_rng([seed, 0])
+
+        # Made up words, so most texts are distinct and the lemmatization cache is not enough
+        made_up = [
+            "".join(rng.choice(SYLLABLES, rng.integers(2, 5))) for _ in range(5000)
+        ]
+        self.words = np.array(WORDS + made_up, dtype=object)
+        self.names = np.array(
+            [name.capitalize() for name in made_up[:2000]], dtype=object
+        )
+
+        # The CPC hierarchy, some groups are used by many more patents than others
+        groups = []
+        for section in CPC_SECTIONS:
+            for class_number in rng.choice(np.arange(1, 100), 12, replace=False):
+                cpc_class = f"{section}{class_number:02d}"
+                for letter in rng.choice(list("BCDFGHJKLMNPQ"), 5, replace=False):
+                    for main_group in rng.choice(np.arange(1, 100), 8, replace=False):
+                        groups.append(
+                            (
+                                f"{cpc_class}{letter}",
+                                f"{cpc_class}{letter}{main_group}/00",
+                                cpc_class,
+                            )
+                        )
+        self.cpc = pd.DataFrame(groups, columns=["subclass", "group", "class"])
+        self.cpc = self.cpc.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+        # Locations, with the patents of a region concentrated in a few of them
+        self.locations = max(100, patents // 20)
+        self.location_ids = _hex_ids(rng, self.locations)
+
+    def write(self, directory: str) -> list[str]:
+        """
+        Writes the tables, as <table>.tsv.zip files like the ones PatentsView publishes.
+
+        Args:
+            directory (str): The directory to write the tables to.
+
+        Returns:
+            list[str]: The paths of the tables.
+        """
+
+        os.makedirs(directory, exist_ok=True)
+        writers = {
+            table: _TableWriter(f"{directory}/{table}.tsv.zip", columns)
+            for table, columns in SYNTHETIC_SCHEMAS.items()
+        }
+        try:
+            writers["g_location_disambiguated"].write(self.location_table())
+            writers["g_cpc_title"].write(self.cpc_title_table())
+            for start in range(0, self.patents, SYNTHETIC_BLOCK_SIZE):
+                end = min(start + SYNTHETIC_BLOCK_SIZE, self.patents)
+                rng = np.random.default_rng([self.seed, 1, start])
+                for table, df in self.block_tables(rng, start, end).items():
+                    writers[table].write(df)
+                print(f"{end:,} of {self.patents:,} patents generated")
+        finally:
+            for writer in writers.values():
+                writer.close()
+        return [writer.path for writer in writers.values()]
+
+    def patent_ids(self, indexes: np.ndarray) -> np.ndarray:
+        """
+        Returns the PatentsView ids of patents by their index, most of them utility patents and
+        some design, plant and reissue patents.
+
+        Args:
+            indexes (np.ndarray): The indexes of the patents.
+
+        Returns:
+            np.ndarray: The ids.
+        """
+
+        kinds = indexes % 20
+        ids = _format(4000000 + indexes)
+        ids[kinds == 7] = _format(500000 + indexes[kinds == 7] // 20, "D", 6)
+        ids[kinds == 13] = _format(10000 + indexes[kinds == 13] // 20, "PP", 5)
+        reissued = (kinds == 19) & (indexes % 100 == 99)
+        ids[reissued] = _format(30000 + indexes[reissued] // 100, "RE", 5)
+        return ids
+
+    def location_table(self) -> pd.DataFrame:
+        rng = np.random.default_rng([self.seed, 2])
+        n = self.locations
+        countries = rng.choice(COUNTRIES, n, p=_zipf_weights(len(COUNTRIES), 1.5))
+        us = countries == "US"
+        latitude = rng.uniform(-60, 70, n).round(4)
+        longitude = rng.uniform(-180, 180, n).round(4)
+        missing = rng.random(n) < self.dirty * 10
+        return pd.DataFrame(
+            {
+                "location_id": self.location_ids,
+                "disambig_city": self.names[rng.integers(0, len(self.names), n)],
+                "disambig_state": np.where(us, rng.choice(US_STATES, n), None),
+                "disambig_country": countries,
+                "latitude": np.where(missing, np.nan, latitude),
+                "longitude": np.where(missing, np.nan, longitude),
+                "county": np.where(us, self.names[rng.integers(0, 2000, n)], None),
+                "state_fips": pd.array(
+                    np.where(us, rng.integers(1, 57, n), None), "Int64"
+                ),
+                "county_fips": pd.array(
+                    np.where(us, rng.integers(1000, 57000, n), None), "Int64"
+                ),
+            }
+        )
+
+    def cpc_title_table(self) -> pd.DataFrame:
+        return pd.DataFrame(
+            {
+                "cpc_subclass": self.cpc["subclass"],
+                "cpc_subclass_title": "Subclass " + self.cpc["subclass"],
+                "cpc_group": self.cpc["group"],
+                "cpc_group_title": "Group " + self.cpc["group"],
+                "cpc_class": self.cpc["class"],
+                "cpc_class_title": "Class " + self.cpc["class"],
+            }
+        )
+
+    def block_tables(
+        self, rng: np.random.Generator, start: int, end: int
+    ) -> dict[str, pd.DataFrame]:
+        """
+        Generates the rows of a block of patents in every table that has rows per patent.
+
+        Args:
+            rng (np.random.Generator): The random generator of the block.
+            start (int): The index of the first patent of the block.
+            end (int): The index after the last patent of the block.
+
+        Returns:
+            dict[str, pd.DataFrame]: The rows of each table.
+        """
+
+        indexes = np.arange(start, end)
+        ids = self.patent_ids(indexes)
+        n = len(ids)
+
+        # Granted on Tuesdays from 1976 on, in the order of the ids
+        weeks = (indexes * 2500 // max(self.patents, 1)).astype("timedelta64[W]")
+        granted = np.datetime64("1976-01-06") + weeks
+        filed = granted - rng.lognormal(6.8, 0.4, n).astype("timedelta64[D]")
+
+        tables = {
+            "g_patent": self.patent_rows(rng, ids, granted),
+            "g_application": self.application_rows(rng, ids, filed),
+            "g_figures": self.figure_rows(rng, ids),
+            "g_cpc_current": self.cpc_rows(rng, ids),
+            "g_ipc_at_issue": self.ipc_rows(rng, ids, granted),
+            "g_pct_data": self.pct_rows(rng, ids, filed),
+            "g_inventor_disambiguated": self.inventor_rows(rng, ids),
+            "g_assignee_disambiguated": self.assignee_rows(rng, ids),
+            "g_us_patent_citation": self.us_citation_rows(rng, indexes, granted),
+            "g_foreign_citation": self.foreign_citation_rows(rng, ids, granted),
+        }
+        # Some rows of the link tables are of patents that are not in g_patent
+        for table in tables:
+            if table not in ("g_patent", "g_application", "g_figures"):
+                df = tables[table]
+                unknown = rng.random(len(df)) < self.dirty
+                df.loc[unknown, "patent_id"] = _format(
+                    rng.integers(0, 10**7, unknown.sum()), "X", 7
+                )
+        return tables
+
+    def patent_rows(
+        self, rng: np.random.Generator, ids: np.ndarray, granted: np.ndarray
+    ) -> pd.DataFrame:
+        n = len(ids)
+        types = (
+            pd.Series(ids)
+            .str[0]
+            .map({"D": "design", "P": "plant", "R": "reissue"})
+            .fillna("utility")
+            .to_numpy()
+        )
+        return pd.DataFrame(
+            {
+                "patent_id": ids,
+                "patent_type": types,
+                "patent_date": self.dirty_dates(rng, granted),
+                "patent_title": self.texts(rng, n, 7, 0.4),
+                "patent_abstract": np.where(
+                    types == "design", None, self.texts(rng, n, 60, 0.5)
+                ),
+                "wipo_kind": np.where(types == "design", "S1", "B2"),
+                "num_claims": np.clip(rng.lognormal(2.8, 0.5, n), 1, 300).astype(int),
+                "withdrawn": (rng.random(n) < self.dirty).astype(int),
+                "filename": _format(rng.integers(0, 999999, n), "ipg", 6) + ".xml",
+            }
+        )
+
+    def application_rows(
+        self, rng: np.random.Generator, ids: np.ndarray, filed: np.ndarray
+    ) -> pd.DataFrame:
+        # A few patents have no application
+        present = rng.random(len(ids)) >= self.dirty * 5
+        ids, filed = ids[present], filed[present]
+        n = len(ids)
+        return pd.DataFrame(
+            {
+                "application_id": _format(rng.integers(10**7, 10**8, n)),
+                "patent_id": ids,
+                "patent_application_type": rng.choice(["14", "15", "16", "29"], n),
+                "filing_date": self.dirty_dates(rng, filed),
+                "series_code": rng.choice(["14", "15", "16", "29"], n),
+                "rule_47_flag": (rng.random(n) < 0.01).astype(int),
+            }
+        )
+
+    def figure_rows(self, rng: np.random.Generator, ids: np.ndarray) -> pd.DataFrame:
+        present = rng.random(len(ids)) < 0.9
+        n = present.sum()
+        figures = rng.geometric(0.12, n)
+        return pd.DataFrame(
+            {
+                "patent_id": ids[present],
+                "num_figures": figures,
+                "num_sheets": np.maximum(1, figures // 2 + rng.integers(0, 3, n)),
+            }
+        )
+
+    def cpc_rows(self, rng: np.random.Generator, ids: np.ndarray) -> pd.DataFrame:
+        patents, sequence = _repeat(ids, rng.geometric(0.35, len(ids)))
+        n = len(patents)
+        groups = self.cpc.iloc[_skewed(rng, len(self.cpc), n)]
+        group = groups["group"].to_numpy(dtype=object)
+        # Some groups are not in g_cpc_title
+        unknown = rng.random(n) < self.dirty
+        group[unknown] = group[unknown] + "9"
+        return pd.DataFrame(
+            {
+                "patent_id": patents,
+                "cpc_sequence": sequence,
+                "cpc_section": groups["class"].str[0].to_numpy(),
+                "cpc_class": groups["class"].to_numpy(),
+                "cpc_subclass": groups["subclass"].to_numpy(),
+                "cpc_group": group,
+                "cpc_type": np.where(sequence == 0, "inventional", "additional"),
+            }
+        )
+
+    def ipc_rows(
+        self, rng: np.random.Generator, ids: np.ndarray, granted: np.ndarray
+    ) -> pd.DataFrame:
+        rows = rng.geometric(0.55, len(ids))
+        patents, sequence = _repeat(ids, rows)
+        dates, _ = _repeat(granted, rows)
+        n = len(patents)
+        sections = rng.choice(IPC_SECTIONS, n)
+        sections[rng.random(n) < self.dirty] = "Z"  # Not an IPC section
+        main_groups = _format(rng.integers(1, 100, n))
+        # Some main groups have a trailing slash, like in the real table
+        slashed = rng.random(n) < 0.3
+        main_groups[slashed] = main_groups[slashed] + "/"
+        subclass = rng.choice(list("BCDFGHJKLMNPQ"), n).astype(object)
+        subclass[rng.random(n) < self.dirty] = None
+        return pd.DataFrame(
+            {
+                "patent_id": patents,
+                "ipc_sequence": sequence,
+                "classification_level": "A",
+                "section": sections,
+                "ipc_class": _format(rng.integers(1, 100, n), width=2),
+                "subclass": subclass,
+                "main_group": main_groups,
+                "subgroup": _format(rng.integers(0, 50, n) * 2, width=2),
+                "symbol_position": np.where(sequence == 0, "F", "L"),
+                "classification_value": "I",
+                "classification_status": "B",
+                "classification_data_source": "H",
+                "action_date": np.datetime_as_string(dates, "D"),
+                "ipc_version_indicator": "20060101",
+            }
+        )
+
+    def pct_rows(
+        self, rng: np.random.Generator, ids: np.ndarray, filed: np.ndarray
+    ) -> pd.DataFrame:
+        present = rng.random(len(ids)) < 0.12
+        ids, filed = ids[present], filed[present]
+        n = len(ids)
+        dates = np.datetime_as_string(filed, "D").astype(object)
+        dates[rng.random(n) < self.dirty * 10] = None
+        countries = rng.choice(FOREIGN_OFFICES[1:], n)
+        return pd.DataFrame(
+            {
+                "patent_id": ids,
+                "published_or_filed_date": dates,
+                "pct_371_date": dates,
+                "pct_102_date": dates,
+                "filed_country": countries,
+                "application_kind": "00",
+                "pct_doc_number": "PCT/"
+                + countries.astype(object)
+                + _format(rng.integers(0, 10**8, n), width=8),
+                "pct_doc_kind": "A1",
+                "pct_doc_type": rng.choice(["wo_grant", "pct_application"], n),
+            }
+        )
+
+    def inventor_rows(self, rng: np.random.Generator, ids: np.ndarray) -> pd.DataFrame:
+        patents, sequence = _repeat(ids, np.minimum(rng.geometric(0.45, len(ids)), 40))
+        n = len(patents)
+        inventors = rng.integers(0, max(self.patents, 1), n)
+        return pd.DataFrame(
+            {
+                "patent_id": patents,
+                "inventor_sequence": sequence,
+                "inventor_id": _format(inventors, "fl:in_"),
+                "disambig_inventor_name_first": self.names[inventors % len(self.names)],
+                "disambig_inventor_name_last": self.names[
+                    (inventors // len(self.names) + inventors) % len(self.names)
+                ],
+                "gender_code": rng.choice(["M", "F", None], n),
+                "location_id": self.location_column(rng, n),
+            }
+        )
+
+    def assignee_rows(self, rng: np.random.Generator, ids: np.ndarray) -> pd.DataFrame:
+        rows = rng.choice([0, 1, 2], len(ids), p=[0.15, 0.75, 0.1])
+        patents, sequence = _repeat(ids, rows)
+        n = len(patents)
+        assignees = _skewed(rng, max(self.patents // 10, 1), n)
+        individual = rng.random(n) < 0.05
+        return pd.DataFrame(
+            {
+                "patent_id": patents,
+                "assignee_sequence": sequence,
+                "assignee_id": _format(assignees, "as_"),
+                "disambig_assignee_individual_name_first": np.where(
+                    individual, self.names[assignees % len(self.names)], None
+                ),
+                "disambig_assignee_individual_name_last": np.where(
+                    individual, self.names[(assignees * 7) % len(self.names)], None
+                ),
+                "disambig_assignee_organization": np.where(
+                    individual,
+                    None,
+                    self.names[assignees % len(self.names)]
+                    + np.array([" Inc.", " Corporation", " GmbH", " Co., Ltd."])[
+                        assignees % 4
+                    ],
+                ),
+                "assignee_type": np.where(individual, 4, 2),
+                "location_id": self.location_column(rng, n),
+            }
+        )
+
+    def us_citation_rows(
+        self, rng: np.random.Generator, indexes: np.ndarray, granted: np.ndarray
+    ) -> pd.DataFrame:
+        # Most patents cite a few others and some cite hundreds
+        fan_out = np.minimum(rng.lognormal(2.2, 1.0, len(indexes)).astype(int), 2000)
+        citing, sequence = _repeat(indexes, fan_out)
+        dates, _ = _repeat(granted, fan_out)
+        n = len(citing)
+
+        # Recent patents are cited more, and a few patents (the hubs) are cited by many
+        cited = (citing * rng.beta(4, 1, n)).astype(np.int64)
+        hubs = rng.random(n) < 0.05
+        cited[hubs] = (_skewed(rng, self.patents, hubs.sum()) * 7919) % max(
+            self.patents, 1
+        )
+        cited_ids = self.patent_ids(cited)
+        # Patents from before the first synthetic one, which are not in g_patent
+        old = rng.random(n) < 0.1
+        cited_ids[old] = _format(rng.integers(100000, 3999999, old.sum()))
+
+        cited_dates = granted.min() - rng.integers(0, 20000, n).astype("timedelta64[D]")
+        cited_dates = np.where(old, cited_dates, dates - rng.integers(0, 5000, n))
+        return pd.DataFrame(
+            {
+                "patent_id": self.patent_ids(indexes)[citing - indexes[0]],
+                "citation_sequence": sequence,
+                "citation_patent_id": cited_ids,
+                "citation_date": self.out_of_range_dates(rng, cited_dates),
+                "record_name": None,
+                "wipo_kind": "A",
+                "citation_category": rng.choice(
+                    ["cited by examiner", "cited by applicant"], n
+                ),
+            }
+        )
+
+    def foreign_citation_rows(
+        self, rng: np.random.Generator, ids: np.ndarray, granted: np.ndarray
+    ) -> pd.DataFrame:
+        rows = rng.poisson(3, len(ids))
+        patents, sequence = _repeat(ids, rows)
+        dates, _ = _repeat(granted, rows)
+        n = len(patents)
+        offices = rng.choice(FOREIGN_OFFICES, n, p=_zipf_weights(len(FOREIGN_OFFICES)))
+        return pd.DataFrame(
+            {
+                "patent_id": patents,
+                "citation_sequence": sequence,
+                "citation_application_id": offices.astype(object)
+                + _format(rng.integers(10**6, 10**10, n)),
+                "citation_date": self.out_of_range_dates(
+                    rng, dates - rng.integers(0, 7000, n).astype("timedelta64[D]")
+                ),
+                "citation_category": "cited by examiner",
+                "citation_country": offices,
+            }
+        )
+
+    def texts(
+        self, rng: np.random.Generator, n: int, words: int, sigma: float
+    ) -> np.ndarray:
+        """
+        Returns texts of words chosen with a Zipf distribution, about as long as words on average.
+
+        Args:
+            rng (np.random.Generator): The random generator.
+            n (int): How many texts.
+            words (int): The median number of words of a text.
+            sigma (float): How much the lengths vary (the sigma of a lognormal distribution).
+
+        Returns:
+            np.ndarray: The texts.
+        """
+
+        lengths = np.maximum(1, rng.lognormal(np.log(words), sigma, n).astype(int))
+        chosen = self.words[_skewed(rng, len(self.words), lengths.sum())]
+        ends = np.cumsum(lengths)
+        return np.array(
+            [
+                " ".join(chosen[end - length : end])
+                for end, length in zip(ends, lengths)
+            ],
+            dtype=object,
+        )
+
+    def location_column(self, rng: np.random.Generator, n: int) -> np.ndarray:
+        """
+        Returns the location ids of n rows, a few locations have most of the rows and some ids are
+        not in g_location_disambiguated.
+        """
+
+        locations = self.location_ids[_skewed(rng, self.locations, n)]
+        unknown = rng.random(n) < self.dirty
+        locations[unknown] = _hex_ids(rng, unknown.sum())
+        return locations
+
+    def dirty_dates(self, rng: np.random.Generator, dates: np.ndarray) -> np.ndarray:
+        """
+        Formats dates as YYYY-MM-DD, with some of them malformed (e.g. 2000-02-30), out of range
+        or missing.
+        """
+
+        texts = pd.Series(np.datetime_as_string(dates.astype("datetime64[D]"), "D"))
+        kinds = rng.choice(4, len(texts), p=[1 - 3 * self.dirty, *[self.dirty] * 3])
+        texts[kinds == 1] = texts[kinds == 1].str[:4] + "-02-30"
+        texts[kinds == 2] = "1066" + texts[kinds == 2].str[4:]
+        texts[kinds == 3] = None
+        return texts.to_numpy(dtype=object)
+
+    def out_of_range_dates(
+        self, rng: np.random.Generator, dates: np.ndarray
+    ) -> np.ndarray:
+        """
+        Formats dates as YYYY-MM-DD, with some of them in years the USPTO didn't exist or
+        0000-00-00, which the citations have instead of missing dates.
+        """
+
+        texts = pd.Series(np.datetime_as_string(dates.astype("datetime64[D]"), "D"))
+        kinds = rng.choice(
+            3, len(texts), p=[1 - 2 * self.dirty, self.dirty, self.dirty]
+        )
+        texts[kinds == 1] = "0000-00-00"
+        texts[kinds == 2] = "1066" + texts[kinds == 2].str[4:]
+        return texts.to_numpy(dtype=object)
+
+
+class _TableWriter:
+    """
+    Writes the blocks of a table into a zipped TSV, with the header before the first block.
+    """
+
+    def __init__(self, path: str, columns: list[str]):
+        self.path = path
+        self.columns = columns
+        self.archive = zipfile.ZipFile(
+            f"{path}.tmp",
+            "w",
+            compression=zipfile.ZIP_DEFLATED,
+            compresslevel=SYNTHETIC_COMPRESSION_LEVEL,
+        )
+        name = os.path.basename(path).removesuffix(".zip")
+        self.file = self.archive.open(name, "w", force_zip64=True)
+        self.file.write(("\t".join(columns) + "\n").encode())
+
+    def write(self, df: pd.DataFrame):
+        self.file.write(
+            df[self.columns].to_csv(sep="\t", index=False, header=False).encode("utf-8")
+        )
+
+    def close(self):
+        self.file.close()
+        self.archive.close()
+        os.replace(f"{self.path}.tmp", self.path)
+
+
+def _repeat(values: np.ndarray, counts: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    This function repeats each value a number of times, for the rows of the link tables.
+
+    Args:
+        values (np.ndarray): The values (e.g. the patent ids).
+        counts (np.ndarray): How many times each value is repeated.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The repeated values and the sequence of each row within the
+        rows of its value.
+    """
+
+    repeated = np.repeat(values, counts)
+    starts = np.repeat(np.cumsum(counts) - counts, counts)
+    return repeated, np.arange(len(repeated)) - starts
+
+
+def _format(numbers: np.ndarray, prefix: str = "", width: int = 0) -> np.ndarray:
+    """
+    This function formats numbers as ids with a prefix, padded with zeros to a width.
+    """
+
+    texts = np.asarray(numbers).astype(str).astype(object)
+    if width:
+        texts = pd.Series(texts).str.zfill(width).to_numpy()
+    return prefix + texts
+
+
+def _hex_ids(rng: np.random.Generator, n: int) -> np.ndarray:
+    """
+    This function returns n random ids of 32 hexadecimal digits, like the location ids.
+    """
+
+    digits = rng.bytes(16 * n).hex()
+    return np.array([digits[i : i + 32] for i in range(0, 32 * n, 32)], dtype=object)
+
+
+def _skewed(rng: np.random.Generator, size: int, n: int, a: float = 1.1) -> np.ndarray:
+    """
+    This function chooses n positions in [0, size) with a Zipf distribution, so a few positions
+    are chosen much more often than the rest.
+    """
+
+    return (rng.zipf(a, n) - 1) % size
+
+
+def _zipf_weights(size: int, a: float = 1.0) -> np.ndarray:
+    """
+    This function returns the probabilities of a Zipf distribution over size values.
+    """
+
+    weights = 1 / np.arange(1, size + 1) ** a
+    return weights / weights.sum()
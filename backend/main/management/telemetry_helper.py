@@ -0,0 +1,349 @@
+"""
+This module contains the Telemetry of an ingestion run, which records where the time and the memory
+of each stage went and writes them to a JSON report.
+
+For each stage it records the wall and CPU time (of the process and of the workers of the process
+pool), an upper bound of the peak resident memory (the peaks of the process and of its workers
+summed, though they might not be at the same time), the rows and bytes of the tables it read, and
+the time spent in the steps that usually dominate (e.g. waiting for downloads, lemmatizing,
+copying and merging). For each chunk of a table it records the time it took to read and to process
+it, its CPU time and the upper bound of its peak resident memory. With tracemalloc it also records
+the lines that allocated the most memory that was still allocated when the stage ended.
+
+The report is rewritten after every stage, so a run that fails still leaves the stages it did, and
+a summary table is printed at the end so runs of different releases are easy to compare.
+"""
+
+import json
+import os
+import time
+import tracemalloc
+import zipfile
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Iterator
+
+import pandas as pd
+
+from main.management.memory_helper import PeakRSS, format_size, process_ids
+
+SUMMARY_COLUMNS = [
+    ("Stage", 24),
+    ("Wall", 9),
+    ("CPU", 9),
+    ("Rows read", 12),
+    ("Rows/s", 10),
+    ("Read", 9),
+    ("RSS bound", 10),
+    ("Download", 10),
+    ("Lemmatize", 10),
+    ("COPY", 9),
+    ("Merge", 9),
+]
+
+
+def cpu_seconds() -> float:
+    """
+    This function returns the CPU time (user and system) of the process and of its child processes
+    that are running (e.g. the workers of the process pool).
+
+    Returns:
+        float: The CPU time in seconds.
+    """
+
+    seconds = time.process_time()
+    ticks = os.sysconf("SC_CLK_TCK")
+    for pid in process_ids()[1:]:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                # The name of the process is in parentheses and can contain spaces
+                fields = f.read().rpartition(")")[2].split()
+        except OSError:
+            continue
+        seconds += (int(fields[11]) + int(fields[12])) / ticks  # utime and stime
+    return seconds
+
+
+class Telemetry:
+    """
+    Records the throughput, the time and the memory of the stages of a run and their chunks.
+
+    Usage:
+        telemetry = Telemetry("main/data/uspto_report.json")
+        with telemetry.stage("patent"):
+            for chunk in telemetry.chunks("g_patent", chunks):
+                with telemetry.timer("lemmatize"):
+                    ...
+        telemetry.print_summary()
+    """
+
+    def __init__(self, path: str, tracemalloc_top: int = 0):
+        """
+        Args:
+            path (str): The path of the JSON report.
+            tracemalloc_top (int, optional): How many of the lines that allocated the most memory
+            are recorded for each stage, 0 doesn't trace the allocations (which slows the run
+            down). Defaults to 0.
+        """
+
+        self.path = path
+        self.tracemalloc_top = tracemalloc_top
+        self.report = {
+            "started_at": datetime.now().isoformat(),
+            "stages": {},
+        }
+        self.current = None  # The record of the stage that is running
+        self.pipelines = []  # The copy pipelines of the stage that is running
+        self.start_time = time.perf_counter()
+        self.start_cpu = cpu_seconds()
+        self.peak = PeakRSS()
+        if tracemalloc_top:
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[dict]:
+        """
+        Records a stage, the report is saved once it ends (even if it fails).
+
+        Args:
+            name (str): The name of the stage.
+
+        Yields:
+            dict: The record of the stage, more values can be added to it.
+        """
+
+        record = {
+            "started_at": datetime.now().isoformat(),
+            "rows_read": 0,
+            "bytes_read": 0,
+            "tsv_bytes": 0,
+            "tables": {},
+            "timers": {},
+            "copies": {},
+            "chunks": [],
+        }
+        self.report["stages"][name] = record
+        self.current, self.pipelines = record, []
+        start_time, start_cpu, peak = time.perf_counter(), cpu_seconds(), PeakRSS()
+        snapshot = tracemalloc.take_snapshot() if self.tracemalloc_top else None
+
+        try:
+            yield record
+        except BaseException:
+            record["failed"] = True
+            raise
+        finally:
+            record["wall_seconds"] = time.perf_counter() - start_time
+            record["cpu_seconds"] = cpu_seconds() - start_cpu
+            record["peak_rss_bound"] = peak.stop()
+            record["rows_per_second"] = record["rows_read"] / max(
+                record["wall_seconds"], 1e-9
+            )
+            for pipeline in self.pipelines:
+                copy = record["copies"].setdefault(
+                    pipeline.table,
+                    {"rows": 0, "copy_seconds": 0.0, "put_wait_seconds": 0.0},
+                )
+                copy["rows"] += pipeline.rows
+                # The shards copy at the same time, so the slowest one is the time it took
+                copy["copy_seconds"] += max(pipeline.copy_seconds)
+                copy["put_wait_seconds"] += pipeline.put_wait_seconds
+            if snapshot is not None:
+                record["top_allocations"] = self.top_allocations(snapshot)
+            self.current, self.pipelines = None, []
+            self.save()
+
+    def table(self, table: str, path: str):
+        """
+        Records the size of a table a stage reads.
+
+        Args:
+            table (str): The name of the table.
+            path (str): The path of the zipped table.
+        """
+
+        if self.current is None or table in self.current["tables"]:
+            return
+        with zipfile.ZipFile(path) as archive:
+            tsv_bytes = archive.infolist()[0].file_size
+        size = {"bytes_read": os.path.getsize(path), "tsv_bytes": tsv_bytes, "rows": 0}
+        self.current["tables"][table] = size
+        self.current["bytes_read"] += size["bytes_read"]
+        self.current["tsv_bytes"] += size["tsv_bytes"]
+
+    def rows(self, table: str, rows: int):
+        """
+        Records rows of a table a stage read.
+
+        Args:
+            table (str): The name of the table.
+            rows (int): The rows.
+        """
+
+        if self.current is None:
+            return
+        self.current["rows_read"] += rows
+        if table in self.current["tables"]:
+            self.current["tables"][table]["rows"] += rows
+
+    def chunks(
+        self, table: str, chunks: Iterator[pd.DataFrame]
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Records the chunks of a table as they are read and processed.
+
+        Args:
+            table (str): The name of the table.
+            chunks (Iterator[pd.DataFrame]): The chunks.
+
+        Yields:
+            pd.DataFrame: The chunks.
+        """
+
+        chunks = iter(chunks)
+        while True:
+            start_time, start_cpu, peak = time.perf_counter(), cpu_seconds(), PeakRSS()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                peak.stop()
+                return
+            read_seconds = time.perf_counter() - start_time
+            self.rows(table, len(chunk))
+            yield chunk
+            # The chunk was processed by the time the next one is asked for
+            wall_seconds = time.perf_counter() - start_time
+            if self.current is not None:
+                self.current["chunks"].append(
+                    {
+                        "table": table,
+                        "rows": len(chunk),
+                        "read_seconds": read_seconds,
+                        "wall_seconds": wall_seconds,
+                        "cpu_seconds": cpu_seconds() - start_cpu,
+                        "rows_per_second": len(chunk) / max(wall_seconds, 1e-9),
+                        "peak_rss_bound": peak.stop(),
+                    }
+                )
+
+    @contextmanager
+    def timer(self, name: str):
+        """
+        Adds the time of a step to the timer with its name in the stage that is running.
+
+        Args:
+            name (str): The name of the step (e.g. lemmatize).
+        """
+
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.current is not None:
+                timers = self.current["timers"]
+                timers[name] = timers.get(name, 0.0) + time.perf_counter() - start_time
+
+    def add_pipeline(self, pipeline):
+        """
+        Records the rows and the copy time of a CopyPipeline of the stage that is running, once
+        the stage ends.
+
+        Args:
+            pipeline (CopyPipeline): The pipeline.
+        """
+
+        if self.current is not None:
+            self.pipelines.append(pipeline)
+
+    def top_allocations(self, snapshot: tracemalloc.Snapshot) -> list[dict]:
+        """
+        Returns the lines that allocated the most memory since a snapshot that is still allocated.
+
+        Args:
+            snapshot (tracemalloc.Snapshot): The snapshot.
+
+        Returns:
+            list[dict]: The lines with the size and the number of the allocations.
+        """
+
+        statistics = tracemalloc.take_snapshot().compare_to(snapshot, "lineno")
+        return [
+            {
+                "location": str(statistic.traceback),
+                "size": statistic.size_diff,
+                "count": statistic.count_diff,
+            }
+            for statistic in statistics[: self.tracemalloc_top]
+        ]
+
+    def save(self):
+        """
+        Writes the report, replacing the previous one atomically.
+        """
+
+        self.report["wall_seconds"] = time.perf_counter() - self.start_time
+        self.report["cpu_seconds"] = cpu_seconds() - self.start_cpu
+        self.report["peak_rss_bound"] = self.peak.value
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(f"{self.path}.tmp", "w") as f:
+            json.dump(self.report, f, indent=2)
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def summary(self) -> str:
+        """
+        Returns a table with the totals of each stage.
+
+        Returns:
+            str: The table.
+        """
+
+        lines = [_summary_row([title for title, _ in SUMMARY_COLUMNS])]
+        for name, record in self.report["stages"].items():
+            if "wall_seconds" not in record:
+                continue
+            timers = record["timers"]
+            copy_seconds = sum(
+                copy["copy_seconds"] for copy in record["copies"].values()
+            )
+            values = [
+                name + (" (failed)" if record.get("failed") else ""),
+                f"{record['wall_seconds']:.1f}s",
+                f"{record['cpu_seconds']:.1f}s",
+                f"{record['rows_read']:,}",
+                f"{record['rows_per_second']:,.0f}",
+                format_size(record["bytes_read"]),
+                format_size(record["peak_rss_bound"]),
+                f"{timers.get('download', 0):.1f}s",
+                f"{timers.get('lemmatize', 0):.1f}s",
+                f"{copy_seconds:.1f}s",
+                f"{timers.get('merge', 0):.1f}s",
+            ]
+            lines.append(_summary_row(values))
+        return "\n".join(lines)
+
+    def print_summary(self):
+        """
+        Prints the summary of the run and where the report was saved.
+        """
+
+        self.save()
+        print(self.summary())
+        print(
+            f"Total: {self.report['wall_seconds']:.1f}s, "
+            f"{self.report['cpu_seconds']:.1f}s of CPU, "
+            f"{format_size(self.report['peak_rss_bound'])} peak RSS at most "
+            "(the peaks of the processes are summed). "
+            f"The report was saved to {self.path}"
+        )
+
+
+def _summary_row(values: list[str]) -> str:
+    """
+    This function formats a row of the summary table, the stage is aligned left and the values
+    right.
+    """
+
+    (first, first_width), *rest = SUMMARY_COLUMNS
+    return f"{values[0]:<{first_width}}" + "".join(
+        f"{value:>{width}}" for value, (_, width) in zip(values[1:], rest)
+    )
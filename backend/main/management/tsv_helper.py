@@ -0,0 +1,268 @@
+"""
+This module contains a parallel reader for big TSV tables, which splits a table in byte ranges that
+are parsed by the workers of the shared process pool at the same time.
+
+A range can only start at the beginning of a row, but the PatentsView tables have quoted fields
+with newlines in them, so not every newline ends a row. The quotes inside quoted fields are doubled,
+so a newline ends a row only if the number of quotes before it is even. The ranges are found by
+counting the quotes up to an approximate offset and moving it to the next newline outside quotes.
+Counting bytes is much faster than parsing, so the ranges are found in the main process while the
+workers parse the ranges that were already found.
+
+The ranges are parsed with pd.read_csv, so the chunks are the same as the chunks of a single
+pd.read_csv except their size, and they are yielded in the order of the table. A stage can pass a
+transform that the worker applies to its range right after parsing it, so the per chunk work of
+the stage runs in parallel too.
+
+A quote in an unquoted field (e.g. 5" disk, or a field that ends in 5") is kept as it is by
+pd.read_csv but is counted by the split, which shifts the boundaries of the ranges after it. The
+workers look for such quotes in their range, and the table is read serially from the first range
+that has one.
+"""
+
+import mmap
+import os
+import shutil
+import zipfile
+from io import BytesIO
+from typing import Callable, Iterator
+
+import numpy as np
+import pandas as pd
+
+from main.management.helpers import multiprocessing_imap
+
+TSV_RANGE_SIZE = 64 * 2**20  # Bytes of the table parsed by a worker at once
+TSV_CHUNK_SIZE = 1000000  # Rows of the chunks of a serial read
+QUOTE = b'"'
+NEWLINE = b"\n"
+# The bytes before a quote that opens a quoted field
+FIELD_STARTS = np.frombuffer(b"\t\n", dtype=np.uint8)
+# The bytes after a quote that closes a quoted field
+FIELD_ENDS = np.frombuffer(b"\t\r\n", dtype=np.uint8)
+
+
+def extract_table(zip_path: str, path: str) -> str:
+    """
+    This function extracts the TSV of a zipped table, since the ranges of a compressed file can't
+    be read without decompressing everything before them. A table that was already extracted is
+    not extracted again.
+
+    Args:
+        zip_path (str): The path of the zipped table.
+        path (str): The path to extract the TSV to.
+
+    Returns:
+        str: The path of the TSV.
+    """
+
+    with zipfile.ZipFile(zip_path) as archive:
+        member = archive.infolist()[0]
+        if os.path.exists(path) and os.path.getsize(path) == member.file_size:
+            return path
+        with archive.open(member) as source, open(f"{path}.tmp", "wb") as target:
+            shutil.copyfileobj(source, target, 2**20)
+    os.replace(f"{path}.tmp", path)
+    return path
+
+
+def split_ranges(
+    path: str, range_size: int = TSV_RANGE_SIZE
+) -> Iterator[tuple[int, int]]:
+    """
+    This function splits the rows of a TSV (without its header) in byte ranges that start and end
+    at the boundaries of rows.
+
+    Args:
+        path (str): The path of the TSV.
+        range_size (int, optional): The approximate size of each range. Defaults to 64 MiB.
+
+    Yields:
+        tuple[int, int]: The start and end offset of each range.
+    """
+
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            start = _row_end(data, 0, 0)
+            while start < len(data):
+                target = min(start + range_size, len(data))
+                # The quotes of the range, so the newline after it is known to be in quotes or not
+                quotes = data[start:target].count(QUOTE)
+                end = _row_end(data, target, quotes)
+                yield start, end
+                start = end
+
+
+def read_tsv(
+    path: str,
+    range_size: int = TSV_RANGE_SIZE,
+    transform: Callable[[pd.DataFrame], pd.DataFrame] | None = None,
+    chunksize: int = TSV_CHUNK_SIZE,
+    **kwargs,
+) -> Iterator[pd.DataFrame]:
+    """
+    This function reads a TSV in chunks that are parsed in parallel by the shared process pool.
+    If a range has a quote in an unquoted field, the rest of the table is read serially.
+
+    Args:
+        path (str): The path of the TSV.
+        range_size (int, optional): The approximate size of each chunk in bytes. Defaults to
+        64 MiB.
+        transform (Callable[[pd.DataFrame], pd.DataFrame] | None, optional): A function applied
+        to each chunk by the worker that parsed it, it has to be picklable (e.g. a module level
+        function) and keep the index of the rows it returns. Defaults to None.
+        chunksize (int, optional): The rows of each chunk if the table is read serially.
+        Defaults to 1000000.
+        kwargs: Extra arguments passed to pd.read_csv (e.g. usecols, dtype).
+
+    Yields:
+        pd.DataFrame: The chunks, in the order of the table. Their index continues from the
+        previous chunk, like the chunks of pd.read_csv.
+    """
+
+    names = pd.read_csv(path, sep="\t", nrows=0).columns.tolist()
+    tasks = (
+        (path, start, end, names, transform, kwargs)
+        for start, end in split_ranges(path, range_size)
+    )
+    offset = 0
+    for start, rows, chunk in multiprocessing_imap(tasks, _read_range):
+        if chunk is None:
+            print(
+                f"{os.path.basename(path)} has quotes in unquoted fields, it's read serially "
+                f"from byte {start}."
+            )
+            yield from _read_serially(
+                path, start, names, offset, transform, chunksize, kwargs
+            )
+            return
+        chunk.index += offset
+        offset += rows
+        yield chunk
+
+
+def _row_end(data: mmap.mmap, position: int, quotes: int) -> int:
+    """
+    This function finds the end of the row a position is in.
+
+    Args:
+        data (mmap.mmap): The TSV.
+        position (int): The position, at the beginning of a row or inside it.
+        quotes (int): The quotes between the beginning of the row and the position.
+
+    Returns:
+        int: The offset after the newline that ends the row, or the size of the TSV.
+    """
+
+    while position < len(data):
+        newline = data.find(NEWLINE, position)
+        if newline == -1:
+            return len(data)
+        quotes += data[position:newline].count(QUOTE)
+        if quotes % 2 == 0:
+            return newline + 1
+        position = newline + 1
+    return len(data)
+
+
+def _has_stray_quotes(data: bytes) -> bool:
+    """
+    This function looks for quotes that neither open, close nor escape a quoted field, which
+    pd.read_csv keeps as they are but shift the rows found by counting quotes.
+
+    The quotes are looked at in runs of consecutive quotes. Since the data starts at a row, the
+    quotes before a run tell whether it starts inside a quoted field: outside one a run has to
+    open a field, so it has to be at the start of a field, and inside one its quotes escape each
+    other in pairs. A run that leaves the field closed (e.g. the last quote of "5"x) has to
+    be followed by the end of the field.
+
+    Args:
+        data (bytes): Whole rows of a TSV.
+
+    Returns:
+        bool: Whether there's a quote that doesn't open a field at its start, escape another
+        quote or close a field at its end.
+    """
+
+    data = np.frombuffer(data, dtype=np.uint8)
+    quotes = np.flatnonzero(data == ord(QUOTE))
+    if len(quotes) == 0:
+        return False
+
+    # The index (in quotes) of the first quote of each run and the length of the runs
+    runs = np.flatnonzero(np.diff(quotes, prepend=-2) != 1)
+    lengths = np.diff(runs, append=len(quotes))
+    starts = quotes[runs]
+    ends = starts + lengths
+
+    inside = runs % 2 == 1  # Whether the run starts inside a quoted field
+    opened = (starts == 0) | np.isin(data[starts - 1], FIELD_STARTS)
+    closed = inside == (lengths % 2 == 1)  # Whether the field is closed after the run
+    ended = np.isin(data[np.minimum(ends, len(data) - 1)], FIELD_ENDS) | (
+        ends == len(data)
+    )
+    return bool((~inside & ~opened).any() or (closed & ~ended).any())
+
+
+def _read_range(task: tuple) -> tuple[int, int, pd.DataFrame | None]:
+    """
+    This function parses a byte range of a TSV and transforms its rows, it runs in the workers
+    of the process pool.
+
+    Args:
+        task (tuple): The path of the TSV, the start and end of the range, the names of the
+        columns, the transform and the extra arguments of pd.read_csv.
+
+    Returns:
+        tuple[int, int, pd.DataFrame | None]: The start of the range, the rows that were parsed
+        and the transformed rows, or None if the range has stray quotes (see _has_stray_quotes).
+    """
+
+    path, start, end, names, transform, kwargs = task
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    if QUOTE in data and _has_stray_quotes(data):
+        return start, 0, None
+
+    # The header is added back, so a range without rows still gives the columns and dtypes
+    header = "\t".join(names).encode("utf-8") + NEWLINE
+    chunk = pd.read_csv(BytesIO(header + data), sep="\t", **kwargs)
+    rows = len(chunk)
+    return start, rows, transform(chunk) if transform else chunk
+
+
+def _read_serially(
+    path: str,
+    start: int,
+    names: list[str],
+    offset: int,
+    transform: Callable[[pd.DataFrame], pd.DataFrame] | None,
+    chunksize: int,
+    kwargs: dict,
+) -> Iterator[pd.DataFrame]:
+    """
+    This function reads the rows of a TSV from an offset on with a single pd.read_csv.
+
+    Args:
+        path (str): The path of the TSV.
+        start (int): The offset of a row.
+        names (list[str]): The names of the columns.
+        offset (int): The index of the row.
+        transform (Callable[[pd.DataFrame], pd.DataFrame] | None): The transform of the chunks.
+        chunksize (int): The rows of each chunk.
+        kwargs (dict): Extra arguments passed to pd.read_csv.
+
+    Yields:
+        pd.DataFrame: The transformed chunks.
+    """
+
+    with open(path, "rb") as f:
+        f.seek(start)
+        for chunk in pd.read_csv(
+            f, sep="\t", header=None, names=names, chunksize=chunksize, **kwargs
+        ):
+            chunk.index += offset
+            yield transform(chunk) if transform else chunk
@@ -0,0 +1,49 @@
+"""
+This module contains the referential validation of the rows copied into staging tables.
+
+The rows of the link tables are copied into staging tables as they are preprocessed, with the ids
+of the rows they reference missing when they couldn't be mapped (e.g. a patent id that is not in
+the patent id map). Before they are merged into their tables, the rows whose references are missing
+or don't exist in the referenced tables are deleted from the staging table with one anti-join per
+reference, instead of every chunk being checked against the database while it's preprocessed.
+"""
+
+from django.db.models import Model
+
+
+def validate_staging(
+    cursor, model: type[Model], staging_table: str, references: dict[str, bool]
+) -> dict[str, int]:
+    """
+    This function deletes the rows of a staging table whose references are not valid.
+
+    Args:
+        cursor: The database cursor to use.
+        model (type[Model]): The model of the staging table.
+        staging_table (str): The staging table.
+        references (dict[str, bool]): The foreign keys of the model that are validated, with
+        whether rows without one are deleted too.
+
+    Returns:
+        dict[str, int]: The number of rows deleted for each reason (e.g. "unknown patent"), a row
+        is only counted for the first reason it fails.
+    """
+
+    cursor.execute(f'ANALYZE "{staging_table}"')
+    rejected = {}
+    for name, required in references.items():
+        field = model._meta.get_field(name)
+        column = field.column
+        if required:
+            cursor.execute(f'DELETE FROM "{staging_table}" WHERE "{column}" IS NULL')
+            rejected[f"missing {name}"] = cursor.rowcount
+
+        referenced_table = field.related_model._meta.db_table
+        referenced_column = field.target_field.column
+        cursor.execute(
+            f'DELETE FROM "{staging_table}" AS staged WHERE staged."{column}" IS NOT NULL '
+            f'AND NOT EXISTS (SELECT 1 FROM "{referenced_table}" AS referenced '
+            f'WHERE referenced."{referenced_column}" = staged."{column}")'
+        )
+        rejected[f"unknown {name}"] = cursor.rowcount
+    return rejected
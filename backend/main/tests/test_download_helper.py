@@ -0,0 +1,172 @@
+"""
+Tests of the download helper against a local HTTP server that supports range requests.
+"""
+
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from main.management.download_helper import DownloadError, download_file
+
+CONTENT = bytes(range(256)) * 1024  # 256 KiB
+
+
+def etag(content: bytes) -> str:
+    """
+    The ETag S3 sends for a file that was not uploaded in parts, the md5 of the file.
+    """
+
+    return f'"{hashlib.md5(content).hexdigest()}"'
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+    Serves the content of the server with an md5 ETag (like S3) and answers range requests,
+    unless If-Range doesn't match the ETag. If the server has cut_after set, the next response
+    is cut after that many bytes of the body, like a dropped connection.
+    """
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        content = self.server.content
+
+        start = 0
+        match = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if match and self.headers.get("If-Range", etag(content)) == etag(content):
+            start = int(match.group(1))
+            if start >= len(content):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(content)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", f"bytes {start}-{len(content) - 1}/{len(content)}"
+            )
+        else:
+            self.send_response(200)
+        self.send_header("ETag", etag(content))
+        self.send_header("Content-Length", str(len(content) - start))
+        self.end_headers()
+
+        end = len(content)
+        if self.server.cut_after is not None:
+            end, self.server.cut_after = start + self.server.cut_after, None
+        self.wfile.write(content[start:end])
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DownloadFileTests(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+        self.server.content = CONTENT
+        self.server.cut_after = None
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/g_patent.tsv.zip"
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "g_patent.tsv.zip")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.directory.cleanup()
+
+    def write_partial(self, content: bytes, validator: str):
+        """
+        Leaves a partial download behind, like an interrupted run does.
+        """
+
+        with open(f"{self.path}.part", "wb") as f:
+            f.write(content)
+        with open(f"{self.path}.part.validator", "w") as f:
+            f.write(validator)
+
+    def read(self) -> bytes:
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def assert_downloaded(self):
+        self.assertEqual(
+            hashlib.md5(self.read()).digest(), hashlib.md5(CONTENT).digest()
+        )
+        self.assertFalse(os.path.exists(f"{self.path}.part"))
+        self.assertFalse(os.path.exists(f"{self.path}.part.validator"))
+
+    def test_resumes_dropped_connection(self):
+        self.server.cut_after = 100000
+
+        download_file(self.url, self.path, chunk_size=4096)
+
+        # The first response was cut, the retry asks for the rest of the same file from the
+        # end of the .part file (the bytes of the last incomplete read may be lost)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertNotIn("Range", self.server.requests[0])
+        offset = int(re.fullmatch(r"bytes=(\d+)-", self.server.requests[1]["Range"])[1])
+        self.assertTrue(0 < offset <= 100000)
+        self.assertEqual(self.server.requests[1]["If-Range"], etag(CONTENT))
+        self.assert_downloaded()
+
+    def test_resumes_partial_download(self):
+        self.write_partial(CONTENT[:100000], etag(CONTENT))
+
+        download_file(self.url, self.path)
+
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.server.requests[0]["Range"], "bytes=100000-")
+        self.assertEqual(self.server.requests[0]["If-Range"], etag(CONTENT))
+        self.assert_downloaded()
+
+    def test_finishes_complete_partial_download(self):
+        # The previous run received every byte but stopped before verifying the file
+        self.write_partial(CONTENT, etag(CONTENT))
+
+        download_file(self.url, self.path)
+
+        self.assertEqual(self.server.requests[0]["Range"], f"bytes={len(CONTENT)}-")
+        self.assert_downloaded()
+
+    def test_rejects_partial_download_longer_than_file(self):
+        self.write_partial(CONTENT + b"stale", etag(CONTENT))
+
+        with self.assertRaisesRegex(DownloadError, "not valid anymore"):
+            download_file(self.url, self.path)
+
+        # The partial download is removed, so the next run starts over
+        self.assertFalse(os.path.exists(f"{self.path}.part"))
+        download_file(self.url, self.path)
+        self.assert_downloaded()
+
+    def test_starts_over_when_file_changed(self):
+        old_content = bytes(reversed(CONTENT))
+        self.write_partial(old_content[:100000], etag(old_content))
+
+        download_file(self.url, self.path)
+
+        # The server ignores the range, since If-Range doesn't match its ETag
+        self.assertEqual(self.server.requests[0]["Range"], "bytes=100000-")
+        self.assertEqual(self.server.requests[0]["If-Range"], etag(old_content))
+        self.assert_downloaded()
+
+    def test_rejects_wrong_checksum(self):
+        with self.assertRaisesRegex(DownloadError, "sha256"):
+            download_file(self.url, self.path, expected_sha256="0" * 64)
+
+        # The bad download is removed, so the next run doesn't resume it
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(f"{self.path}.part"))
+        self.assertFalse(os.path.exists(f"{self.path}.part.validator"))
+
+        download_file(
+            self.url, self.path, expected_sha256=hashlib.sha256(CONTENT).hexdigest()
+        )
+        self.assert_downloaded()
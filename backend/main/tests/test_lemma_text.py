@@ -0,0 +1,54 @@
+"""
+Tests that the optimized text normalization produces exactly the output of the original one.
+"""
+
+import string
+import unittest
+
+from nltk.corpus import stopwords
+from nltk.stem import WordNetLemmatizer
+from nltk.tokenize import word_tokenize
+
+from main.management.helpers import lemma_text
+
+lemma = WordNetLemmatizer()
+
+TEXTS = [
+    None,
+    "",
+    "Method and apparatus for controlling a vehicle",
+    "A semiconductor device includes a substrate, a gate electrode disposed on the "
+    "substrate, and source/drain regions. The gate electrode has a width of 10-20 nm.",
+    "Systems and methods are disclosed for processing the data of the users' devices; "
+    "the processors are configured to receive, store and analyze it.",
+    "The user cannot open it, so we're gonna wanna gimme a hand, lemme see what we gotta do.",
+    "Compounds of formula (I) wherein R1 is C1-C6 alkyl, and their salts (e.g. HCl).",
+    "Naïve café résumé: the α-helix and β-sheet of the protein—see FIG. 3…",
+    "Multiple    spaces,\ttabs\nand\r\nnew lines between the words",
+    "1. A method comprising: 2. The method of claim 1, wherein . . . and so on.",
+    "THE MICE WERE FED GEESE AND THE LEAVES WERE ANALYZED BY THE ANALYSES",
+]
+
+
+def reference_lemma_text(text: str | None) -> tuple[int, str]:
+    """
+    The original, unoptimized implementation of lemma_text.
+    """
+
+    if not text:
+        return 0, ""
+    tokens = [
+        lemma.lemmatize(w)
+        for w in word_tokenize(
+            text.lower().translate(str.maketrans("", "", string.punctuation))
+        )
+        if w not in stopwords.words("english")
+    ]
+    return len(tokens) - tokens.count("."), " ".join(tokens)
+
+
+class LemmaTextTests(unittest.TestCase):
+    def test_matches_reference(self):
+        for text in TEXTS:
+            with self.subTest(text=text):
+                self.assertEqual(lemma_text(text), reference_lemma_text(text))
@@ -0,0 +1,73 @@
+"""
+Tests of the parallel TSV reader, in particular of the quotes that shift the ranges.
+"""
+
+import os
+import tempfile
+import unittest
+
+import pandas as pd
+
+from main.management.helpers import close_pool
+from main.management.tsv_helper import _has_stray_quotes, read_tsv
+
+
+class StrayQuotesTests(unittest.TestCase):
+    def test_quoted_fields(self):
+        for data in [
+            b"1\tplain\n",
+            b'1\t"quoted\tfield"\n',
+            b'1\t"a ""quoted"" word"\n',
+            b'1\t"""quoted"""\n',
+            b'1\t""\t2\n',
+            b'"1"\tfirst\n',
+            b'1\t"multi\nline"\r\n',
+        ]:
+            with self.subTest(data=data):
+                self.assertFalse(_has_stray_quotes(data))
+
+    def test_stray_quotes(self):
+        for data in [
+            b'1\t5" disk\n',
+            b'1\t5"\t2\n',
+            b'1\t5"\n',
+            b'1\t5"\r\n',
+            b'1\t"closed"early\n',
+        ]:
+            with self.subTest(data=data):
+                self.assertTrue(_has_stray_quotes(data))
+
+
+class ReadTsvTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "g_patent.tsv")
+
+    def tearDown(self):
+        close_pool()
+        self.directory.cleanup()
+
+    def assert_read(self, rows: list[str]):
+        with open(self.path, "w") as f:
+            f.write("patent_id\tpatent_title\tpatent_type\n" + "".join(rows))
+
+        chunks = list(read_tsv(self.path, range_size=64, chunksize=3, dtype=str))
+
+        expected = pd.read_csv(self.path, sep="\t", dtype=str)
+        pd.testing.assert_frame_equal(pd.concat(chunks), expected)
+
+    def test_quoted_fields(self):
+        self.assert_read(
+            [
+                f'{i}\t"A ""quoted""\ttitle\nwith a newline"\tutility\n'
+                for i in range(20)
+            ]
+        )
+
+    def test_stray_quotes_at_field_end(self):
+        # The quotes would make the split look for the end of the ranges inside quotes
+        rows = [f"{i}\tTitle {i}\tutility\n" for i in range(20)]
+        rows[5] = '5\tA 5"\tutility\n'
+        rows[8] = '8\tTitle 8\tA 5"\n'
+        rows[12] = '12\t"Quoted\ntitle"\tutility\n'
+        self.assert_read(rows)